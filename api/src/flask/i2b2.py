@@ -72,11 +72,8 @@ def updatemeta(source_id:str = None):
         meta_server = os.getenv("META_SERVER"),
         source_id = source_id
         )
-    meta_flush = "http://{meta_server}:5000/flush-metadata?source_id={source_id}".format(
-        meta_server = os.getenv("META_SERVER"),
-        source_id = source_id
-        )
-    meta_load = "http://{meta_server}:5000/load-csv-to-postgres?source_id={source_id}".format(
+    ## The load replaces the previous metadata of the source in one short transaction (so no flush beforehand, which would leave i2b2 without it meanwhile)
+    meta_load = "http://{meta_server}:5000/load-csv-to-postgres?source_id={source_id}&replace=true".format(
         meta_server = os.getenv("META_SERVER"),
         source_id = source_id
         )
@@ -89,8 +86,6 @@ def updatemeta(source_id:str = None):
     ## For subsequent "result"s, do not override "False" if the latest response is true. Append text instead of overwrite 
     result = [meta_response.ok, meta_response.text]
     if meta_response:
-        meta_response = requests.get(meta_flush)
-        result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
         meta_response = requests.get(meta_load)
         result = [not result[0] or meta_response.ok, result[1] + meta_response.text]
     meta_response = requests.get(meta_count_patients)
@@ -142,3 +137,20 @@ def update_patient_counts():
         endpoint_status = str(result[0]),
         endpoint_messages = result[1].replace("\n","<br/>")
     )
+
+@app.route('/partition-tables')
+def partition_tables():
+    """Make a basic http request to the meta container which will then convert i2b2's ontology and dimension tables to one partition per source"""
+    logger.info("Partitioning i2b2 tables by source...")
+
+    meta_partition_endpoint = "http://{meta_server}:5000/partition-tables".format(
+        meta_server = os.getenv("META_SERVER")
+        )
+    logger.debug("Forwarding request to responsible container: {}".format(meta_partition_endpoint))
+    meta_response = requests.get(meta_partition_endpoint)
+    result = [meta_response.ok, meta_response.text]
+    logger.debug("Tables partitioned: {}".format(result))
+    return "<html><body><p>Success: {endpoint_status}</p><p>Message Log:<br/>{endpoint_messages}</p></body></html>\n".format(
+        endpoint_status = str(result[0]),
+        endpoint_messages = result[1].replace("\n","<br/>")
+    )
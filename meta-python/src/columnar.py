@@ -0,0 +1,196 @@
+""" columnar.py
+Typed columnar intermediate files (Arrow IPC or Parquet) for the handoff between fetching and loading
+
+Optional - needs pyarrow. The values are converted once when writing (types, NULLs, sourcesystem_cd), so the loader doesn't need to sniff or guess
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+import datetime
+import os
+import re
+import time
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.types
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+## File extension for each format
+file_extensions:dict = {"arrow": ".arrow", "parquet": ".parquet"}
+
+## Column types of the i2b2 tables, in the same format as meta._get_col_limits - columns which aren't listed are strings
+column_types:dict = {
+    "i2b2metadata.i2b2": {"c_hlevel": "integer", "c_totalnum": "integer", "update_date": "timestamp without time zone", "download_date": "timestamp without time zone", "import_date": "timestamp without time zone"},
+    "i2b2metadata.table_access": {"c_hlevel": "integer", "c_totalnum": "integer", "c_entry_date": "timestamp without time zone", "c_change_date": "timestamp without time zone"},
+    "i2b2demodata.concept_dimension": {"update_date": "timestamp without time zone", "download_date": "timestamp without time zone", "import_date": "timestamp without time zone", "upload_id": "integer"},
+    "i2b2demodata.modifier_dimension": {"update_date": "timestamp without time zone", "download_date": "timestamp without time zone", "import_date": "timestamp without time zone", "upload_id": "integer"},
+}
+## Timestamp columns which are "current_timestamp" in the csv - their NULLs are replaced with the time of loading (flagged in the field metadata)
+load_time_columns:dict = {
+    "i2b2metadata.i2b2": ["update_date", "import_date"],
+    "i2b2demodata.concept_dimension": ["update_date", "import_date"],
+    "i2b2demodata.modifier_dimension": ["update_date", "import_date"],
+}
+LOAD_TIME_KEY = b"null_is_load_time"
+
+def available() -> bool:
+    """True when pyarrow can be imported"""
+    return pyarrow is not None
+
+def intermediate_format() -> str:
+    """The configured "intermediate_format" - "csv" when not configured or when pyarrow is missing"""
+    file_format = app.config.get("intermediate_format", "csv")
+    if file_format in file_extensions and not available():
+        logger.warn("intermediate_format '{}' needs pyarrow, which is not installed - using csv".format(file_format))
+        return "csv"
+    if file_format not in file_extensions:
+        return "csv"
+    return file_format
+
+def _arrow_type(col_type:str):
+    """Arrow type for a postgres type as listed by _get_col_limits"""
+    if col_type in ["integer", "smallint"]:
+        return pyarrow.int32()
+    elif col_type == "bigint":
+        return pyarrow.int64()
+    elif col_type.startswith("timestamp"):
+        return pyarrow.timestamp("us")
+    return pyarrow.string()
+
+def table_schema(schema_name:str, table_name:str, ordered_cols:list):
+    """The arrow schema for a table, with its columns in the order of the csv"""
+    table_key = "{}.{}".format(schema_name, table_name)
+    col_types = column_types.get(table_key, {})
+    load_time_cols = load_time_columns.get(table_key, [])
+    fields = []
+    for col_name in ordered_cols:
+        metadata = {LOAD_TIME_KEY: b"true"} if col_name in load_time_cols else None
+        fields.append(pyarrow.field(col_name, _arrow_type(col_types.get(col_name, "text")), metadata = metadata))
+    return pyarrow.schema(fields)
+
+def _convert(value:str, col_name:str, col_type:str, source_id:str):
+    """Convert a csv value to the typed value - the same rules the csv loader applies"""
+    if col_name == "sourcesystem_cd":
+        return source_id
+    if value == "" or value == "NULL" or value == "None":
+        ## c_dimcode must be the string "NULL" rather than NULL (see push_csv_to_database)
+        return "NULL" if col_name == "c_dimcode" else None
+    if col_type in ["integer", "smallint", "bigint"]:
+        return int(value)
+    if col_type.startswith("timestamp"):
+        if value == "current_timestamp":
+            return None
+        return parse_timestamp(value)
+    return value
+
+def parse_timestamp(value:str) -> datetime.datetime:
+    """Parse a timestamp of the csv - the format written by the model ("%Y-%m-%d %H:%M:%S.0") or any ISO 8601 date or date and time,
+    like postgres accepts them in the csv path. A time zone is dropped (the columns are "timestamp without time zone")
+    """
+    value = value.strip()
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        ## Before python 3.11, fromisoformat only accepts 3 or 6 digits of fractional seconds (eg not the ".0" of the model)
+        match = re.match(r"^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2})\.(\d+)(.*)$", value)
+        if match is None:
+            raise ValueError("Invalid timestamp: '{}'".format(value))
+        parsed = datetime.datetime.fromisoformat("{}.{}{}".format(match.group(1), match.group(2)[ : 6].ljust(6, "0"), match.group(3)))
+    return parsed.replace(tzinfo = None)
+
+def _record_batch(schema, rows:list, source_id:str):
+    """Convert csv rows of a table into a typed record batch of the schema (from table_schema)"""
+    columns = []
+    for col_index, field in enumerate(schema):
+        col_type = "integer" if pyarrow.types.is_integer(field.type) else "timestamp" if pyarrow.types.is_timestamp(field.type) else "text"
+        columns.append(pyarrow.array([_convert(row[col_index], field.name, col_type, source_id) for row in rows], type = field.type))
+    return pyarrow.RecordBatch.from_arrays(columns, schema = schema)
+
+def write_tables(tree_lines, sourcesystem_id:str, out_dir:str, file_format:str = "arrow", table_columns:dict = None, write_stats:dict = None, file_stats:dict = None) -> bool:
+    """Write one typed file per table (the successor of meta.write_csv)
+
+    Each tree's rows are appended as a record batch (or row group), so only one tree's rows are held at a time
+    :param tree_lines: Iterable of the csv lines of each tree ({schema: {table: [rows]}}), eg from meta.csv_trees_parallel
+    :param table_columns: Ordered columns for each table {"<schema>.<table>": [cols]}, defaults to those of the model
+    :param write_stats: Optional dict, filled with {"<schema>.<table>": {"rows", "seconds", "rows_per_second"}}
+    :param file_stats: Optional dict, filled with {<filename>: {"bytes", "seconds"}}. The files are written atomically (see output_files)
+        and compressed internally, with the codec of config "output_compression" (arrow files only support zstd, which is also used for gzip)
+    """
+    import output_files
+    if table_columns is None:
+        from model import MetaNode
+        table_columns = MetaNode.table_columns
+    if write_stats is None:
+        write_stats = {}
+    logger.debug("Writing {} files under '{}'".format(file_format, out_dir))
+    compression = app.config.get("output_compression", "none") or "none"
+    writers:dict = {}
+    schemas:dict = {}
+    outputs:dict = {}
+    try:
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        for lines in tree_lines:
+            for schema_name, tables in lines.items():
+                for table_name, rows in tables.items():
+                    table_key = "{}.{}".format(schema_name, table_name)
+                    start = time.perf_counter()
+                    table_stats = write_stats.setdefault(table_key, {"rows": 0, "seconds": 0.0})
+                    if table_key not in writers:
+                        filename = os.path.join(out_dir, "{sourcesystem_id}.{schema_name}.{table_name}{extension}".format(sourcesystem_id=sourcesystem_id, schema_name=schema_name, table_name=table_name, extension=file_extensions[file_format]))
+                        logger.debug("Writing {} data to file: {}".format(file_format, filename))
+                        schemas[table_key] = table_schema(schema_name, table_name, table_columns[table_key])
+                        outputs[table_key] = output_files.OutputFile(filename, binary = True)
+                        if file_format == "parquet":
+                            writers[table_key] = pyarrow.parquet.ParquetWriter(outputs[table_key].file, schemas[table_key], compression = compression)
+                        else:
+                            options = pyarrow.ipc.IpcWriteOptions(compression = None if compression == "none" else "zstd")
+                            writers[table_key] = pyarrow.ipc.new_file(outputs[table_key].file, schemas[table_key], options = options)
+                    if len(rows) == 0:
+                        continue
+                    batch = _record_batch(schemas[table_key], rows, sourcesystem_id)
+                    if file_format == "parquet":
+                        writers[table_key].write_table(pyarrow.Table.from_batches([batch]))
+                    else:
+                        writers[table_key].write_batch(batch)
+                    table_stats["rows"] += batch.num_rows
+                    table_stats["seconds"] += time.perf_counter() - start
+        for table_key, writer in writers.items():
+            writer.close()
+            outputs[table_key].seconds += write_stats[table_key]["seconds"]
+        writers = {}
+        output_files.commit_all(list(outputs.values()), file_stats)
+        for table_stats in write_stats.values():
+            table_stats["rows_per_second"] = round(table_stats["rows"] / table_stats["seconds"]) if table_stats["seconds"] > 0 else 0
+        logger.info("Wrote {} for '{}': {}".format(file_format, sourcesystem_id, write_stats))
+        return True
+    except Exception as e:
+        logger.error("Failed to write {} data: {}".format(file_format, e))
+        output_files.discard_all(list(outputs.values()))
+        return False
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+def read_table(file_path:str):
+    """Read a file written by write_tables - arrow files are memory mapped, so the columns aren't copied"""
+    if file_path.endswith(file_extensions["parquet"]):
+        return pyarrow.parquet.read_table(file_path, memory_map = True)
+    with pyarrow.memory_map(file_path, "r") as source:
+        return pyarrow.ipc.open_file(source).read_all()
+
+def table_rows(table, load_time:datetime.datetime):
+    """Generator for the rows of a table read by read_table as dicts, with the NULLs of load time columns replaced by load_time"""
+    load_time_cols = [field.name for field in table.schema if field.metadata and field.metadata.get(LOAD_TIME_KEY) == b"true"]
+    for batch in table.to_batches():
+        columns = {name: batch.column(i).to_pylist() for i, name in enumerate(batch.schema.names)}
+        for col_name in load_time_cols:
+            columns[col_name] = [load_time if value is None else value for value in columns[col_name]]
+        for row_index in range(batch.num_rows):
+            yield {name: values[row_index] for name, values in columns.items()}
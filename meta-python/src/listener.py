@@ -36,6 +36,9 @@ def load_settings(app_context):
         app_settings = yaml.safe_load(yaml_file)
     for k, v in app_settings.items():
         app_context.config[k] = v
+    ## Csv column plans are built from the settings
+    from model import MetaNode
+    MetaNode.reset_column_plans()
 
 ## Import and configure the flask app
 from flask import Flask
@@ -51,12 +54,26 @@ app.logger.debug("Flask app loaded and configured with: {}".format(os.getenv('AP
 ## TODO: Load .env based settings (which are needed when we don't want to rebuild the docker container!)
 ## TODO: Or maybe better to mount the yaml config?
 
+import columnar
 import meta
+import partitions
 
 ## Global var(s)
 ## TODO: Track state for each source_id?
 is_running = False
 
+def _connections_unavailable(db_conns:dict, response:dict) -> bool:
+    """True if a connection of get_database_connections couldn't be checked out - then all are released and the response is set to 503"""
+    missing = [key for key, db_conn in db_conns.items() if db_conn is None]
+    if len(missing) == 0:
+        return False
+    connection.release_database_connections(db_conns)
+    new_message = "No database connection available for: {} (the pool is exhausted or the database is unreachable), try again later".format(missing)
+    response['content'] += "{}\n".format(new_message)
+    response['status_code'] = 503
+    app.logger.error(new_message)
+    return True
+
 ## TODO: Should be an admin console page, in the future
 @app.route('/')
 def index():
@@ -78,45 +95,35 @@ def flush(source_id:str = None):
     response['content'] = ""
     if source_id:
         app.logger.info("Attempting to remove data associated with source: {}".format(source_id))
-        db_conns = {}
+        ## Pooled connections: the data manager connection and 1 for each scheme
+        db_conns = connection.get_database_connections()
+        if _connections_unavailable(db_conns, response):
+            return response
         try:
-            ## Create the data manager connection and 1 for each scheme
-            db_conns["dm"] = connection.get_database_connection(
-                os.getenv("I2B2DBHOST"),
-                os.getenv("I2B2DBNAME"),
-                os.getenv("DB_ADMIN_USER"),
-                os.getenv("DB_ADMIN_PASS")
-            )
-            db_conns[os.getenv("DS_CRC_DB")] = connection.get_database_connection(
-                os.getenv("I2B2DBHOST"),
-                os.getenv("I2B2DBNAME"),
-                os.getenv("DS_CRC_USER"),
-                os.getenv("DS_CRC_PASS")
-            )
-            db_conns[os.getenv("DS_ONT_DB")] = connection.get_database_connection(
-                os.getenv("I2B2DBHOST"),
-                os.getenv("I2B2DBNAME"),
-                os.getenv("DS_ONT_USER"),
-                os.getenv("DS_ONT_PASS")
-            )
             if meta.clean_sources_in_database(db_conns, [source_id]):
                 for db_conn in db_conns.values():
-                    db_conn.commit()
+                    if db_conn is not None:
+                        db_conn.commit()
+                ## Loaded again, even if the files didn't change
+                meta.clear_source_loaded(source_id)
                 response['status_code'] = 200
                 response['content'] = "Source data removed from database for source_id: '{}'".format(source_id)
             else:
                 app.logger.debug("Rollingback database for connections: {}".format(list(db_conns.keys())))
                 for db_conn in db_conns.values():
-                    db_conn.rollback()
+                    if db_conn is not None:
+                        db_conn.rollback()
                 response['status_code'] = 500
                 response['content'] = "Unable to clean source data in database for source_id: '{}'".format(source_id)
-        except:
+        except Exception as e:
             for db_conn in db_conns.values():
-                db_conn.rollback()
-            app.logger.error("Error flushing data for source_id: '{}'\n{}".format(source_id, Exception))
+                if db_conn is not None:
+                    db_conn.rollback()
+            response['status_code'] = 500
+            response['content'] = "Error flushing data for source_id: '{}'".format(source_id)
+            app.logger.error("Error flushing data for source_id: '{}'\n{}".format(source_id, e))
         finally:
-            for db_conn in db_conns.values():
-                db_conn.close()
+            connection.release_database_connections(db_conns)
     else:
         response['status_code'] = 400
         response['content'] = "source_id not provided: '{}'".format(source_id)
@@ -137,9 +144,12 @@ def fetch(fuseki_endpoint:str = None, source_id:str = None):
         fuseki_endpoint = request.args.get('fuseki_endpoint')
     if source_id is None:
         source_id = request.args.get('source_id')
+    fetch_mode = request.args.get('fetch_mode')
+    ## "refresh" to re-query fuseki and update the response cache, "bypass" to ignore the cache
+    cache_mode = request.args.get('cache')
     ## TODO: if source_id is STILL None, try to use the requesting IP to match a source (So that CoMetaR instances don't have to know their source_id)
 
-    app.logger.info("Supplied vars...\nfuseki_endpoint: {}\nsource_id: {}".format(fuseki_endpoint, source_id))
+    app.logger.info("Supplied vars...\nfuseki_endpoint: {}\nsource_id: {}\nfetch_mode: {}\ncache: {}".format(fuseki_endpoint, source_id, fetch_mode, cache_mode))
 
     ## Steps:
     # Check filesystem (directories exist etc?)
@@ -153,6 +163,8 @@ def fetch(fuseki_endpoint:str = None, source_id:str = None):
     if source_type == "fuseki":
         fuseki_endpoint = app.config["fuseki_sources"][source_id]
         app.logger.debug("Set endpoint based on recognised source ({}): {}".format(source_id, fuseki_endpoint))
+    elif source_type == "rdf_dump":
+        app.logger.debug("Using RDF dump for recognised source ({}): {}".format(source_id, app.config["rdf_dump_sources"][source_id]))
     elif source_type == "local_files":
         response["content"] = "source_id '{}' is a local file based source, so there is nothing to fetch, CSV already exists".format(source_id)
         response['status_code'] = 200
@@ -171,28 +183,64 @@ def fetch(fuseki_endpoint:str = None, source_id:str = None):
     #     fuseki_endpoint = "http://dwh.proxy/fuseki/cometar_live/query"
     #     source_id = "test"
 
-    result = meta.pull_fuseki_datatree(fuseki_endpoint, source_id)
+    fetch_stats = {}
+    if source_type == "rdf_dump":
+        result = meta.pull_rdf_dump_datatree(app.config["rdf_dump_sources"][source_id], source_id)
+    else:
+        result = meta.pull_fuseki_datatree(fuseki_endpoint, source_id, fetch_mode, cache_mode, fetch_stats)
     if result:
-        response['content'] += "{} - {}\n".format("Data retrieved from fuseki", fuseki_endpoint)
+        if source_type == "rdf_dump":
+            response['content'] += "{} - {}\n".format("Data read from RDF dump", app.config["rdf_dump_sources"][source_id])
+        else:
+            response['content'] += "{} - {}\n".format("Data retrieved from fuseki", fuseki_endpoint)
+        if "duplicates_avoided" in fetch_stats:
+            response['content'] += "Unique nodes fetched: {}, tree nodes built: {}, duplicate fetches avoided: {}\n".format(fetch_stats["fetched"], fetch_stats["tree_nodes"], fetch_stats["duplicates_avoided"])
+        if "reused" in fetch_stats:
+            response['content'] += "Nodes reused from previous fetch: {}, refetched: {}\n".format(fetch_stats["reused"], fetch_stats["refetched"])
         response['status_code'] = 200
     else:
-        response['content'] += "{}\n".format("Error in retrieving or processing fuseki data!")
+        response['content'] += "{}\n".format("Error in retrieving or processing {} data!".format(source_type))
         response['status_code'] = 500
         return response
 
     ## Write objects to flat structured CSV files - 1 per table
         ## Filename includes source_id
-    all_trees = []
-    for tree in result[source_id]:
-        all_trees.append(tree.whole_tree_csv())
-    app.logger.debug("All trees for source '{}': {}".format(source_id, len(all_trees)))
-    combined_tree = meta.combine_csv_trees(all_trees)
-    if meta.write_csv(combined_tree, source_id, source_dir):
-        response['content'] += "{}\n".format("CSV written")
-        response['status_code'] = 200
-    else:
-        response['content'] += "{}\n".format("CSV writing FAILED!")
+    intermediate_format = columnar.intermediate_format()
+    file_stats = {}
+    written = True
+    if intermediate_format != "csv":
+        ## Typed columnar files, the loader prefers them over csv files of the same table
+        write_stats = {}
+        written = columnar.write_tables((lines for lines, _seconds in meta.csv_trees_parallel(result[source_id])), source_id, source_dir, intermediate_format, write_stats = write_stats, file_stats = file_stats)
+        for table, table_stats in write_stats.items():
+            response['content'] += "{}: {} rows ({} rows/s)\n".format(table, table_stats["rows"], table_stats["rows_per_second"])
+        response['content'] += "{}\n".format("{} written".format(intermediate_format) if written else "{} writing FAILED!".format(intermediate_format))
+    if not written:
         response['status_code'] = 500
+    elif intermediate_format == "csv" or app.config.get("write_csv_export", False):
+        ## Also written with columnar files, as an export for other tools
+        if app.config.get("csv_write_mode", "stream") == "stream":
+            write_stats = {}
+            written = meta.write_csv_stream(result[source_id], source_id, source_dir, write_stats = write_stats, file_stats = file_stats)
+            for table, table_stats in write_stats.items():
+                response['content'] += "{}: {} rows ({} rows/s)\n".format(table, table_stats["rows"], table_stats["rows_per_second"])
+        else:
+            all_trees = []
+            for lines, _seconds in meta.csv_trees_parallel(result[source_id]):
+                all_trees.append(lines)
+            app.logger.debug("All trees for source '{}': {}".format(source_id, len(all_trees)))
+            combined_tree = meta.combine_csv_trees(all_trees)
+            written = meta.write_csv(combined_tree, source_id, source_dir, file_stats = file_stats)
+        if written:
+            response['content'] += "{}\n".format("CSV written")
+            response['status_code'] = 200
+        else:
+            response['content'] += "{}\n".format("CSV writing FAILED!")
+            response['status_code'] = 500
+    for filename, written_stats in file_stats.items():
+        response['content'] += "{}: {} bytes in {:.3f}s\n".format(filename, written_stats["bytes"], written_stats["seconds"])
+    response['content'] += "Total bytes written: {}\n".format(sum(written_stats["bytes"] for written_stats in file_stats.values()))
+    meta.invalidate_source(source_id)
     logger.debug("Fetching complete, response: {}".format(response))
     return response
 
@@ -203,6 +251,7 @@ def load_data(source_id:list = None):
     
     These include data which are serialised by the "fetch" route and locally maintained files for custom metadata
     Temporary files are named on the convention <db_prepared_directory>/<db_prepared_prefix>.<source_id>.<schema_name>.<table_name>.csv
+    With ?replace=true the previous rows of the source are replaced in one short transaction at the end (no flush needed beforehand)
     """
     app.logger.info("Running update route to update i2b2 with pre-fetched metadata...")
     ## TODO: Check serialised data exists - else skip
@@ -232,6 +281,8 @@ def load_data(source_id:list = None):
         fuseki_endpoint = app.config["fuseki_sources"][source_id]
         response['content'] = "Set endpoint based on recognised source ({}): {}".format(source_id, fuseki_endpoint)
         # app.logger.info(response['content'])
+    elif source_type == "rdf_dump":
+        response["content"] = "source_id '{}' is an RDF dump based source: {}".format(source_id, app.config["rdf_dump_sources"][source_id])
     elif source_type == "local_files":
         response["content"] = "source_id '{}' is a local file based source.".format(source_id)
         # app.logger.info(response["content"])
@@ -252,43 +303,59 @@ def load_data(source_id:list = None):
         response["content"] += "\n{}".format(new_message)
         app.logger.warn(new_message)
         return response
-    db_conns = {}
-    ## Create the data manager connection and 1 for each scheme
-    db_conns["dm"] = connection.get_database_connection(
-        os.getenv("I2B2DBHOST"),
-        os.getenv("I2B2DBNAME"),
-        os.getenv("DB_ADMIN_USER"),
-        os.getenv("DB_ADMIN_PASS")
-    )
-    db_conns[os.getenv("DS_CRC_DB")] = connection.get_database_connection(
-        os.getenv("I2B2DBHOST"),
-        os.getenv("I2B2DBNAME"),
-        os.getenv("DS_CRC_USER"),
-        os.getenv("DS_CRC_PASS")
-    )
-    db_conns[os.getenv("DS_ONT_DB")] = connection.get_database_connection(
-        os.getenv("I2B2DBHOST"),
-        os.getenv("I2B2DBNAME"),
-        os.getenv("DS_ONT_USER"),
-        os.getenv("DS_ONT_PASS")
-    )
-    if source_type == "fuseki":
+    source_signature = meta.source_signature(source_id)
+    if not meta.source_changed_since_load(source_id) and request.args.get('force', "false").lower() != "true":
+        new_message = "Files of source_id '{}' have not changed since they were loaded (last update: {}), skipping. Use ?force=true to load them anyway".format(source_id, source_update)
+        response["content"] += "\n{}".format(new_message)
+        app.logger.info(new_message)
+        response['status_code'] = 200
+        return response
+    if source_type in ["fuseki", "rdf_dump"]:
         delim = ","
     else:
         delim = ";"
-    # if meta.push_csv_to_database(db_conn, prepared_file_paths):
-    if meta.push_csv_to_database(db_conns, source_id, source_file_paths, delim):
-        for db_conn in db_conns.values():
-            db_conn.commit()
-        new_message = "Pushing CSV metadata to database has succeeded!"
+    csv_file_paths, columnar_file_paths = meta.split_columnar_paths(source_id, source_file_paths)
+    if len(columnar_file_paths) > 0 and not columnar.available():
+        app.logger.warn("Columnar files can't be read without pyarrow, loading csv only: {}".format(columnar_file_paths))
+        columnar_file_paths = []
+    ## With replace, the rows are loaded into shadow tables and swapped in at the end (instead of flushing first) - i2b2 keeps the previous rows until the commit
+    shadow_tables = {} if request.args.get('replace', "false").lower() == "true" else None
+    ddl_summary = {"applied": [], "skipped": []}
+    ## Pooled connections: the data manager connection and 1 for each scheme
+    db_conns = connection.get_database_connections()
+    if _connections_unavailable(db_conns, response):
+        return response
+    try:
+        ## The col limit DDL is committed on its own, before any rows are loaded (so the load and swap stay one transaction)
+        if len(csv_file_paths) > 0 or len(columnar_file_paths) > 0:
+            meta.update_configured_col_limits(db_conns, ddl_summary)
+        # if meta.push_csv_to_database(db_conn, prepared_file_paths):
+        if (meta.push_csv_to_database(db_conns, source_id, csv_file_paths, delim, shadow_tables) is not False
+                and meta.push_columnar_to_database(db_conns, source_id, columnar_file_paths, shadow_tables) is not False
+                and (shadow_tables is None or meta.swap_shadow_tables(db_conns, source_id, shadow_tables))):
+            for db_conn in db_conns.values():
+                if db_conn is not None:
+                    db_conn.commit()
+            meta.mark_source_loaded(source_id, source_signature)
+            new_message = "Pushing CSV metadata to database has succeeded!"
+            if shadow_tables is not None:
+                new_message += " Replaced the previous metadata of '{}'".format(source_id)
+            response['content'] += "\n{}".format(new_message)
+            app.logger.info(new_message)
+            response['status_code'] = 200
+        else:
+            for db_conn in db_conns.values():
+                if db_conn is not None:
+                    db_conn.rollback()
+            app.logger.error("Pushing data to database failed!")
+            response['content'] += "{}\n".format("Pushing CSV metadata to database failed!")
+            response['status_code'] = 500
+            return response
+    finally:
+        connection.release_database_connections(db_conns)
+        new_message = "Column DDL applied: {} - skipped, as the type already matches: {}".format(ddl_summary["applied"], ddl_summary["skipped"])
         response['content'] += "\n{}".format(new_message)
         app.logger.info(new_message)
-        response['status_code'] = 200
-    else:
-        app.logger.error("Pushing data to database failed!")
-        response['content'] += "{}\n".format("Pushing CSV metadata to database failed!")
-        response['status_code'] = 500
-        return response
 
     app.logger.info("API endpoint processing complete!")
     app.logger.debug(response)
@@ -302,34 +369,59 @@ def update_patient_counts():
     response = {}
     response['status_code'] = 500
     response['content'] = ""
-    db_conns = {}
-    ## Create the data manager connection and 1 for each scheme
-    db_conns["dm"] = connection.get_database_connection(
-        os.getenv("I2B2DBHOST"),
-        os.getenv("I2B2DBNAME"),
-        os.getenv("DB_ADMIN_USER"),
-        os.getenv("DB_ADMIN_PASS")
-    )
-    db_conns[os.getenv("DS_CRC_DB")] = connection.get_database_connection(
-        os.getenv("I2B2DBHOST"),
-        os.getenv("I2B2DBNAME"),
-        os.getenv("DS_CRC_USER"),
-        os.getenv("DS_CRC_PASS")
-    )
-    db_conns[os.getenv("DS_ONT_DB")] = connection.get_database_connection(
-        os.getenv("I2B2DBHOST"),
-        os.getenv("I2B2DBNAME"),
-        os.getenv("DS_ONT_USER"),
-        os.getenv("DS_ONT_PASS")
-    )
-    if meta.update_patient_count(db_conns=db_conns):
-        response['content'] += "{}\n".format("Database updated with patient counts!")
+    ## Pooled connections: the data manager connection and 1 for each scheme
+    db_conns = connection.get_database_connections()
+    if _connections_unavailable(db_conns, response):
+        return response
+    try:
+        if meta.update_patient_count(db_conns=db_conns):
+            response['content'] += "{}\n".format("Database updated with patient counts!")
+            response['status_code'] = 200
+            app.logger.info("Processing successfully completed!")
+        else:
+            response['content'] += "{}\n".format("Database update of patient counts FAILED!")
+            response['status_code'] = 500
+            app.logger.warn("Processing failed!")
+    finally:
+        connection.release_database_connections(db_conns)
+
+    app.logger.info(response)
+    return response
+
+@app.route('/partition-tables')
+def partition_tables():
+    """Convert i2b2's ontology and dimension tables to one partition per source (see partitions) - enable them with config "db_partition_by_source" """
+    app.logger.info("Running route to partition the tables by source...")
+
+    response = {}
+    response['status_code'] = 500
+    response['content'] = ""
+    ## Pooled connections: the data manager connection and 1 for each scheme
+    db_conns = connection.get_database_connections()
+    if _connections_unavailable(db_conns, response):
+        return response
+    try:
+        results = partitions.migrate(db_conns)
+        meta.invalidate_schema_catalog()
+        for db_conn in db_conns.values():
+            if db_conn is not None:
+                db_conn.commit()
+        response['content'] += "{}\n".format("Tables partitioned by source: {}".format(results))
         response['status_code'] = 200
         app.logger.info("Processing successfully completed!")
-    else:
-        response['content'] += "{}\n".format("Database update of patient counts FAILED!")
-        response['status_code'] = 500
-        app.logger.warn("Processing failed!")
+    except Exception as e:
+        for db_conn in db_conns.values():
+            if db_conn is not None:
+                db_conn.rollback()
+        response['content'] += "{}\n".format("Partitioning the tables FAILED!")
+        app.logger.error("Failed to partition the tables...\n{}".format(e))
+    finally:
+        connection.release_database_connections(db_conns)
 
     app.logger.info(response)
     return response
+
+@app.route('/database-pool-stats')
+def database_pool_stats():
+    """Statistics of the pooled database connections of each role (size, idle, in use, created, reused, waits...)"""
+    return connection.database_pool_stats()
@@ -7,27 +7,96 @@ from flask import current_app as app
 import logging
 logger = logging.getLogger(__name__)
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
 import datetime
+import json
+import multiprocessing
+from queries import cache
 from queries import connection
 from datetime import date, datetime as dt
 from queries import queries
 import model
 import os
+import partitions
 import psycopg2
 import psycopg2.sql
+import shutil
 import time
 from typing import Tuple
 
+## Registry of the sources {source_id: {"type", "dir", "file_paths", "update", "signature", "checked"}} - see source_info
+_source_registry:dict = {}
+## Signature of the source files at their last successful load {source_id: signature}
+_source_loaded:dict = {}
+## Column types of the database tables {schema: {"loaded", "tables": {table: {col_name: col_type}}}} - see _get_col_limits
+_schema_catalog:dict = {}
+
 ## TODO: Make a "source" class for these functions?
 def source_info(source_id:str) -> Tuple[str, str, list[str], dt]:
-    """Search for the source_id in the possible sources (eg fuseki or local files)"""
-    source_type = _source_type(source_id)
-    source_dir, source_file_paths = _source_location(source_id, source_type)
-    source_update = _source_update(source_file_paths)
-    logger.debug("Source info for id '{}': {},{},{},{}".format(source_id, source_type, source_dir, source_file_paths, source_update))
-    time.sleep(1.6)
-    return source_type, source_dir, source_file_paths, source_update
+    """Search for the source_id in the possible sources (eg fuseki or local files)
+
+    Answered from the source registry. An entry is checked against the file system (a stat of the directories and files) at most
+    every "source_registry_check_seconds" (default: every call) and is rebuilt when anything changed
+    """
+    entry = _source_registry.get(source_id)
+    now = time.monotonic()
+    if entry is not None and now - entry["checked"] < app.config.get("source_registry_check_seconds", 0):
+        return entry["type"], entry["dir"], entry["file_paths"], entry["update"]
+    if entry is None or _source_signature(source_id, entry["type"], entry["dir"], entry["file_paths"]) != entry["signature"]:
+        source_type = _source_type(source_id)
+        source_dir, source_file_paths = _source_location(source_id, source_type)
+        entry = {
+            "type": source_type,
+            "dir": source_dir,
+            "file_paths": source_file_paths,
+            "update": _source_update(source_file_paths),
+            "signature": _source_signature(source_id, source_type, source_dir, source_file_paths),
+        }
+        _source_registry[source_id] = entry
+        logger.debug("Source info for id '{}': {},{},{},{}".format(source_id, source_type, source_dir, source_file_paths, entry["update"]))
+    entry["checked"] = now
+    return entry["type"], entry["dir"], entry["file_paths"], entry["update"]
+
+def _source_signature(source_id:str, source_type:str, source_dir:str, source_file_paths:list[str]) -> tuple:
+    """What the source info depends on - the configured sources and the mtimes of the source directories and files
+
+    Adding, removing or renaming a file changes the mtime of its directory (the files are written by renaming, see output_files)
+    """
+    signature = [
+        source_type,
+        source_id in app.config["fuseki_sources"].keys(),
+        source_id in (app.config.get("rdf_dump_sources") or {}).keys(),
+    ]
+    for directory in [app.config["local_file_sources"], source_dir]:
+        signature.append(os.stat(directory).st_mtime_ns if directory and os.path.isdir(directory) else None)
+    for file_path in source_file_paths or []:
+        signature.append(os.stat(file_path).st_mtime_ns if os.path.isfile(file_path) else None)
+    return tuple(signature)
+
+def invalidate_source(source_id:str) -> None:
+    """Drop the registry entry of the source (eg after writing its files), so the next source_info looks it up again"""
+    _source_registry.pop(source_id, None)
+
+def source_signature(source_id:str) -> tuple:
+    """The current signature of the source (see _source_signature) - take it before loading, for mark_source_loaded"""
+    source_info(source_id)
+    return _source_registry[source_id]["signature"]
+
+def source_changed_since_load(source_id:str) -> bool:
+    """True unless the source files are the same as at the last successful load (see mark_source_loaded)"""
+    return _source_loaded.get(source_id) != source_signature(source_id)
+
+def mark_source_loaded(source_id:str, signature:tuple) -> None:
+    """Remember the source files which were loaded successfully, so unchanged files can be skipped
+
+    :param signature: From source_signature, taken before loading (the files can change during the load)
+    """
+    _source_loaded[source_id] = signature
+
+def clear_source_loaded(source_id:str) -> None:
+    """Forget the last load of the source (eg when it was flushed from the database), so it is loaded again"""
+    _source_loaded.pop(source_id, None)
 
 def _source_type(source_id:str) -> str:
     """Search for the source_id in the possible sources (eg fuseki or local files)"""
@@ -38,13 +107,15 @@ def _source_type(source_id:str) -> str:
     logger.debug("Local sources available from '{}': {}".format(app.config["local_file_sources"], local_sources))
     if source_id in app.config["fuseki_sources"].keys():
         source_type = "fuseki"
+    elif source_id in (app.config.get("rdf_dump_sources") or {}).keys():
+        source_type = "rdf_dump"
     elif source_id in local_sources:
         source_type = "local_files"
     return source_type
 
 def _source_location(source_id:str, source_type:str) -> Tuple[str, list[str]]:
     """Check if the source has local files and return directory and each file path"""
-    dynamic_sources = ["fuseki"] ## TODO: Get from config
+    dynamic_sources = ["fuseki", "rdf_dump"] ## TODO: Get from config
     source_dir = None
     source_file_paths = None
     if source_type in dynamic_sources:
@@ -59,44 +130,256 @@ def _source_location(source_id:str, source_type:str) -> Tuple[str, list[str]]:
         if os.path.isdir(test_dir):
             source_dir = test_dir
         if source_dir and os.path.isdir(source_dir):
-            source_file_paths = [os.path.join(source_dir, f) for f in os.listdir(source_dir) if os.path.isfile(os.path.join(source_dir, f)) and f.endswith(".csv")]
+            source_file_paths = [os.path.join(source_dir, f) for f in os.listdir(source_dir) if os.path.isfile(os.path.join(source_dir, f)) and f.endswith((".csv", ".csv.gz", ".csv.zst"))]
     return source_dir, source_file_paths
 
 def _source_update(source_file_paths:list[str]) -> dt:
     """When was the most recent change to the source files"""
     last_update = None
-    ## TODO: If source_file_paths not None, stat each file and find most recent date
+    for file_path in source_file_paths or []:
+        if os.path.isfile(file_path):
+            file_update = dt.fromtimestamp(os.path.getmtime(file_path))
+            if last_update is None or file_update > last_update:
+                last_update = file_update
     return last_update
 
-def pull_fuseki_datatree(fuseki_endpoint:str, source_id:str) -> dict:
-    """Pull the full tree, build objects and serialise data"""
-    logger.debug("fetching all fuseki data for endpoint (managed by queries module, using config)")
+def pull_fuseki_datatree(fuseki_endpoint:str, source_id:str, fetch_mode:str = None, cache_mode:str = None, fetch_stats:dict = None) -> dict:
+    """Pull the full tree, build objects and serialise data
+    
+    :param fetch_mode: "recursive" (queries for each node), "bulk" (paged queries for the whole ontology), "concurrent" (queries for each node, run in parallel by a pool of workers)
+        or "incremental" (as concurrent, but only re-query nodes which are new or changed since the last fetch, see fetch_concurrent). Defaults to config "fuseki_fetch_mode"
+    :param cache_mode: How to use the sparql response cache (when configured): None to use it, "refresh" to re-query and update it or "bypass" to ignore it
+    :param fetch_stats: Optional dict, filled with counts about the fetch (eg "reused" and "refetched" nodes for the incremental mode)
+    """
+    if fetch_mode is None:
+        fetch_mode = app.config.get("fuseki_fetch_mode", "recursive")
+    if fetch_mode not in ["recursive", "bulk", "concurrent", "incremental"]:
+        logger.warn("Unknown fetch_mode '{}', using 'recursive'".format(fetch_mode))
+        fetch_mode = "recursive"
+    if fetch_stats is None:
+        fetch_stats = {}
+    from model import MetaNode
+    MetaNode.MetaNode.new_run()
+    logger.debug("fetching all fuseki data for endpoint (managed by queries module, using config) with fetch_mode: {}".format(fetch_mode))
     ## Save the fuseki tree data - could have multiple sources - TODO: naming scheme needs more thought
     metadata_trees:dict = {}
     metadata_trees[source_id] = []
-    conn = connection.get_fuseki_connection(fuseki_endpoint, "requests", source_id = source_id)
+    workers = None
+    if fetch_mode in ["concurrent", "incremental"]:
+        workers = app.config.get("fuseki_fetch_workers", 8)
+    conn = connection.get_fuseki_connection(fuseki_endpoint, "requests", source_id = source_id, pool_size = workers)
+    if cache_mode != "bypass":
+        conn["cache"] = cache.get_response_cache()
+        conn["cache_mode"] = cache_mode
     top_elements:dict = queries.top_elements(conn)
+    if fetch_mode in ["bulk", "concurrent", "incremental"]:
+        if fetch_mode == "bulk":
+            all_children:dict = queries.getAllChildren(conn)
+            all_attributes:dict = queries.getAllAttributes(conn)
+        elif fetch_mode == "concurrent":
+            all_children, all_attributes, _fingerprints = fetch_concurrent(conn, list(top_elements.keys()), workers, fetch_stats = fetch_stats)
+        else:
+            previous_nodes = _load_fetch_state(source_id)
+            all_children, all_attributes, fingerprints = fetch_concurrent(conn, list(top_elements.keys()), workers, previous_nodes = previous_nodes, fetch_stats = fetch_stats)
+            _save_fetch_state(source_id, all_children, all_attributes, fingerprints)
+        ## Trees are assembled afterwards in query result order, so child order doesn't depend on which worker finished first
+        for node_uri, node_type in top_elements.items():
+            metadata_trees[source_id].append(build_tree(conn, node_uri, node_type, all_children, all_attributes))
+    else:
+        ## Shared by all trees of the run, so a node reachable through several parents is only queried once
+        registry = new_node_registry()
+        for node_uri, node_type in top_elements.items():
+            metadata_trees[source_id].append(get_tree(conn, node_uri, node_type, registry = registry))
+        fetch_stats["fetched"] = len(registry["attributes"])
+        fetch_stats["tree_nodes"] = registry["tree_nodes"]
+        fetch_stats["duplicates_avoided"] = registry["tree_nodes"] - len(registry["attributes"])
+    logger.info("Fetch stats for '{}': {}".format(source_id, fetch_stats))
+    return metadata_trees
+
+def pull_rdf_dump_datatree(dump_path:str, source_id:str) -> dict:
+    """Build the full tree from a local RDF export (Turtle or N-Triples) - the same trees as from fuseki, without any queries"""
+    from queries import rdf_dump
+    from model import MetaNode
+    MetaNode.MetaNode.new_run()
+    logger.debug("building all trees from RDF dump: {}".format(dump_path))
+    metadata_trees:dict = {}
+    metadata_trees[source_id] = []
+    top_elements, all_children, all_attributes = rdf_dump.read_dump(dump_path)
+    ## build_tree only needs the source_id from the connection (all attributes are available)
+    conn = {"source_id": source_id}
     for node_uri, node_type in top_elements.items():
-        metadata_trees[source_id].append(get_tree(conn, node_uri, node_type))
+        metadata_trees[source_id].append(build_tree(conn, node_uri, node_type, all_children, all_attributes))
     return metadata_trees
 
-def get_tree(conn, node_uri:str, node_type:str, parent_node:object = None):
-    """Get all children under a single node"""
+def new_node_registry() -> dict:
+    """Per-run registry of fetched nodes, keyed by URI
+    
+    - "attributes": {node_uri: element}
+    - "children": {node_uri: {child_uri: child_type}}
+    - "tree_nodes": Number of nodes built, one per path to a URI (so at least the number of URIs)
+    """
+    return {"attributes": {}, "children": {}, "tree_nodes": 0}
+
+def get_tree(conn, node_uri:str, node_type:str, parent_node:object = None, registry:dict = None):
+    """Get all children under a single node
+    
+    A concept can be a member of several collections (or narrower than several concepts), so it is reached through several paths.
+    Each path still gets its own nodes (i2b2 needs a row per path), but the attributes and children of a URI are only queried
+    the first time and then taken from the registry - this also covers the whole subtree below a shared node
+    :param registry: Nodes already fetched in this run (see new_node_registry), a new one is used when not supplied
+    """
     from queries import queries
+    if registry is None:
+        registry = new_node_registry()
+    node_uri = node_uri.strip("<>")
+    registry["tree_nodes"] += 1
+    if node_uri not in registry["attributes"]:
+        registry["attributes"][node_uri] = queries.getAttributes(conn, node_uri)
+        registry["children"][node_uri] = queries.getChildren(conn, node_uri)
+    else:
+        logger.debug("Reusing fetched data for '{}' (reached through another parent)".format(node_uri))
+    new_parent = _element(conn, node_uri, node_type, parent_node = parent_node, element = registry["attributes"][node_uri])
+    for child_uri, child_type in registry["children"][node_uri].items():
+        get_tree(conn, child_uri, child_type, new_parent, registry)
+    return new_parent
+
+def fetch_concurrent(conn, top_uris:list, workers:int, batch_size:int = None, previous_nodes:dict = None, fetch_stats:dict = None) -> Tuple[dict, dict, dict]:
+    """Fetch children and attributes of every node under the top elements, with a pool of workers sharing the connection
+    
+    The frontier holds the pending URIs of one tree level, all are fetched in parallel before moving to the next level.
+    So the run takes (roughly) one round trip per level of the tree, rather than per node. Each URI is only fetched once
+    :param batch_size: Nodes per attribute query, defaults to config "fuseki_attribute_batch_size"
+    :param previous_nodes: State of a previous fetch ({node_uri: {"fingerprint", "element", "children"}}). When supplied, fingerprints are fetched
+        and nodes whose fingerprint matches keep their attributes and children. For new and changed nodes the attributes are queried, and the
+        edges of the whole ontology are fetched once (getAllChildren) instead of the children of each node. Those edges then replace the kept children
+        too, as a changed child type isn't a statement of the parent (a node which only gets its type, under an unchanged parent, is found with the next change)
+    :param fetch_stats: Optional dict, updated with the number of "fetched" nodes (and "reused"/"refetched" nodes when using previous_nodes)
+    :return: all_children {parent_uri: {child_uri: child_type}} and all_attributes {node_uri: element} - as used by build_tree.
+        Also fingerprints {node_uri: fingerprint} (empty without previous_nodes)
+    """
+    if batch_size is None:
+        batch_size = app.config.get("fuseki_attribute_batch_size", 100)
+    if fetch_stats is None:
+        fetch_stats = {}
+    all_children:dict = {}
+    all_attributes:dict = {}
+    fingerprints:dict = {}
+    ## Edges of the whole ontology, once a node is new or changed (incremental only)
+    edges:dict = None
+    reused = 0
+    frontier:list = list(dict.fromkeys(uri.strip("<>") for uri in top_uris))
+    seen:set = set(frontier)
+    ## Worker threads need their own app context for the config (used by queries)
+    real_app = app._get_current_object()
+    with ThreadPoolExecutor(max_workers = workers, initializer = lambda: real_app.app_context().push()) as executor:
+        level = 0
+        while len(frontier) > 0:
+            logger.info("Fetching {} nodes at tree level {} with {} workers".format(len(frontier), level, workers))
+            attribute_uris = frontier
+            children_uris = frontier
+            relinked_uris = []
+            if previous_nodes is not None:
+                fingerprint_futures = [executor.submit(queries.getFingerprints, conn, frontier[start : start + batch_size], batch_size) for start in range(0, len(frontier), batch_size)]
+                for fingerprint_future in fingerprint_futures:
+                    fingerprints.update(fingerprint_future.result())
+                attribute_uris = []
+                for node_uri in frontier:
+                    previous_node = previous_nodes.get(node_uri)
+                    if previous_node is not None and fingerprints.get(node_uri) is not None and previous_node.get("fingerprint") == fingerprints[node_uri]:
+                        all_attributes[node_uri] = previous_node["element"]
+                        reused += 1
+                    else:
+                        attribute_uris.append(node_uri)
+                children_uris = []
+                ## Never read from the response cache - a cached response from before the change would be stored with the new fingerprint
+                if len(attribute_uris) > 0 and edges is None:
+                    edges = queries.getAllChildren(conn, use_cache = False)
+                    relinked_uris = list(all_children.keys())
+                    for node_uri in relinked_uris:
+                        all_children[node_uri] = edges.get(node_uri, {})
+            children_futures = {node_uri: executor.submit(queries.getChildren, conn, node_uri) for node_uri in children_uris}
+            ## Attributes are queried for batches of nodes (VALUES block), each batch is a task. New and changed nodes are never read from the cache (see above)
+            attribute_futures = [executor.submit(queries.getAttributesBatch, conn, attribute_uris[start : start + batch_size], batch_size, previous_nodes is None) for start in range(0, len(attribute_uris), batch_size)]
+            for attribute_future in attribute_futures:
+                all_attributes.update(attribute_future.result())
+            for node_uri in frontier:
+                if node_uri in children_futures:
+                    all_children[node_uri] = children_futures[node_uri].result()
+                elif edges is not None:
+                    all_children[node_uri] = edges.get(node_uri, {})
+                else:
+                    all_children[node_uri] = previous_nodes[node_uri]["children"]
+            next_frontier = []
+            ## Nodes whose kept children were replaced by the edges can have new children too
+            for node_uri in relinked_uris + frontier:
+                for child_uri in all_children[node_uri].keys():
+                    if child_uri not in seen:
+                        seen.add(child_uri)
+                        next_frontier.append(child_uri)
+            frontier = next_frontier
+            level += 1
+    fetch_stats["fetched"] = len(all_attributes)
+    if previous_nodes is not None:
+        fetch_stats["reused"] = reused
+        fetch_stats["refetched"] = len(all_attributes) - reused
+        fetch_stats["children"] = "kept" if edges is None else "all edges fetched"
+    logger.info("Fetched {} nodes in {} levels ({})".format(len(all_attributes), level, fetch_stats))
+    return all_children, all_attributes, fingerprints
+
+def _fetch_state_path(source_id:str) -> str:
+    """File for the per-node state of the last incremental fetch (hidden, so it isn't picked up as source data)"""
+    return os.path.join(app.config["dynamic_metadata_directory"], source_id, ".fetch_state.json")
+
+def _load_fetch_state(source_id:str) -> dict:
+    """Per-node state of the last incremental fetch, empty if there is none (or it can't be read)"""
+    state_path = _fetch_state_path(source_id)
+    if not os.path.isfile(state_path):
+        logger.info("No previous fetch state for '{}', fetching all nodes".format(source_id))
+        return {}
+    try:
+        with open(state_path, "r") as f:
+            return json.load(f)["nodes"]
+    except Exception as e:
+        logger.warn("Could not read previous fetch state '{}', fetching all nodes: {}".format(state_path, e))
+        return {}
+
+def _save_fetch_state(source_id:str, all_children:dict, all_attributes:dict, fingerprints:dict) -> None:
+    """Write the per-node state (fingerprint, attributes and children) for the next incremental fetch"""
+    state_path = _fetch_state_path(source_id)
+    nodes = {node_uri: {"fingerprint": fingerprints.get(node_uri), "element": element, "children": all_children.get(node_uri, {})} for node_uri, element in all_attributes.items()}
+    try:
+        if not os.path.isdir(os.path.dirname(state_path)):
+            os.makedirs(os.path.dirname(state_path))
+        with open(state_path + ".tmp", "w") as f:
+            json.dump({"nodes": nodes}, f)
+        os.replace(state_path + ".tmp", state_path)
+        logger.debug("Saved fetch state for {} nodes: {}".format(len(nodes), state_path))
+    except Exception as e:
+        logger.warn("Could not save fetch state '{}': {}".format(state_path, e))
+
+def build_tree(conn, node_uri:str, node_type:str, all_children:dict, all_attributes:dict, parent_node:object = None):
+    """Assemble all children under a single node from pre-fetched data (no queries, unless a node's attributes are missing)
+    
+    :param all_children: {parent_uri: {child_uri: child_type}}
+    :param all_attributes: {node_uri: element}
+    """
     node_uri = node_uri.strip("<>")
-    new_parent = _element(conn, node_uri, node_type, parent_node = parent_node, )
-    children = queries.getChildren(conn, node_uri)
-    for node_uri, node_type in children.items():
-        get_tree(conn, node_uri, node_type, new_parent)
+    new_parent = _element(conn, node_uri, node_type, parent_node = parent_node, element = all_attributes.get(node_uri))
+    for child_uri, child_type in all_children.get(node_uri, {}).items():
+        build_tree(conn, child_uri, child_type, all_children, all_attributes, new_parent)
     return new_parent
 
-def _element(conn, node_uri:str, node_type:str = "concept", parent_node:object = None) -> object:
-    """Get a single node - with all its details"""
+def _element(conn, node_uri:str, node_type:str = "concept", parent_node:object = None, element:dict = None) -> object:
+    """Get a single node - with all its details
+    
+    :param element: Pre-fetched attributes of the node, they are queried when not supplied
+    """
     logger.info("Fetching the node data for '{}'".format(node_uri))
     from queries import queries
 
     node_uri = node_uri.strip("<>")
-    element:dict = queries.getAttributes(conn, node_uri)
+    if element is None:
+        element = queries.getAttributes(conn, node_uri)
     logger.debug("Node data: {}".format(element))
 
     logger.debug("element[\"notations\"]: {}".format(element["notations"]))
@@ -134,29 +417,216 @@ def combine_csv_trees(trees:list) -> dict:
                     combined_tree[schema][table].extend(data)
     return combined_tree
 
-def write_csv(csv_tree:dict, sourcesystem_id:str, out_dir:str, output_delim:str = ","):
-    """Take a dict which has a list of lists for each table - write each dict entry as a csv file"""
+def write_csv(csv_tree:dict, sourcesystem_id:str, out_dir:str, output_delim:str = ",", file_stats:dict = None):
+    """Take a dict which has a list of lists for each table - write each dict entry as a csv file
+
+    The tables are written concurrently, each to a temporary file which is renamed when complete (see output_files)
+    :param file_stats: Optional dict, filled with {<filename>: {"bytes", "seconds"}}
+    """
+    import output_files
     logger.debug("Writing csv_tree to files under '{}': (length {})".format(out_dir, len(csv_tree)))
+    compression = output_files.output_compression()
+    outputs = []
+    def write_table(output, data_structure):
+        start = time.perf_counter()
+        write = csv.writer(output.file, delimiter = output_delim)
+        write.writerows(data_structure)
+        output.commit()
+        output.seconds += time.perf_counter() - start
     try:
         if not os.path.isdir(out_dir):
             os.makedirs(out_dir)
+        table_data = []
         for schema_name, tables in csv_tree.items():
             for table_name, data_structure in tables.items():
                 filename = os.path.join(out_dir, "{sourcesystem_id}.{schema_name}.{table_name}.csv".format(sourcesystem_id=sourcesystem_id, schema_name=schema_name, table_name=table_name))
                 logger.debug("Writing csv data to file: {}".format(filename))
-                with open(filename, 'w') as f: 
-                    write = csv.writer(f, delimiter = output_delim)
-                    write.writerows(data_structure)
+                outputs.append(output_files.OutputFile(filename, compression = compression))
+                table_data.append(data_structure)
+        if len(outputs) > 0:
+            with ThreadPoolExecutor(max_workers = len(outputs)) as executor:
+                for result in [executor.submit(write_table, output, data_structure) for output, data_structure in zip(outputs, table_data)]:
+                    result.result()
+        if file_stats is not None:
+            for output in outputs:
+                file_stats[os.path.basename(output.path)] = {"bytes": output.bytes, "seconds": output.seconds}
         return True
     except Exception as e:
         logger.error("Failed to write CSV data: {}".format(e))
+        output_files.discard_all(outputs)
         return False
 
-def update_col_limits(db_conns, schema:str, table:str, limits:dict = None) -> bool:
+## The trees being serialised by process pools {run key: trees} - inherited by the forked workers, so the trees don't need to be pickled
+_csv_trees:dict = {}
+
+def _csv_worker_init(real_app) -> None:
+    """Process pool initializer, workers need an app context for the config"""
+    real_app.app_context().push()
+
+def _tree_csv(run_key:int, tree_index:int) -> Tuple[dict, dict]:
+    """Generate the csv rows of one of the trees (in a worker process)
+
+    :return: The rows, like whole_tree_csv ({schema: {table: [rows]}}) and the seconds spent on each table {"<schema>.<table>": seconds}
+    """
+    lines = {"i2b2metadata": {"table_access": [], "i2b2": []}, "i2b2demodata": {"concept_dimension": [], "modifier_dimension": []}}
+    seconds:dict = {}
+    start = time.perf_counter()
+    for schema_name, table_name, row in _csv_trees[run_key][tree_index].iter_csv_rows():
+        lines[schema_name][table_name].append(row)
+        end = time.perf_counter()
+        seconds["{}.{}".format(schema_name, table_name)] = seconds.get("{}.{}".format(schema_name, table_name), 0.0) + end - start
+        start = end
+    return lines, seconds
+
+def _tree_csv_parts(run_key:int, tree_index:int, part_dir:str, output_delim:str) -> Tuple[dict, dict]:
+    """Stream the csv rows of one of the trees into a part file per table (in a worker process), see _tree_part_path
+
+    :return: The number of rows {"<schema>.<table>": rows} and the seconds spent on each table {"<schema>.<table>": seconds}
+    """
+    row_counts:dict = {}
+    seconds:dict = {}
+    part_files:dict = {}
+    writers:dict = {}
+    try:
+        start = time.perf_counter()
+        for schema_name, table_name, row in _csv_trees[run_key][tree_index].iter_csv_rows():
+            table_key = "{}.{}".format(schema_name, table_name)
+            if table_key not in writers:
+                part_files[table_key] = open(_tree_part_path(part_dir, tree_index, table_key), "w", newline = "", encoding = "utf-8")
+                writers[table_key] = csv.writer(part_files[table_key], delimiter = output_delim)
+            writers[table_key].writerow(row)
+            end = time.perf_counter()
+            row_counts[table_key] = row_counts.get(table_key, 0) + 1
+            seconds[table_key] = seconds.get(table_key, 0.0) + end - start
+            start = end
+    finally:
+        for part_file in part_files.values():
+            part_file.close()
+    return row_counts, seconds
+
+def _tree_part_path(part_dir:str, tree_index:int, table_key:str) -> str:
+    """File of a tree's rows of a table, written by _tree_csv_parts"""
+    return os.path.join(part_dir, "{}.{}.csv".format(tree_index, table_key))
+
+def _map_trees(func, trees:list, workers:int, *args):
+    """Generator for func(run_key, tree_index, *args) of each tree (in the same order as the trees), run by a pool of worker processes
+
+    Workers are forked (the trees are shared, not pickled), where forking isn't available - or with 1 worker - func runs in this process.
+    Forking a process with other running threads is unsafe: a lock held by another thread at that moment (logging, connection pools)
+    stays locked in the worker, which can hang. Only use workers > 1 when the listener doesn't serve requests concurrently (eg flask run --without-threads)
+    """
+    run_key = id(trees)
+    _csv_trees[run_key] = trees
+    try:
+        if workers <= 1 or len(trees) <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            for tree_index in range(len(trees)):
+                yield func(run_key, tree_index, *args)
+            return
+        logger.info("Generating csv for {} trees with {} worker processes".format(len(trees), workers))
+        real_app = app._get_current_object()
+        ## The workers are forked when the tasks are submitted, after the trees were registered
+        with ProcessPoolExecutor(max_workers = min(workers, len(trees)), mp_context = multiprocessing.get_context("fork"), initializer = _csv_worker_init, initargs = (real_app,)) as executor:
+            ## map returns the results in order of the trees, whichever finishes first
+            for result in executor.map(func, [run_key] * len(trees), range(len(trees)), *[[arg] * len(trees) for arg in args]):
+                yield result
+    finally:
+        _csv_trees.pop(run_key, None)
+
+def csv_trees_parallel(trees:list, workers:int = None):
+    """Generator for the csv rows of each tree (in the same order as the trees), generated by a pool of worker processes
+
+    Each tree is serialised by one worker, the results are returned in tree order - so merging them gives the same rows as the single process path.
+    All rows of a tree are returned at once (for write_csv_stream, the rows are streamed through part files instead). See _map_trees about forking
+    :param workers: Number of processes, defaults to config "csv_workers" (default 1: no worker processes)
+    :return: Generator of (lines, seconds) for each tree, see _tree_csv
+    """
+    if workers is None:
+        workers = app.config.get("csv_workers", 1)
+    yield from _map_trees(_tree_csv, trees, workers)
+
+def write_csv_stream(trees:list, sourcesystem_id:str, out_dir:str, output_delim:str = ",", write_stats:dict = None, workers:int = None, file_stats:dict = None) -> bool:
+    """Stream the rows of the trees straight into one csv file per table, without collecting them (as whole_tree_csv and combine_csv_trees do)
+
+    The files are the same as from write_csv with the combined trees
+    :param write_stats: Optional dict, filled with {"<schema>.<table>": {"rows", "seconds", "rows_per_second"}}. The seconds include generating the rows
+    :param workers: When more than 1 (defaults to config "csv_workers", default 1), the trees are serialised in parallel by worker processes (see _map_trees).
+        Each worker streams its tree's rows into part files, which are appended to the files in tree order - so memory stays constant
+        (the seconds are summed over the workers)
+    :param file_stats: Optional dict, filled with {<filename>: {"bytes", "seconds"}}. The files are written to temporary files
+        and renamed concurrently when all rows are written (see output_files)
+    """
+    import output_files
+    if workers is None:
+        workers = app.config.get("csv_workers", 1)
+    logger.debug("Streaming csv rows of {} trees to files under '{}'".format(len(trees), out_dir))
+    if write_stats is None:
+        write_stats = {}
+    files:dict = {}
+    compression = output_files.output_compression()
+    try:
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        writers:dict = {}
+        for schema_name, table_names in {"i2b2metadata": ["table_access", "i2b2"], "i2b2demodata": ["concept_dimension", "modifier_dimension"]}.items():
+            for table_name in table_names:
+                filename = os.path.join(out_dir, "{sourcesystem_id}.{schema_name}.{table_name}.csv".format(sourcesystem_id=sourcesystem_id, schema_name=schema_name, table_name=table_name))
+                logger.debug("Streaming csv data to file: {}".format(filename))
+                files[(schema_name, table_name)] = output_files.OutputFile(filename, compression = compression)
+                writers[(schema_name, table_name)] = csv.writer(files[(schema_name, table_name)].file, delimiter = output_delim)
+                write_stats["{}.{}".format(schema_name, table_name)] = {"rows": 0, "seconds": 0.0}
+        if workers > 1 and len(trees) > 1:
+            ## Hidden, so it doesn't match the source file names
+            part_dir = os.path.join(out_dir, ".{}.parts".format(sourcesystem_id))
+            os.makedirs(part_dir, exist_ok = True)
+            try:
+                for tree_index, (row_counts, seconds) in enumerate(_map_trees(_tree_csv_parts, trees, workers, part_dir, output_delim)):
+                    for (schema_name, table_name), output in files.items():
+                        table_key = "{}.{}".format(schema_name, table_name)
+                        if table_key not in row_counts:
+                            continue
+                        start = time.perf_counter()
+                        part_path = _tree_part_path(part_dir, tree_index, table_key)
+                        with open(part_path, "r", newline = "", encoding = "utf-8") as part_file:
+                            shutil.copyfileobj(part_file, output.file, 1048576)
+                        os.remove(part_path)
+                        table_stats = write_stats[table_key]
+                        table_stats["rows"] += row_counts[table_key]
+                        table_stats["seconds"] += time.perf_counter() - start + seconds[table_key]
+            finally:
+                shutil.rmtree(part_dir, ignore_errors = True)
+        else:
+            for tree in trees:
+                rows = tree.iter_csv_rows()
+                start = time.perf_counter()
+                for schema_name, table_name, row in rows:
+                    writers[(schema_name, table_name)].writerow(row)
+                    end = time.perf_counter()
+                    table_stats = write_stats["{}.{}".format(schema_name, table_name)]
+                    table_stats["rows"] += 1
+                    table_stats["seconds"] += end - start
+                    start = end
+        for (schema_name, table_name), output in files.items():
+            output.seconds += write_stats["{}.{}".format(schema_name, table_name)]["seconds"]
+        output_files.commit_all(list(files.values()), file_stats)
+        for table_stats in write_stats.values():
+            table_stats["rows_per_second"] = round(table_stats["rows"] / table_stats["seconds"]) if table_stats["seconds"] > 0 else 0
+        logger.info("Streamed csv for '{}': {}".format(sourcesystem_id, write_stats))
+        return True
+    except Exception as e:
+        logger.error("Failed to write CSV data: {}".format(e))
+        output_files.discard_all(list(files.values()))
+        return False
+
+def update_col_limits(db_conns, schema:str, table:str, limits:dict = None, ddl_summary:dict = None) -> bool:
     """Set limits for any defined cols the schema/table
+
+    Only cols whose type differs from the schema catalog are ALTERed (which can rewrite the table and locks it exclusively)
     :param limits: {col_name: col_type} - where an entry exists in this dict, it will be updated
+    :param ddl_summary: Optional dict, filled with the statements {"applied": [], "skipped": []}
     """
     logger.info("Updating col datatype and limits for '{}.{}'...\n{}".format(schema, table, limits))
+    if ddl_summary is None:
+        ddl_summary = {}
     if schema in db_conns:
         use_conn = schema
         logger.debug("Found matching connection for schema '{}'".format(schema))
@@ -164,14 +634,27 @@ def update_col_limits(db_conns, schema:str, table:str, limits:dict = None) -> bo
         ## TODO: Pass default programatically
         use_conn = "dm"
         logger.debug("No matching connection for schema '{}', using default".format("dm"))
-    cursor = db_conns[use_conn].cursor()
     result = False
     if limits:
+        current_limits = _get_col_limits(db_conns, schema, table)
+        changes = {}
+        for col_name, col_type in limits.items():
+            statement = "ALTER TABLE {}.{} ALTER COLUMN {} TYPE {};".format(schema, table, col_name, col_type)
+            if col_name in current_limits and _normalise_col_type(col_type) == current_limits[col_name]:
+                if statement not in ddl_summary.setdefault("skipped", []):
+                    ddl_summary["skipped"].append(statement)
+            else:
+                changes[col_name] = statement
+        if len(changes) == 0:
+            logger.debug("Col types of '{}.{}' already match, nothing to ALTER".format(schema, table))
+            return True
+        cursor = db_conns[use_conn].cursor()
         try:
-            for col_name, col_type in limits.items():
-                cursor.execute("ALTER TABLE {}.{} ALTER COLUMN {} TYPE {};".format(schema, table, col_name, col_type))
+            for col_name, statement in changes.items():
+                cursor.execute(statement)
                 logger.debug("Ran ALTER query: {}".format(cursor.query))
             db_conns[use_conn].commit()
+            ddl_summary.setdefault("applied", []).extend(changes.values())
             result = True
         except Exception as e:
             ## TODO: This can fail if an existing entry is too long - we download data, update limits, trim data and re-upload
@@ -179,26 +662,63 @@ def update_col_limits(db_conns, schema:str, table:str, limits:dict = None) -> bo
             db_conns[use_conn].rollback()
         finally:
             cursor.close()
+            invalidate_schema_catalog(schema)
     return result
 
+## Aliases of the postgres types, as named in information_schema (see _normalise_col_type)
+_col_type_aliases:dict = {
+    "varchar": "character varying",
+    "int": "integer",
+    "int4": "integer",
+    "int8": "bigint",
+    "int2": "smallint",
+    "bool": "boolean",
+    "timestamp": "timestamp without time zone",
+    "timestamptz": "timestamp with time zone",
+}
+
+def _normalise_col_type(col_type:str) -> str:
+    """A configured col type (eg "varchar(2000)") in the format of _get_col_limits (eg "character varying(2000)")"""
+    col_type = " ".join(str(col_type).lower().split())
+    type_name, _bracket, length = col_type.partition("(")
+    type_name = _col_type_aliases.get(type_name.strip(), type_name.strip())
+    if length and type_name == "character varying":
+        return "{}({})".format(type_name, length.rstrip(")").strip())
+    return type_name if not length else "{}({}".format(type_name, length)
+
+def _load_schema_catalog(db_conns, schema:str) -> dict:
+    """Read the col types of all tables in the schema (one query) into the catalog"""
+    logger.debug("Loading schema catalog of '{}'...".format(schema))
+    cursor = db_conns["dm"].cursor()
+    cursor.execute("SELECT table_name, column_name, data_type, character_maximum_length AS max_length FROM information_schema.columns WHERE table_schema = %s;", [schema])
+    tables = {}
+    for table, col_name, data_type, max_length in cursor.fetchall():
+        cols = tables.setdefault(table, {})
+        cols[col_name] = data_type
+        if data_type == "character varying" and type(max_length) is int:
+            cols[col_name] += "({})".format(max_length)
+    cursor.close()
+    _schema_catalog[schema] = {"loaded": time.monotonic(), "tables": tables}
+    return _schema_catalog[schema]
+
+def invalidate_schema_catalog(schema:str = None) -> None:
+    """Drop the catalog of the schema (or all), so it's read again on next use - eg after DDL"""
+    if schema is None:
+        _schema_catalog.clear()
+    else:
+        _schema_catalog.pop(schema, None)
+
 def _get_col_limits(db_conns, schema:str, table:str) -> dict:
-    """Get limits for all cols in the schema/table"""
-    logger.debug("Getting cols for '{}.{}'...".format(schema, table))
-    use_conn = "dm"
-    logger.debug("Read only query, use data manager connection: '{}'".format("dm"))
-    cursor = db_conns[use_conn].cursor()
-    cursor.execute("SELECT column_name, data_type, character_maximum_length AS max_length FROM information_schema.columns WHERE table_schema = '{}' AND table_name = '{}';".format(schema, table))
-    tmp = cursor.fetchall()
-    # logger.debug("Fetchall: {}".format(tmp))
-    # logger.debug("cursor.__dir__: {}".format(cursor.__dir__()))
-
-    cols = {}
-    for col in tmp:
-        # logger.debug("col: {}".format(col))
-        cols[col[0]] = col[1]
-        if col[1] == "character varying" and type(col[2]) is int:
-            cols[col[0]] += "({})".format(col[2])
+    """Get limits for all cols in the schema/table
 
+    Answered from the schema catalog, which is read once per schema and again after "schema_catalog_ttl_seconds" (or invalidate_schema_catalog)
+    """
+    logger.debug("Getting cols for '{}.{}'...".format(schema, table))
+    catalog = _schema_catalog.get(schema)
+    if catalog is None or time.monotonic() - catalog["loaded"] > app.config.get("schema_catalog_ttl_seconds", 300):
+        ## Read only query, use data manager connection
+        catalog = _load_schema_catalog(db_conns, schema)
+    cols = dict(catalog["tables"].get(table, {}))
     logger.debug(cols)
     return cols
 
@@ -233,38 +753,44 @@ def add_source(row:dict, source_id:str, schema = None, table = None) -> tuple[di
         changed = True
     elif schema and schema == "i2b2metadata" and table and table == "table_access" and "c_table_cd" in row:
         ## Add to table_access c_table_cd
-        ## HACK: Ensure c_table_cd always starts with i2b2_
-        if not str(new_row["c_table_cd"]).startswith("i2b2_"):
-            logger.warn("Adding prefix 'i2b2_' for c_table_cd column")
-            new_row["c_table_cd"] = "{}{}".format("i2b2_", row["c_table_cd"])
-        ## TODO: This is hard coding that the c_table_cd starts with i2b2_ - that may not always be the case!
-        if "i2b2_" in new_row["c_table_cd"]:
-            new_row["c_table_cd"] = new_row["c_table_cd"].replace("i2b2_", "i2b2_{}_".format(source_id))
-            changed = True
-        else:
-            logger.warn("new_row[\"c_table_cd\"] ({}) in '{}.{}' does not contain 'i2b2_' so will not have the source_id/sourcesystem_cd ({}) added".format(
-                new_row,
-                schema,
-                table,
-                source_id
-            ))
+        new_row["c_table_cd"] = _source_table_cd(row["c_table_cd"], source_id, schema, table)
+        changed = True
     else:
         new_row = row
     return new_row, changed
 
+def _source_table_cd(c_table_cd:str, source_id:str, schema = None, table = None) -> str:
+    """Add the source_id to a c_table_cd of table_access (i2b2_<source_id>_...)"""
+    ## HACK: Ensure c_table_cd always starts with i2b2_
+    if not str(c_table_cd).startswith("i2b2_"):
+        logger.warn("Adding prefix 'i2b2_' for c_table_cd column")
+        c_table_cd = "{}{}".format("i2b2_", c_table_cd)
+    ## TODO: This is hard coding that the c_table_cd starts with i2b2_ - that may not always be the case!
+    if "i2b2_" in c_table_cd:
+        c_table_cd = c_table_cd.replace("i2b2_", "i2b2_{}_".format(source_id))
+    else:
+        logger.warn("c_table_cd ({}) in '{}.{}' does not contain 'i2b2_' so will not have the source_id/sourcesystem_cd ({}) added".format(
+            c_table_cd,
+            schema,
+            table,
+            source_id
+        ))
+    return c_table_cd
+
+## Rows of a source in each table {"<schema>.<table>": (condition, parameter format)} - the source_id is formatted into the parameter
+source_row_filters:dict = {
+    "i2b2metadata.table_access": ("c_table_cd LIKE %s", "i2b2\\_{}\\_%"),
+    "i2b2metadata.i2b2": ("sourcesystem_cd=%s", "{}"),
+    "i2b2demodata.concept_dimension": ("sourcesystem_cd=%s", "{}"),
+    "i2b2demodata.modifier_dimension": ("sourcesystem_cd=%s", "{}"),
+}
+
 def clean_sources_in_database(db_conns, source_ids:list):
     """DELETE selectively based on the source_ids"""
-    ## TODO: Get prepared query from file
     ## TODO: Should this be in a different module?
     translator_deletes:dict = {}
-    translator_deletes["i2b2metadata"] = """
-        DELETE FROM i2b2metadata.table_access WHERE c_table_cd LIKE %s;
-        DELETE FROM i2b2metadata.i2b2 WHERE sourcesystem_cd=%s;
-    """
-    translator_deletes["i2b2demodata"] = """
-        DELETE FROM i2b2demodata.concept_dimension WHERE sourcesystem_cd=%s;
-        DELETE FROM i2b2demodata.modifier_dimension WHERE sourcesystem_cd=%s;
-    """
+    for table_key in source_row_filters.keys():
+        translator_deletes.setdefault(table_key.split(".")[0], []).append(table_key)
     logger.debug("Running deletes for: {}".format(list(translator_deletes.keys())))
     queries:list = []
     for schema in list(translator_deletes.keys()):
@@ -278,12 +804,15 @@ def clean_sources_in_database(db_conns, source_ids:list):
                 logger.debug("No matching connection for schema '{}', using default".format("dm"))
             cursor = db_conns[use_conn].cursor()
             for source_id in source_ids:
-                if schema == "i2b2metadata":
-                    cursor.execute(translator_deletes[schema], ["i2b2\\_{}\\_%".format(source_id), source_id])
-                elif schema == "i2b2demodata":
-                    cursor.execute(translator_deletes[schema], [source_id] * 2)
+                for table_key in translator_deletes[schema]:
+                    ## A source's partition is truncated instead
+                    if partitions.flush_source(cursor, table_key, source_id):
+                        queries.append(cursor.query)
+                        continue
+                    condition, param_format = source_row_filters[table_key]
+                    cursor.execute("DELETE FROM {} WHERE {};".format(table_key, condition), [param_format.format(source_id)])
+                    queries.append(cursor.query)
             logger.debug("Running specific deletes for: {}".format(schema))
-            queries.append(cursor.query)
         except Exception as e:
             db_conns[use_conn].rollback() ## This is also rolled back in the calling function if we return False
             logger.error("Failed to complete database DELETEs...\n{}".format(e))
@@ -291,6 +820,172 @@ def clean_sources_in_database(db_conns, source_ids:list):
     logger.debug("DELETEd source_ids: {}\n{}".format(source_ids, queries))
     return True
 
+def _load_target(cursor, schema:str, table:str, source_id:str, shadow_tables:dict = None) -> Tuple[str, str]:
+    """The table to load into - the table itself (or the source's partition, see partitions), or with shadow_tables its shadow table (see swap_shadow_tables)
+
+    A shadow table is an empty temporary copy of the table, created for the first file of the table in a load.
+    For a partitioned table it is a new partition of the source instead (see partitions.shadow_partition). A partitioned table is locked
+    against other loads, check the loaded rows with partitions.drop_cross_source_duplicates
+    :param shadow_tables: The shadow tables of this load {"<schema>.<table>": "<schema>.<shadow_table>"}, filled by this function
+    """
+    table_key = "{}.{}".format(schema, table)
+    partitions.lock_for_load(cursor, table_key)
+    if shadow_tables is None:
+        if partitions.use_partitions(cursor, table_key):
+            return schema, partitions.ensure_partition(cursor, table_key, source_id)
+        return schema, table
+    if table_key not in shadow_tables:
+        if partitions.use_partitions(cursor, table_key):
+            shadow_tables[table_key] = partitions.shadow_partition(cursor, table_key, source_id)
+        else:
+            shadow_table = "shadow_{}_{}".format(schema, table)
+            ## Indexes and constraints are included, so ON CONFLICT skips the same rows as in the table
+            cursor.execute("DROP TABLE IF EXISTS pg_temp.{shadow_table}; CREATE TEMP TABLE {shadow_table} (LIKE {schema}.{table} INCLUDING ALL);".format(shadow_table = shadow_table, schema = schema, table = table))
+            shadow_tables[table_key] = "pg_temp.{}".format(shadow_table)
+        logger.debug("Loading '{}' into shadow table '{}'".format(table_key, shadow_tables[table_key]))
+    return tuple(shadow_tables[table_key].split("."))
+
+def swap_shadow_tables(db_conns, source_id:str, shadow_tables:dict) -> bool:
+    """Replace the rows of the source with those loaded into the shadow tables - instead of clean_sources_in_database before loading
+
+    For each table, the rows of the source are deleted and the shadow rows are inserted with one INSERT ... SELECT (tables without a shadow
+    table are only cleaned, as with a flush). The caller commits: until then i2b2 sees the previous rows, and the rows are only locked from the DELETE to the commit.
+    Partitioned tables (see partitions) exchange the source's partition for the shadow one instead
+    :param shadow_tables: Filled by push_csv_to_database/push_columnar_to_database
+    :return: Boolean success/failure
+    """
+    try:
+        for table_key, (condition, param_format) in source_row_filters.items():
+            schema = table_key.split(".")[0]
+            use_conn = schema if schema in db_conns else "dm"
+            cursor = db_conns[use_conn].cursor()
+            start = time.perf_counter()
+            if table_key in shadow_tables and not shadow_tables[table_key].startswith("pg_temp."):
+                partitions.exchange_partition(cursor, table_key, source_id, shadow_tables[table_key])
+                logger.info("Exchanged the partition of '{}' in '{}' ({:.3f}s)".format(source_id, table_key, time.perf_counter() - start))
+                continue
+            if partitions.flush_source(cursor, table_key, source_id):
+                deleted = "all"
+            else:
+                cursor.execute("DELETE FROM {} WHERE {};".format(table_key, condition), [param_format.format(source_id)])
+                deleted = cursor.rowcount
+            inserted = 0
+            if table_key in shadow_tables:
+                cursor.execute("INSERT INTO {table_key} SELECT * FROM {shadow_table} ON CONFLICT DO NOTHING;".format(table_key = table_key, shadow_table = shadow_tables[table_key]))
+                inserted = cursor.rowcount
+                cursor.execute("DROP TABLE {};".format(shadow_tables[table_key]))
+            logger.info("Swapped rows of '{}' in '{}': {} deleted, {} inserted ({:.3f}s)".format(source_id, table_key, deleted, inserted, time.perf_counter() - start))
+        return True
+    except Exception as e:
+        logger.error("Failed to swap in the shadow tables of '{}'...\n{}".format(source_id, e))
+        return False
+
+def _column_transform_plan(file_headers:list, insert_headers:list, col_limits:dict, source_id:str, schema:str, table:str, upload_time:str) -> dict:
+    """What transform_chunk does to each column of a table's csv - the rules of update_headers, add_source and shorten_csv_data
+
+    :param file_headers: Columns in the csv file
+    :param insert_headers: Columns inserted - the file headers, plus sourcesystem_cd when the table has it and the file doesn't (see update_headers)
+    """
+    columns = []
+    for col_name in insert_headers:
+        col_plan = {"name": col_name, "max_length": None}
+        if col_name in col_limits and col_limits[col_name].startswith("character varying("):
+            col_plan["max_length"] = int(col_limits[col_name].split("(")[-1].rstrip(")"))
+        columns.append(col_plan)
+    return {
+        "file_width": len(file_headers),
+        "columns": columns,
+        "source_id": source_id,
+        "schema": schema,
+        "table": table,
+        "upload_time": upload_time,
+        ## See add_source
+        "source_table_cd": "sourcesystem_cd" not in insert_headers and schema == "i2b2metadata" and table == "table_access" and "c_table_cd" in insert_headers,
+        "adds_source": "sourcesystem_cd" in insert_headers or (schema == "i2b2metadata" and table == "table_access" and "c_table_cd" in insert_headers),
+    }
+
+def transform_chunk(plan:dict, chunk:list) -> Tuple[list, int]:
+    """Apply the loading rules to a chunk of csv rows, a whole column at a time
+
+    - '' and 'NULL' become NULL, 'current_timestamp' the upload time (c_dimcode NULL becomes the string 'NULL')
+    - import_date is always the upload time
+    - sourcesystem_cd (c_table_cd of table_access without sourcesystem_cd) gets the source id, see add_source
+    - varchar values are trimmed to the column length, see shorten_csv_data
+    :param plan: From _column_transform_plan
+    :param chunk: Rows as lists of strings (csv.reader), short rows are padded with NULL (as csv.DictReader does)
+    :return: The rows as tuples for inserting and the number of trimmed values
+    """
+    width = plan["file_width"]
+    row_count = len(chunk)
+    file_columns = list(zip(*[row if len(row) == width else (row + [None] * width)[ : width] for row in chunk])) if row_count > 0 else [()] * width
+    upload_time = plan["upload_time"]
+    columns = []
+    trimmed = 0
+    for col_index, col_plan in enumerate(plan["columns"]):
+        col_name = col_plan["name"]
+        if col_name == "import_date":
+            ## In case it wasn't set as "current_timestamp" and therefore picked up already
+            column = [upload_time] * row_count
+        elif col_name == "sourcesystem_cd":
+            column = [plan["source_id"]] * row_count
+        else:
+            column = [None if v == '' or v == 'NULL' else upload_time if v == 'current_timestamp' else v for v in file_columns[col_index]]
+            if col_name == "c_dimcode":
+                ## TODO:(Be less hacky) Hacky fix for NULL and "NULL" being the same once the csv is loaded!
+                column = ["NULL" if v is None else v for v in column]
+            elif col_name == "c_table_cd" and plan["source_table_cd"]:
+                column = [_source_table_cd(v, plan["source_id"], plan["schema"], plan["table"]) for v in column]
+        max_length = col_plan["max_length"]
+        if max_length is not None:
+            long_values = [i for i, v in enumerate(column) if v and len(v) > max_length]
+            for i in long_values:
+                logger.info("**Trimming length of field! ({}.{} {} - {})".format(plan["schema"], plan["table"], col_name, column[i]))
+                column[i] = "{}...".format(column[i][ : max_length-3])
+            trimmed += len(long_values)
+        columns.append(column)
+    return list(zip(*columns)) if row_count > 0 else [], trimmed
+
+def _csv_chunks(reader, chunk_rows:int):
+    """Generator for the rows of a csv reader in lists of chunk_rows"""
+    chunk = []
+    for row in reader:
+        if len(row) == 0:
+            ## Blank line (skipped by csv.DictReader too)
+            continue
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def transform_csv_chunks(plan:dict, reader, file_size:int = 0, workers:int = None, chunk_rows:int = None):
+    """Generator for the transformed chunks of a csv (see transform_chunk), in the order of the file
+
+    Large files (config "csv_load_parallel_min_bytes") are transformed by a pool of worker processes, which get a few chunks ahead of the caller
+    :param workers: Number of processes, defaults to config "csv_load_workers"
+    :param chunk_rows: Rows per chunk, defaults to config "csv_load_chunk_rows"
+    """
+    if workers is None:
+        workers = app.config.get("csv_load_workers", 1)
+    if chunk_rows is None:
+        chunk_rows = app.config.get("csv_load_chunk_rows", 10000)
+    chunks = _csv_chunks(reader, chunk_rows)
+    if workers <= 1 or file_size < app.config.get("csv_load_parallel_min_bytes", 16777216) or "fork" not in multiprocessing.get_all_start_methods():
+        for chunk in chunks:
+            yield transform_chunk(plan, chunk)
+        return
+    logger.info("Transforming csv chunks of {} rows with {} worker processes".format(chunk_rows, workers))
+    with ProcessPoolExecutor(max_workers = workers, mp_context = multiprocessing.get_context("fork")) as executor:
+        ## A bounded window of submitted chunks, so the file isn't read into memory ahead of the inserts
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(transform_chunk, plan, chunk))
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).result()
+        for result in pending:
+            yield result.result()
+
 def update_headers(row:dict, table_headers:list) -> tuple[dict, bool]:
     """Compare headers in use (possibly from CSV file) and table headers to ensure nothing critical is missing
     
@@ -304,40 +999,29 @@ def update_headers(row:dict, table_headers:list) -> tuple[dict, bool]:
         changed = True
     return new_row, changed
 
-def push_csv_to_database(db_conns, source_id:str, prepared_file_paths:list, delim:str = ","):
+def push_csv_to_database(db_conns, source_id:str, prepared_file_paths:list, delim:str = ",", shadow_tables:dict = None):
     """Push any csv data which is listed to the database
     
     Sniffs for header line so should work with or without heading line - using database columns if no header
     Replace "current_timestamp" with actual datetime in memory before inserting
     Update source_id fields
 
-    Also does some fixing of NULL and empty data
+    Also does some fixing of NULL and empty data. The col limits must be applied before (see update_configured_col_limits)
+    The rows are parsed in chunks and transformed a column at a time (see transform_chunk), large files by worker processes
 
     :param prepared_file_paths: list of full filepaths
+    :param shadow_tables: Load into shadow tables instead of the tables, swap them in with swap_shadow_tables (pass an empty dict, it is filled)
     :return: Boolean success/failure
     """
     ## TODO: Work with unknown delimiters (mostly , or ;)? Or always with ,?
+    import output_files
     if prepared_file_paths and len(prepared_file_paths) > 0:
         upload_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.0")
         logger.info("Updating database with data from CSV files... {}".format(prepared_file_paths))
-        ## Update col limits
-        type_limits = app.config["i2b2db_col_limits"]
-        if type_limits:
-            for current_schema, current_tables in type_limits.items():
-                if current_tables:
-                    for current_table, table_limits in current_tables.items():
-                        update_col_limits(db_conns, current_schema, current_table, table_limits)
-                        # logger.debug("Col limits after updating: {}".format(_get_col_limits(db_conn, current_schema, current_table)))
         try:
             for csv_filepath in prepared_file_paths:
                 csv_filename = os.path.basename(csv_filepath)
-                ## TOOD: More sanity checks, this is making dangerous assumptions about the file naming policy
-                if source_id in csv_filename:
-                    current_schema = csv_filename.split(".")[1]
-                    current_table = csv_filename.split(".")[2]
-                else:
-                    current_schema = csv_filename.split(".")[0]
-                    current_table = csv_filename.split(".")[1]
+                current_schema, current_table = _schema_table_from_filename(csv_filepath, source_id)
                 logger.debug("Interpreting CSV file '{}' (schema: {}, table: {}) with delimiter '{}'...".format(
                     csv_filename,
                     current_schema,
@@ -354,8 +1038,8 @@ def push_csv_to_database(db_conns, source_id:str, prepared_file_paths:list, deli
                 cursor = db_conns[use_conn].cursor()
                 ## Get dict of cols and length so we can update and trim our data to fit
                 col_limits = _get_col_limits(db_conns, current_schema, current_table)
-                with open(csv_filepath, 'r') as f:
-                    ## Check for header line and reset to start of file
+                with output_files.open_input(csv_filepath) as f:
+                    ## Check for header line
                     file_headers = None
                     has_header = False
                     reader = csv.reader(f, delimiter = delim)
@@ -379,48 +1063,197 @@ def push_csv_to_database(db_conns, source_id:str, prepared_file_paths:list, deli
                     ## This can be somewhere in-between the file headers and the table_headers!
                     insert_headers = list(update_headers({k:None for k in file_headers},table_headers)[0].keys())
                     logger.debug("insert_headers: {}".format(insert_headers))
-                    query = 'insert into {schema}.{table}({headers}) values ({values}) ON CONFLICT DO NOTHING;'
-                    query = query.format(
-                        schema = current_schema,
-                        table = current_table,
-                        headers = ",".join(insert_headers),
-                        values = ','.join(['%s'] * len(insert_headers))
-                    )
-                    logger.debug("prepared query: {}".format(query))
-                    ## Reset to beginning of file in case first line is data, not header
-                    f.seek(0)
-
-                    reader = csv.DictReader(f, fieldnames = file_headers, delimiter = delim)
-                    if has_header:
-                        ## Skip header
-                        next(reader)
-                    for data in reader:
-                        # logger.debug("data line: {}".format(data))
-                        ## Add columns such as "sourcesystem_cd" if they are not in the CSV file
-                        data, changed = update_headers(data, table_headers)
-                        ## Ensure its an sql null not a string 'null' - int's don't like strings
-                        ## Also replace "current_timestamp" with the actual current timestamp
-                        data = {k:(None if v == '' or v == 'NULL' else upload_time if v == 'current_timestamp' else v) for k,v in data.items()}
-                        if "c_dimcode" in data and data["c_dimcode"] is None:
-                            ## TODO:(Be less hacky) Hacky fix for NULL and "NULL" being the same once the csv is loaded!
-                            logger.debug("c_dimcode is None (changing to 'NULL'): {}".format(data["c_dimcode"]))
-                            data["c_dimcode"] = "NULL"
+                plan = _column_transform_plan(file_headers, insert_headers, col_limits, source_id, current_schema, current_table, upload_time)
+                trimmed_count = [0]
+                def row_chunks(csv_filepath = csv_filepath, plan = plan, has_header = has_header):
+                    ## Start at the beginning of file again in case first line is data, not header (reopened, compressed streams can't always seek)
+                    trimmed_count[0] = 0
+                    with output_files.open_input(csv_filepath) as f:
+                        reader = csv.reader(f, delimiter = delim)
+                        if has_header:
+                            ## Skip header
+                            next(reader)
+                        for rows, trimmed in transform_csv_chunks(plan, reader, os.path.getsize(csv_filepath)):
+                            trimmed_count[0] += trimmed
+                            yield rows
+                target_schema, target_table = _load_target(cursor, current_schema, current_table, source_id, shadow_tables)
+                row_count, load_mode = insert_rows(cursor, target_schema, target_table, insert_headers, row_chunks)
+                row_count -= partitions.drop_cross_source_duplicates(cursor, "{}.{}".format(current_schema, current_table), source_id, "{}.{}".format(target_schema, target_table))
+                logger.info("INSERTed {} rows for '{}.{}' ({}) Added source: {}, trimmed values: {}".format(row_count, current_schema, current_table, load_mode, plan["adds_source"], trimmed_count[0]))
+            return True
+        except Exception as e:
+            # db_conn.rollback() ## Handled by calling function
+            logger.error("Failed to complete database INSERTs...\n{}".format(e))
+            return False
+
+def _copy_value(value) -> str:
+    """A value for COPY ... (FORMAT csv) - NULL is an unquoted empty value, everything else is quoted (so '' stays an empty string)"""
+    if value is None:
+        return ""
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+class _CopyStream:
+    """File-like object for cursor.copy_expert, reading chunks of row tuples as csv"""
+    def __init__(self, row_chunks):
+        self._chunks = iter(row_chunks)
+        self._buffer = b""
+        self.rows = 0
+
+    def read(self, size:int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += "".join(",".join(_copy_value(value) for value in row) + "\n" for row in chunk).encode("utf-8")
+            self.rows += len(chunk)
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[ : size], self._buffer[size : ]
+        return data
+
+def insert_rows(cursor, schema:str, table:str, headers:list, row_chunks, load_mode:str = None) -> Tuple[int, str]:
+    """Insert rows into a table, skipping rows which conflict (ON CONFLICT DO NOTHING)
+
+    - "copy": The rows are streamed with COPY FROM STDIN into a temporary staging table, then merged into the table with one INSERT ... SELECT.
+        If that fails, the transaction is rolled back to before the COPY (savepoint) and the rows are inserted with "rows"
+    - "rows": One INSERT per row (executemany for each chunk)
+    :param row_chunks: Function returning an iterable of chunks (lists) of row tuples in the order of headers - called again for the fallback
+    :param load_mode: "copy" or "rows", defaults to config "db_load_mode"
+    :return: Number of rows inserted (for "copy" without the conflicting rows) and the load mode used
+    """
+    if load_mode is None:
+        load_mode = app.config.get("db_load_mode", "copy")
+    column_list = ",".join(headers)
+    if load_mode == "copy":
+        stage_table = "stage_{}_{}".format(schema, table)
+        try:
+            cursor.execute("SAVEPOINT bulk_load;")
+        except Exception as e:
+            logger.warn("Can't use bulk load (COPY) for '{}.{}', inserting row by row: {}".format(schema, table, e))
+            load_mode = "rows"
+    if load_mode == "copy":
+        try:
+            ## Dropped with the transaction, reused (empty) for more files of the table in the same transaction
+            cursor.execute("CREATE TEMP TABLE IF NOT EXISTS {stage_table} (LIKE {schema}.{table} INCLUDING DEFAULTS) ON COMMIT DROP;".format(stage_table = stage_table, schema = schema, table = table))
+            cursor.execute("TRUNCATE {};".format(stage_table))
+            stream = _CopyStream(row_chunks())
+            cursor.copy_expert("COPY {stage_table} ({columns}) FROM STDIN WITH (FORMAT csv);".format(stage_table = stage_table, columns = column_list), stream, size = 1048576)
+            cursor.execute("INSERT INTO {schema}.{table} ({columns}) SELECT {columns} FROM {stage_table} ON CONFLICT DO NOTHING;".format(schema = schema, table = table, columns = column_list, stage_table = stage_table))
+            inserted = cursor.rowcount
+            cursor.execute("RELEASE SAVEPOINT bulk_load;")
+            logger.debug("COPY staged {} rows for '{}.{}', {} inserted".format(stream.rows, schema, table, inserted))
+            return inserted, "copy"
+        except Exception as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT bulk_load;")
+            logger.warn("Bulk load (COPY) into '{}.{}' failed, inserting row by row: {}".format(schema, table, e))
+    query = 'insert into {schema}.{table}({headers}) values ({values}) ON CONFLICT DO NOTHING;'.format(
+        schema = schema,
+        table = table,
+        headers = column_list,
+        values = ','.join(['%s'] * len(headers))
+    )
+    logger.debug("prepared query: {}".format(query))
+    row_count = 0
+    for rows in row_chunks():
+        cursor.executemany(query, rows)
+        row_count += len(rows)
+    return row_count, "rows"
+
+def update_configured_col_limits(db_conns, ddl_summary:dict = None) -> None:
+    """Apply the col limits of config "i2b2db_col_limits" to the database tables (only those which differ, see update_col_limits)
+
+    The ALTERs are committed per table, so call this before loading any rows - not within the transaction of a load
+
+    :param ddl_summary: Optional dict, filled with the statements {"applied": [], "skipped": []}
+    """
+    if ddl_summary is None:
+        ddl_summary = {}
+    type_limits = app.config["i2b2db_col_limits"]
+    if type_limits:
+        for current_schema, current_tables in type_limits.items():
+            if current_tables:
+                for current_table, table_limits in current_tables.items():
+                    update_col_limits(db_conns, current_schema, current_table, table_limits, ddl_summary)
+                    # logger.debug("Col limits after updating: {}".format(_get_col_limits(db_conn, current_schema, current_table)))
+    logger.info("Col limit DDL applied: {}, skipped (type already matches): {}".format(ddl_summary.get("applied", []), len(ddl_summary.get("skipped", []))))
+
+def _schema_table_from_filename(file_path:str, source_id:str) -> Tuple[str, str]:
+    """Get the schema and table from the filename ([<source_id>.]<schema>.<table>.<ext>)"""
+    filename = os.path.basename(file_path)
+    ## TOOD: More sanity checks, this is making dangerous assumptions about the file naming policy
+    if source_id in filename:
+        return filename.split(".")[1], filename.split(".")[2]
+    return filename.split(".")[0], filename.split(".")[1]
+
+def split_columnar_paths(source_id:str, source_file_paths:list) -> Tuple[list, list]:
+    """Split the file paths of a source into csv and columnar files (see columnar.write_tables)
+
+    Where a table has both, only the newer file is used - a columnar file and the csv export written with it are loaded from the columnar file
+    :return: (csv_file_paths, columnar_file_paths)
+    """
+    import columnar
+    columnar_file_paths = [f for f in source_file_paths if os.path.splitext(f)[1] in columnar.file_extensions.values()]
+    csv_file_paths = [f for f in source_file_paths if f not in columnar_file_paths]
+    for columnar_path in list(columnar_file_paths):
+        table_key = _schema_table_from_filename(columnar_path, source_id)
+        table_csv_paths = [f for f in csv_file_paths if _schema_table_from_filename(f, source_id) == table_key]
+        ## Written in the same run (export) the mtimes are close, so the columnar file wins by a margin
+        if len(table_csv_paths) > 0 and max(os.path.getmtime(f) for f in table_csv_paths) > os.path.getmtime(columnar_path) + 60:
+            logger.info("Ignoring '{}', the csv for the table is newer".format(columnar_path))
+            columnar_file_paths.remove(columnar_path)
+        else:
+            csv_file_paths = [f for f in csv_file_paths if f not in table_csv_paths]
+    logger.debug("Source files for '{}' - csv: {}, columnar: {}".format(source_id, csv_file_paths, columnar_file_paths))
+    return csv_file_paths, columnar_file_paths
+
+def push_columnar_to_database(db_conns, source_id:str, prepared_file_paths:list, shadow_tables:dict = None):
+    """Push typed columnar files (arrow or parquet, see columnar.write_tables) to the database
+
+    The columns are matched to the table by name and already have the database types, so there is no header sniffing or NULL fixing.
+    Columns which the table doesn't have are dropped. Load time columns and import_date get the time of loading
+
+    :param prepared_file_paths: list of full filepaths
+    :param shadow_tables: Load into shadow tables instead of the tables, see push_csv_to_database
+    :return: Boolean success/failure
+    """
+    import columnar
+    if prepared_file_paths and len(prepared_file_paths) > 0:
+        upload_time = datetime.datetime.now().replace(microsecond = 0)
+        logger.info("Updating database with data from columnar files... {}".format(prepared_file_paths))
+        try:
+            for file_path in prepared_file_paths:
+                current_schema, current_table = _schema_table_from_filename(file_path, source_id)
+                use_conn = current_schema if current_schema in db_conns else "dm"
+                cursor = db_conns[use_conn].cursor()
+                col_limits = _get_col_limits(db_conns, current_schema, current_table)
+                table = columnar.read_table(file_path)
+                insert_headers = [col_name for col_name in table.schema.names if col_name in col_limits]
+                dropped_headers = [col_name for col_name in table.schema.names if col_name not in col_limits]
+                if len(dropped_headers) > 0:
+                    logger.warn("Columns of '{}' not in '{}.{}' are not loaded: {}".format(file_path, current_schema, current_table, dropped_headers))
+                def row_chunks(table = table, insert_headers = insert_headers, col_limits = col_limits, current_schema = current_schema, current_table = current_table):
+                    chunk = []
+                    for data in columnar.table_rows(table, upload_time):
+                        data = {col_name: data[col_name] for col_name in insert_headers}
                         if "import_date" in data:
-                            ## In case it wasn't set as "current_timestamp" and therefore picked up already
                             data["import_date"] = upload_time
-                        # logger.debug("CSV data: {}".format(data))
-                        ## Add source_id where necessary
+                        ## Keeps the c_table_cd prefix in table_access
                         data, changed = add_source(data, source_id, current_schema, current_table)
-                        ## Ensure data fits the database column length restrictions (for varchar)
                         data, changed = shorten_csv_data(data, col_limits, current_schema, current_table)
-                        ## Insert line of data
-                        cursor.execute(query, list(data.values()))
-                ## NOTE: Changed is updated per function each line, so this will only see if the last function applied to the last line made a change
-                logger.info("INSERTed values for '{}.{}' Added source: {}".format(current_schema, current_table, changed))
+                        chunk.append(tuple(data.values()))
+                        if len(chunk) >= app.config.get("csv_load_chunk_rows", 10000):
+                            yield chunk
+                            chunk = []
+                    if len(chunk) > 0:
+                        yield chunk
+                target_schema, target_table = _load_target(cursor, current_schema, current_table, source_id, shadow_tables)
+                row_count, load_mode = insert_rows(cursor, target_schema, target_table, insert_headers, row_chunks)
+                row_count -= partitions.drop_cross_source_duplicates(cursor, "{}.{}".format(current_schema, current_table), source_id, "{}.{}".format(target_schema, target_table))
+                logger.info("INSERTed {} rows for '{}.{}' ({})".format(row_count, current_schema, current_table, load_mode))
             return True
         except Exception as e:
-            # db_conn.rollback() ## Handled by calling function
-            logger.error("Failed to complete database INSERTs...\n{}".format(e))
+            logger.error("Failed to complete database INSERTs from columnar files...\n{}".format(e))
             return False
 
 def update_patient_count(db_conns) -> bool:
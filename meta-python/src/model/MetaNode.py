@@ -7,6 +7,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 import datetime
+import sys
 from enum import Enum
 
 class NodeType(Enum):
@@ -28,6 +29,151 @@ class NodeStatus(Enum):
     """Possible status of node"""
     DRAFT = 1
 
+## Compact values which are often the same (eg a label without a tag) are shared between nodes
+shared_values:dict = {}
+
+def _intern(value):
+    """Intern strings, so nodes share the same object for repeated values (eg tags, sourcesystem_cd)"""
+    if type(value) is str:
+        return sys.intern(value)
+    return value
+
+def _compact(d:dict, skip_none:bool = False, intern_keys:bool = False) -> tuple:
+    """Store a tagged attribute dict as a flat tuple (k, tag, k, tag...) - None stays None
+    
+    :param skip_none: Leave out a None key
+    :param intern_keys: Also intern the keys (when they repeat between nodes, eg units)
+    """
+    if d is None:
+        return None
+    flat = []
+    for k, tag in d.items():
+        if k is None and skip_none:
+            continue
+        flat.append(_intern(k) if intern_keys else k)
+        flat.append(_intern(tag))
+    flat = tuple(flat)
+    if all(k is None or k == "" for k in flat[0::2]):
+        flat = shared_values.setdefault(flat, flat)
+    return flat
+
+def _expand(flat:tuple) -> dict:
+    """The dict for a tuple made by _compact"""
+    if flat is None:
+        return None
+    return dict(zip(flat[0::2], flat[1::2]))
+
+## Column plans - how each column's value is found: a fixed value, a property or the first non-empty of several properties
+COLUMN_FIXED = "fixed"
+COLUMN_PROPERTY = "property"
+COLUMN_FIRST_OF = "first_of"
+## {(schema_name, table_name): (ordered_cols, plan)}, built from the config when first used
+column_plans:dict = {}
+
+def reset_column_plans() -> None:
+    """Forget the column plans, so they are rebuilt from the (reloaded) config"""
+    column_plans.clear()
+
+def _column_plan(ordered_cols:list, table_name:str = None, schema_name:str = None) -> list:
+    """The plan for the columns of a table, a list with (kind, value) for each column
+
+    Resolves the config once per table, in order of precedence: "schema-table-col", "table-col" then "col" in "fixed_value_cols" or "sql_col_object_property_map"
+    (fixed values before mapped properties), otherwise the column's own name is the property
+    """
+    cached = column_plans.get((schema_name, table_name))
+    if cached is not None and (cached[0] is ordered_cols or cached[0] == ordered_cols):
+        return cached[1]
+    fixed_value_cols = app.config["fixed_value_cols"]
+    property_map = app.config["sql_col_object_property_map"]
+    plan = []
+    for col_name in ordered_cols:
+        keys = []
+        if schema_name and table_name:
+            keys.append("{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name))
+        if table_name:
+            keys.append("{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name))
+        keys.append(col_name)
+        step = (COLUMN_PROPERTY, col_name)
+        for key in keys:
+            if key in fixed_value_cols:
+                step = (COLUMN_FIXED, str(fixed_value_cols.get(key, "")))
+                break
+            elif key in property_map:
+                real_property_options = property_map.get(key, "")
+                if real_property_options and type(real_property_options) is str:
+                    step = (COLUMN_PROPERTY, real_property_options)
+                elif real_property_options and type(real_property_options) is list:
+                    step = (COLUMN_FIRST_OF, tuple(real_property_options))
+                else:
+                    step = (COLUMN_FIXED, "")
+                break
+        plan.append(step)
+    logger.debug("Column plan for '{}.{}': {}".format(schema_name, table_name, plan))
+    column_plans[(schema_name, table_name)] = (ordered_cols, plan)
+    return plan
+
+## Ordered columns of the csv for each table
+table_columns:dict = {
+    "i2b2metadata.i2b2": ["c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_tablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "m_applied_path", "update_date", "download_date", "import_date", "sourcesystem_cd", "valuetype_cd", "m_exclusion_cd", "c_path", "c_symbol"],
+    "i2b2metadata.table_access": ["c_table_cd", "c_table_name", "c_protected_access", "c_ontology_protection", "c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_dimtablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "c_entry_date", "c_change_date", "c_status_cd", "valuetype_cd"],
+    "i2b2demodata.concept_dimension": ["concept_path", "concept_cd", "name_char", "concept_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"],
+    "i2b2demodata.modifier_dimension": ["modifier_path", "modifier_cd", "name_char", "modifier_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"],
+}
+
+class RowView(object):
+    """Lazy replacement for the dict from a node's __dict__, used by _data_to_csv
+
+    Reading a key evaluates the node's property the first time and remembers it, so a node's rows for all tables only evaluate the properties their columns need, once.
+    Values can be set (like a dict) and then override the node's property
+    """
+    __slots__ = ["source", "attributes", "memo", "containing_row", "notation_rows"]
+
+    def __init__(self, source, attributes:list, containing_row = None, memo:dict = None) -> None:
+        """
+        :param source: The MetaNode or NotationNode
+        :param attributes: The keys which are available (like the keys of __dict__)
+        :param containing_row: For a NotationNode, the row of its containing node - keys which the NotationNode doesn't define are read from there
+        """
+        self.source = source
+        self.attributes = attributes
+        self.containing_row = containing_row
+        self.memo = {} if memo is None else memo
+        self.notation_rows = None
+
+    def get(self, key:str, default = None):
+        """Same as dict.get on the __dict__ of the source"""
+        if key in self.memo:
+            return self.memo[key]
+        if key not in self.attributes:
+            return default
+        if self.containing_row is not None and not hasattr(type(self.source), key):
+            value = self.containing_row.get(key)
+        else:
+            value = getattr(self.source, key, None)
+        self.memo[key] = value
+        return value
+
+    def __getitem__(self, key:str):
+        """Same as dict[key] on the __dict__ of the source"""
+        if key not in self.memo and key not in self.attributes:
+            raise KeyError(key)
+        return self.get(key)
+
+    def __setitem__(self, key:str, value) -> None:
+        """Set (or override) a value"""
+        self.memo[key] = value
+
+    def copy(self):
+        """A copy, so values can be overridden without changing this row (the values evaluated so far are kept)"""
+        return RowView(self.source, self.attributes, self.containing_row, dict(self.memo))
+
+    def notation_row(self, notation_obj):
+        """The row for one of the node's NotationNodes, sharing this row's values"""
+        if self.notation_rows is None:
+            self.notation_rows = {}
+        if notation_obj not in self.notation_rows:
+            self.notation_rows[notation_obj] = RowView(notation_obj, NotationNode.row_attributes, containing_row = self)
+        return self.notation_rows[notation_obj]
 
 class MetaNode(object):
     """All CoMetaR nodes. Those with a notation will be extended by ConceptNode or ModifierNode
@@ -36,34 +182,54 @@ class MetaNode(object):
     skos:prefLabel "Gesundheitsfragebogen: EQ-5D VAS"@de ;
     skos:prefLabel "Health questionnaire EQ-5D VAS"@en ;
     pref_labels = {"Gesundheitsfragebogen: EQ-5D VAS": "de", "Health questionnaire EQ-5D VAS": "en"}
-    """
 
-    parent_node = None
-    child_nodes:list = None
+    There can be millions of nodes, so they are kept compact: slots rather than an instance dict, the tagged attributes are stored as flat tuples
+    (label, tag, label, tag...) and only returned as dicts when read, common strings are interned and all nodes of a run share one timestamp
+    """
+    __slots__ = [
+        "parent_node", "child_nodes", "_child_set", "_derived", "node_uri", "name", "_pref_labels", "_display_labels", "_descriptions", "_notations", "_multi_notations",
+        "_alt_labels", "dwh_display_status", "fetch_timestamp", "_node_type", "status", "_datatype", "_units", "sourcesystem_cd"
+    ]
+
+    parent_node:object
+    child_nodes:list
+    ## Same nodes as child_nodes, for constant time membership checks (only created with the first child)
+    _child_set:set
+    ## Derived fields cached by finalize (None when not finalized, or after the tree was changed)
+    _derived:dict
+    ## The derived fields which finalize caches - in the order they are calculated (later ones use earlier ones)
+    derived_attributes:list = ["ancestor_count", "element_path", "c_hlevel", "applied_path", "concept_long_hash8"]
+    ## Properties and attributes available to the csv columns (see __dict__ and csv_row)
+    row_attributes:list = [
+        "c_table_cd", "c_hlevel", "concept_long", "concept_long_hash8", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname",
+        "description", "descriptions", "applied_path", "fetch_timestamp", "notation", "notations", "sourcesystem_cd", "display_label"
+    ]
+    ## Shared by all nodes created in the same run (see new_run)
+    run_timestamp:str = None
 
     ## Used as title  (k is title, v is tag)
-    pref_labels:dict[str:str] = None
+    _pref_labels:tuple
     ## Used in sidebar/tree  (k is label, v is tag)
-    _display_labels:dict[str:str] = None
+    _display_labels:tuple
     ## Main body text for node  (k is text, v is tag)
-    descriptions:dict[str:str] = None
+    _descriptions:tuple
     ## Codes (k is notation, v is tag)
-    _notations:dict[str:str] = None
+    _notations:dict[str:str]
+    ## The multiple notations with the MULTI container first - created once, when first needed
+    _multi_notations:dict
     ## Optionnaly displayed in CoMetaR top right  (k is label, v is tag)
-    alt_labels:dict[str:str] = None
+    _alt_labels:tuple
 
     ## i2b2hidden
-    dwh_display_status:str = None
-    ## Where a modifier is applicable
-    _applied_path:str = None
-    ## When the object is created
-    fetch_timestamp:str = None
-    _node_type:NodeType = None
-    status:NodeStatus = None
-    _datatype:NodeDatatype = None
+    dwh_display_status:str
+    ## When the run (fetch) which created the object started
+    fetch_timestamp:str
+    _node_type:NodeType
+    status:NodeStatus
+    _datatype:NodeDatatype
     ## Can be multiple units listed in CoMetaR - can (optionally) be tagged eg as UCUM, SI, etc
     ## TODO: Possibly use a Unit class?
-    units:dict[str:str] = None
+    _units:tuple
 
     @property
     def top_level_node(self) -> bool:
@@ -76,8 +242,10 @@ class MetaNode(object):
             return False
     @property
     def ancestor_count(self) -> int:
-        """ Dynamically calculated
+        """ Dynamically calculated (or cached by finalize)
         Dependant on parent (eventually) not existing"""
+        if self._derived is not None and "ancestor_count" in self._derived:
+            return self._derived["ancestor_count"]
         if self.parent_node is None:
             return 0
         else:
@@ -128,7 +296,9 @@ class MetaNode(object):
         return va_part1 + va_part2
     @property
     def element_path(self) -> str:
-        """Dynamically calculated"""
+        """Dynamically calculated (or cached by finalize)"""
+        if self._derived is not None and "element_path" in self._derived:
+            return self._derived["element_path"]
         sep = app.config["i2b2_path_separator"]
         ipp = app.config["i2b2_path_prefix"]
         np = self.name
@@ -143,7 +313,9 @@ class MetaNode(object):
         return built_path.replace("\\\\", "\\").replace("//", "/")
     @property
     def c_hlevel(self) -> int:
-        """Dynamically calculated"""
+        """Dynamically calculated (or cached by finalize)"""
+        if self._derived is not None and "c_hlevel" in self._derived:
+            return self._derived["c_hlevel"]
         if self.node_type == NodeType.MODIFIER:
             if self.parent_node.node_type == NodeType.CONCEPT:
                 return 1
@@ -155,7 +327,7 @@ class MetaNode(object):
     def pref_labels(self) -> dict:
         """Dict or None"""
         if self._pref_labels and len(self._pref_labels) > 0:
-            return self._pref_labels
+            return _expand(self._pref_labels)
         else:
             return None
     @property
@@ -178,8 +350,7 @@ class MetaNode(object):
     @pref_labels.setter
     def pref_labels(self, pref_labels):
         """Ensure no "None" key in dict"""
-        self._pref_labels = pref_labels
-        self._pref_labels.pop(None, None)
+        self._pref_labels = _compact(pref_labels, skip_none = True)
 
     @property
     def datatype(self) -> NodeDatatype:
@@ -266,7 +437,9 @@ class MetaNode(object):
             return "concept_path"
     @property
     def applied_path(self) -> str:
-        """Path where the modifier is applicable"""
+        """Path where the modifier is applicable (cached by finalize)"""
+        if self._derived is not None and "applied_path" in self._derived:
+            return self._derived["applied_path"]
         if self.node_type != NodeType.MODIFIER:
             ## TODO: Define this return string in a config
             return "@"
@@ -286,7 +459,7 @@ class MetaNode(object):
         (k is label, v is language tag)
         """
         if self._display_labels and len(self._display_labels) > 0:
-            return self._display_labels
+            return _expand(self._display_labels)
         else:
             return None
     @property
@@ -317,9 +490,35 @@ class MetaNode(object):
     @display_labels.setter
     def display_labels(self, display_labels: dict):
         """Simple"""
-        self._display_labels = display_labels
         ## Ensure there is not a "None" key
-        self._display_labels.pop(None, None)
+        self._display_labels = _compact(display_labels, skip_none = True)
+
+    @property
+    def descriptions(self) -> dict:
+        """Dict (k is text, v is language tag) or None"""
+        return _expand(self._descriptions)
+    @descriptions.setter
+    def descriptions(self, descriptions:dict):
+        """Stored compact"""
+        self._descriptions = _compact(descriptions)
+
+    @property
+    def alt_labels(self) -> dict:
+        """Dict (k is label, v is language tag) or None"""
+        return _expand(self._alt_labels)
+    @alt_labels.setter
+    def alt_labels(self, alt_labels:dict):
+        """Stored compact"""
+        self._alt_labels = _compact(alt_labels)
+
+    @property
+    def units(self) -> dict:
+        """Dict (k is unit, v is tag) or None"""
+        return _expand(self._units)
+    @units.setter
+    def units(self, units:dict):
+        """Stored compact"""
+        self._units = _compact(units, intern_keys = True)
 
     @property
     def description(self) -> str:
@@ -336,7 +535,9 @@ class MetaNode(object):
         return self.element_path
     @property
     def concept_long_hash8(self) -> str:
-        """Concept path"""
+        """Concept path (hashed, cached by finalize)"""
+        if self._derived is not None and "concept_long_hash8" in self._derived:
+            return self._derived["concept_long_hash8"]
         import base64
         import hashlib
         hasher = hashlib.sha1(self.element_path.encode()).digest()
@@ -351,24 +552,28 @@ class MetaNode(object):
         if self.child_nodes is not None and len(self.child_nodes) != 0 and self._notations is not None and len(self._notations) > 1:
         # if self._notations is not None and len(self._notations) > 1:
             ## Create the multi container path if needed (when notations could clash with child nodes or for VA display purposes)
-            dummy_notation = {app.config["i2b2_multipath_container"]: NotationNode(self, None)}
-            # logger.debug("Created dummy notation for multi: {}\nAlso using notations: {}".format(dummy_notation, self._notations))
-            # logger.debug("Because child_nodes: {}\nand notations: {}".format(self.child_nodes, self._notations))
-            return {**dummy_notation, **self._notations}
+            if self._multi_notations is None:
+                dummy_notation = {app.config["i2b2_multipath_container"]: NotationNode(self, None)}
+                # logger.debug("Created dummy notation for multi: {}\nAlso using notations: {}".format(dummy_notation, self._notations))
+                # logger.debug("Because child_nodes: {}\nand notations: {}".format(self.child_nodes, self._notations))
+                object.__setattr__(self, "_multi_notations", {**dummy_notation, **self._notations})
+            return self._multi_notations
         else:
             return self._notations
     @property
     def notation(self) -> str:
         """Return the notation for the base Node (only a real notation if there exists only 1 notation, otherwise its empty)"""
-        if self.notations is not None and len(self.notations) == 1:
-            return list(self.notations.keys())[0]
+        notations = self.notations
+        if notations is not None and len(notations) == 1:
+            return next(iter(notations))
         else:
             return ""
     @notations.setter
     def notations(self, notations:dict):
         """Create objects from name(s) and tag
-        NOTE: The empty "multi" container is not created or stored, but generated when notations are retrieved. Safer in case child_nodes are added later
+        NOTE: The empty "multi" container is not created here, but when notations are first retrieved after child_nodes were added
         """
+        self._multi_notations = None
         if notations is None or len(notations) == 0:
             ## No notations
             self._notations = None
@@ -378,9 +583,9 @@ class MetaNode(object):
         else:
             ## Multi notations - NOTE: repeated logic must be matched in NotationNode to calculate the correct path
             new_notations = {}
-            for notation_name, notation_tag in notations.items():
-                ## For the actual notations
-                new_notations[notation_name] = NotationNode(self, notation_name, notation_tag)
+            for index, (notation_name, notation_tag) in enumerate(notations.items()):
+                ## For the actual notations - with their position, which is part of the path
+                new_notations[notation_name] = NotationNode(self, notation_name, notation_tag, index)
             self._notations = new_notations
 
     @property
@@ -422,66 +627,77 @@ class MetaNode(object):
     @property
     def meta_csv(self) -> dict:
         """csv data with same format as i2b2metadata i2b2 and table_access tables"""
-        d = self.__dict__()
-        # logger.debug("computed members: {}".format(d))
-        i2b2_cols = ["c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_tablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "m_applied_path", "update_date", "download_date", "import_date", "sourcesystem_cd", "valuetype_cd", "m_exclusion_cd", "c_path", "c_symbol"]
+        return self._meta_lines(self.csv_row())
+    def _meta_lines(self, d) -> dict:
+        """meta_csv using the (lazy) row of this node, so it can be shared with _data_lines"""
         ## meta_inserts' dict can have 2 entries, i2b2 and table_access
         lines = {"i2b2": [], "table_access": []}
         ## ontology can have multiple entries when there are multiple notations
         ## Always insert the base node
-        lines["i2b2"].append(MetaNode._data_to_csv(ordered_cols = i2b2_cols, d = d, table_name = "i2b2", schema_name = "i2b2metadata"))
-        logger.debug("self.notations for '{}': {}".format(self.name, self.notations))
-        if self.notations and len(self.notations) >= 2:
+        lines["i2b2"].append(MetaNode._data_to_csv(ordered_cols = table_columns["i2b2metadata.i2b2"], d = d, table_name = "i2b2", schema_name = "i2b2metadata"))
+        notations = d.get("notations")
+        logger.debug("self.notations for '{}': {}".format(self.name, notations))
+        if notations and len(notations) >= 2:
             ## If multiple notations, use NotationNode objects to populate the additional csv lines
-            for notation_obj in self.notations.values():
-                lines["i2b2"].append(MetaNode._data_to_csv(ordered_cols = i2b2_cols, d = notation_obj.__dict__(), table_name = "i2b2", schema_name = "i2b2metadata"))
+            for notation_obj in notations.values():
+                lines["i2b2"].append(MetaNode._data_to_csv(ordered_cols = table_columns["i2b2metadata.i2b2"], d = d.notation_row(notation_obj), table_name = "i2b2", schema_name = "i2b2metadata"))
             simplified_lines = {}
             simplified_lines["i2b2"] = [v[0:6] for v in lines["i2b2"]]
             logger.debug("Multiple notations for '{}'...\n{}".format(self.name, simplified_lines))
 
-        ta_cols = ["c_table_cd", "c_table_name", "c_protected_access", "c_ontology_protection", "c_hlevel", "c_fullname", "c_name", "c_synonym_cd", "c_visualattributes", "c_totalnum", "c_basecode", "c_metadataxml", "c_facttablecolumn", "c_dimtablename", "c_columnname", "c_columndatatype", "c_operator", "c_dimcode", "c_comment", "c_tooltip", "c_entry_date", "c_change_date", "c_status_cd", "valuetype_cd"]
         if self.top_level_node:
+            ## Only for this row, so on a copy
+            d = d.copy()
             d["c_hlevel"] = 1
-            logger.debug("Using self dict: {}".format(d))
-            lines["table_access"] = [MetaNode._data_to_csv(ordered_cols = ta_cols, d = d, table_name = "table_access", schema_name = "i2b2metadata")]
+            lines["table_access"] = [MetaNode._data_to_csv(ordered_cols = table_columns["i2b2metadata.table_access"], d = d, table_name = "table_access", schema_name = "i2b2metadata")]
         # else:
         #     lines["table_access"] = None
         return lines
     @property
     def data_csv(self) -> dict:
         """csv data with same format as i2b2demodata concept- or modifier- dimension tables"""
-        if not self.notations or len(self.notations) == 0:
+        return self._data_lines(self.csv_row())
+    def _data_lines(self, d) -> dict:
+        """data_csv using the (lazy) row of this node, so it can be shared with _meta_lines"""
+        notations = d.get("notations")
+        if not notations or len(notations) == 0:
             ## When this is just a container/folder, there is nothing to do
             return None
-        d = self.__dict__()
-        # logger.debug("computed members: {}".format(d))
 
         if self.node_type == NodeType.CONCEPT:
             concept_type_table = "concept_dimension"
-            cols = ["concept_path", "concept_cd", "name_char", "concept_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"]
         elif self.node_type == NodeType.MODIFIER:
             concept_type_table = "modifier_dimension"
-            cols = ["modifier_path", "modifier_cd", "name_char", "modifier_blob", "update_date", "download_date", "import_date", "sourcesystem_cd", "upload_id"]
         else:
             logger.error("This node ({}) should be a concept or modifier, its niether! {}".format(self.node_uri, self.node_type))
             return None
+        cols = table_columns["i2b2demodata.{}".format(concept_type_table)]
         ## data inserts occur once for each notation, but not for the containing concept (unless its a single notation)
         lines = {"concept_dimension": [], "modifier_dimension": []}
-        if len(self.notations) == 1:
+        if len(notations) == 1:
             lines[concept_type_table].append(MetaNode._data_to_csv(ordered_cols = cols, d = d, table_name = concept_type_table, schema_name = "i2b2demodata"))
         else:
-            for notation_obj in self.notations.values():
+            for notation_obj in notations.values():
                 if notation_obj.notation is not None and notation_obj.notation != "":
-                    lines[concept_type_table].append(MetaNode._data_to_csv(ordered_cols = cols, d = notation_obj.__dict__(), table_name = concept_type_table, schema_name = "i2b2demodata"))
+                    lines[concept_type_table].append(MetaNode._data_to_csv(ordered_cols = cols, d = d.notation_row(notation_obj), table_name = concept_type_table, schema_name = "i2b2demodata"))
         return lines
 
+    def csv_row(self):
+        """The row data for this node (the same as __dict__), but each property is only evaluated when a column needs it - and then remembered"""
+        return RowView(self, MetaNode.row_attributes)
+
     def __init__(self, node_uri, name, node_type, pref_labels, display_labels, notations, descriptions, alt_labels = None, datatype = None, dwh_display_status = None, parent_node = None, units = None, sourcesystem_cd = "UNKNOWN") -> None:
         """Initialise an instance with data"""
+        ## Set first, its checked whenever an attribute is set
+        object.__setattr__(self, "_derived", None)
+        self.parent_node = None
+        self.status = None
         if parent_node is not None:
             self.parent_node = parent_node
             self.parent_node.add_child(self)
             logger.debug("Node has parent ({}): {}".format(self.parent_node, self.parent_node.node_uri))
         self.child_nodes = []
+        self._child_set = None
         self.node_uri = node_uri
         self.name = name
         self.node_type = node_type
@@ -492,18 +708,80 @@ class MetaNode(object):
         self.alt_labels = alt_labels
         self.datatype = datatype
         self.units = units
-        self.dwh_display_status = dwh_display_status
-        self.sourcesystem_cd = sourcesystem_cd
-        ## TODO: take time format from config
-        self.fetch_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.0")
+        self.dwh_display_status = _intern(dwh_display_status)
+        self.sourcesystem_cd = _intern(sourcesystem_cd)
+        if MetaNode.run_timestamp is None:
+            MetaNode.new_run()
+        self.fetch_timestamp = MetaNode.run_timestamp
         logger.info("New MetaNode object created! ({})".format(self.node_uri))
 
     def add_child(self, child_node) -> None:
-        """Add a child of this node to the list"""
+        """Add a child of this node to the list - in insertion order (so the output is reproducible), ignoring a child which is already there"""
         logger.debug("Adding child: {}".format(child_node))
+        if self._child_set is None:
+            object.__setattr__(self, "_child_set", set())
+        elif child_node in self._child_set:
+            return
+        self._child_set.add(child_node)
         self.child_nodes.append(child_node)
-        ## Deduplicate:
-        self.child_nodes = list(set(self.child_nodes))
+        ## Having children changes the paths of multiple notations
+        if self._derived is not None:
+            self.invalidate()
+
+    @classmethod
+    def new_run(cls) -> None:
+        """Start a new run, nodes created from now on get its timestamp as fetch_timestamp"""
+        ## TODO: take time format from config
+        cls.run_timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.0")
+        logger.debug("New run timestamp for nodes: {}".format(cls.run_timestamp))
+
+    def __setattr__(self, name:str, value) -> None:
+        """Setting anything on a finalized node drops the cached derived fields (see invalidate)"""
+        if self._derived is not None and name != "_derived":
+            self.invalidate()
+        object.__setattr__(self, name, value)
+
+    def finalize(self) -> None:
+        """Calculate the derived fields (derived_attributes) of this node and all its descendants in one top-down traversal and cache them
+
+        Each node's fields only need the (already cached) fields of its parent, so this is linear in the size of the tree.
+        The notations of a node with multiple notations are included. Changes to the tree afterwards invalidate the cache
+        """
+        pending = [self]
+        finalized = 0
+        while len(pending) > 0:
+            node = pending.pop()
+            ## Start empty, so each field is calculated fresh but can use the ones before it
+            derived = {}
+            object.__setattr__(node, "_derived", derived)
+            for attribute in MetaNode.derived_attributes:
+                try:
+                    derived[attribute] = getattr(node, attribute)
+                except AttributeError:
+                    ## Leave it to the property, eg a top level modifier
+                    pass
+            if node._notations is not None and len(node._notations) > 1:
+                for notation_obj in node.notations.values():
+                    notation_obj.finalize()
+            finalized += 1
+            pending.extend(reversed(node.child_nodes))
+        logger.debug("Finalized {} nodes under '{}'".format(finalized, self.name))
+
+    def invalidate(self) -> None:
+        """Drop the cached derived fields of this node and its descendants (their paths include this node's)"""
+        pending = [self]
+        while len(pending) > 0:
+            node = pending.pop()
+            if node._derived is None:
+                continue
+            object.__setattr__(node, "_derived", None)
+            if node._notations is not None and len(node._notations) > 1:
+                for notation_obj in node._notations.values():
+                    notation_obj._derived = None
+                if node._multi_notations is not None:
+                    for notation_obj in node._multi_notations.values():
+                        notation_obj._derived = None
+            pending.extend(node.child_nodes)
 
     def whole_tree_csv(self, lines:dict = None) -> dict:
         """dict with 4 lists for each table in: i2b2metadata{table_access,i2b2}, i2b2demodata{concept_dimension,modifier_dimension}
@@ -515,12 +793,15 @@ class MetaNode(object):
         if lines is None:
             lines = {"i2b2metadata":{"table_access": [], "i2b2": []},"i2b2demodata":{"concept_dimension": [], "modifier_dimension": []}}
         if self.top_level_node:
+            ## Derived fields are calculated once for the whole tree, rather than for every row
+            self.finalize()
             logger.debug("#### ~~~~ STARTING whole tree CSV ~~~~ ####")
             logger.debug("Starting point for meta_csv: {}".format(lines["i2b2metadata"]))
             logger.debug("Starting point for data_csv: {}".format(lines["i2b2demodata"]))
             # time.sleep(2)
 
-        i2b2metadata_csv = self.meta_csv
+        row = self.csv_row()
+        i2b2metadata_csv = self._meta_lines(row)
         if i2b2metadata_csv is not None:
             if i2b2metadata_csv.get("table_access") is not None:
                 lines["i2b2metadata"]["table_access"].extend(i2b2metadata_csv["table_access"])
@@ -528,7 +809,7 @@ class MetaNode(object):
                 lines["i2b2metadata"]["i2b2"].extend(i2b2metadata_csv["i2b2"])
         logger.debug("Added meta_csv: {}".format(i2b2metadata_csv))
 
-        i2b2demodata_csv = self.data_csv
+        i2b2demodata_csv = self._data_lines(row)
         if i2b2demodata_csv is not None:
             if i2b2demodata_csv.get("concept_dimension") is not None:
                 lines["i2b2demodata"]["concept_dimension"].extend(i2b2demodata_csv["concept_dimension"])
@@ -549,70 +830,69 @@ class MetaNode(object):
             logger.debug("#### ~~~~ FINISHED whole tree CSV ~~~~ ####")
         return lines
 
+    def iter_csv_rows(self):
+        """Generator for the csv lines of this node and all its descendants as (schema, table, row) - the same rows, in the same order, as whole_tree_csv
+
+        Nothing is collected, so the rows can be written as they are generated (see meta.write_csv_stream)
+        """
+        if self.top_level_node:
+            ## Derived fields are calculated once for the whole tree, rather than for every row
+            self.finalize()
+        pending = [self]
+        while len(pending) > 0:
+            node = pending.pop()
+            logger.info("Generating csv lines for '{}' ({}): {}".format(node.name, node.node_type_pretty, node.node_uri))
+            node_row = node.csv_row()
+            i2b2metadata_csv = node._meta_lines(node_row)
+            if i2b2metadata_csv is not None:
+                for table in ["table_access", "i2b2"]:
+                    for row in i2b2metadata_csv.get(table) or []:
+                        yield "i2b2metadata", table, row
+            i2b2demodata_csv = node._data_lines(node_row)
+            if i2b2demodata_csv is not None:
+                for table in ["concept_dimension", "modifier_dimension"]:
+                    for row in i2b2demodata_csv.get(table) or []:
+                        yield "i2b2demodata", table, row
+            if node.child_nodes is not None:
+                pending.extend(reversed(node.child_nodes))
+
     @classmethod
     def _data_to_csv(cls, ordered_cols:list, d:dict, delim:str = ";", table_name:str = None, schema_name:str = None) -> list:
-        """Generate a csv line given the columns and data provided"""
-        first = True
-        line = []
+        """Generate a csv line given the columns and data provided - by applying the column plan for the table (see _column_plan)"""
         d["ontology_tablename"] = app.config["ontology_tablename"]
-        for col_name in ordered_cols:
-            new_value = ""
-            real_property_options = None
-            real_property = None
-            ## Inject fixed values for some columns (see sql inserts) OR
-            ## Lookup name map as sql cols can differ from attribute/property names in code. Also can implement preference list to avoid empty values
-            if schema_name and table_name and "{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name) in app.config["fixed_value_cols"]:
-                new_value = str(app.config["fixed_value_cols"].get("{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name), ""))
-            elif schema_name and table_name and "{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name) in app.config["sql_col_object_property_map"]:
-                # logger.info("Mapping SQL column '{}' to object attribute '{}'".format(col_name, [y for x,y in app.config["sql_col_object_property_map"].items() if col_name in x]))
-                real_property_options = app.config["sql_col_object_property_map"].get("{sn}{sep}{tn}{sep}{cn}".format(sep="-", sn=schema_name, tn=table_name, cn=col_name), "")
-            elif table_name and "{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name) in app.config["fixed_value_cols"]:
-                new_value = str(app.config["fixed_value_cols"].get("{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name), ""))
-            elif table_name and "{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name) in app.config["sql_col_object_property_map"]:
-                real_property_options = app.config["sql_col_object_property_map"].get("{tn}{sep}{cn}".format(sep="-", tn=table_name, cn=col_name), "")
-            elif col_name in app.config["fixed_value_cols"]:
-                new_value = str(app.config["fixed_value_cols"].get(col_name, ""))
-            elif col_name in app.config["sql_col_object_property_map"]:
-                real_property_options = app.config["sql_col_object_property_map"].get(col_name, "")
-                # logger.debug("Mapping SQL col '{}' from fuseki properties in map '{}' (Type: {})".format(col_name, real_property_options, type(real_property_options)))
+        line = []
+        for kind, value in _column_plan(ordered_cols, table_name, schema_name):
+            if kind is COLUMN_FIXED:
+                line.append(value)
+            elif kind is COLUMN_PROPERTY:
+                line.append(str(d.get(value, "")))
             else:
-                new_value = str(d.get(col_name, ""))
-                logger.debug("Matched and available col_name ({}) name for '{}', value: {}".format(col_name, d["pref_label"], new_value))
-            if real_property_options and type(real_property_options) is str:
-                real_property = real_property_options
-            elif real_property_options and type(real_property_options) is list:
-                real_property = ""
-                for attempt_property in real_property_options:
+                ## First property with a non-empty value
+                new_value = ""
+                for attempt_property in value:
                     if d.get(attempt_property, None) is not None and str(d.get(attempt_property, "")) != "":
-                    # if attempt_property in d and str(d.get(attempt_property, "")) != "":
-                        logger.debug("Found non-empty useful value with prop '{}': '{}'".format(attempt_property, str(d.get(attempt_property, ""))))
-                        real_property = attempt_property
+                        new_value = str(d.get(attempt_property, ""))
                         break
-                    else:
-                        logger.debug("Found empty/useless value with prop '{}': {}".format(attempt_property, str(d.get(attempt_property, ""))))
-                        pass
-            if real_property:
-                new_value = str(d.get(real_property, ""))
-                logger.debug("mismatched sql({})/object({}) name for '{}', value: {}".format(col_name, real_property, d["pref_label"], new_value))
-            if first:
-                first = False
-                line = [new_value]
-            else:
                 line.append(new_value)
         return line
 
     def __dict__(self):
         """Return all properties which are useful as well as any regular attributes"""
-        all_attributes = [
-            "c_table_cd", "c_hlevel", "concept_long", "concept_long_hash8", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname",
-            "description", "descriptions", "applied_path", "fetch_timestamp", "notation", "notations", "sourcesystem_cd", "display_label"
-        ]
-        d = {k: getattr(self, k, None) for k in all_attributes}
+        d = {k: getattr(self, k, None) for k in MetaNode.row_attributes}
         return d
 
 
 class NotationNode(object):
     """Sometimes we have multiple notations, each needs a node in i2b2 but is mostly inherited from the parent concept"""
+    __slots__ = ["containing_node", "_notation", "tag", "index", "_derived"]
+
+    ## Derived fields cached by finalize (cleared by the containing node when it is invalidated)
+    _derived:dict
+    derived_attributes:list = ["element_path", "c_hlevel", "concept_long_hash8"]
+    ## Properties and attributes available to the csv columns, those not defined here come from the containing node (see __dict__)
+    row_attributes:list = [
+        "c_hlevel", "concept_long", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description", "descriptions",
+        "applied_path", "fetch_timestamp", "concept_long_hash8", "notation", "notations", "display_label"]
 
     @property
     def visual_attribute(self) -> str:
@@ -627,6 +907,8 @@ class NotationNode(object):
             - multi container only used if node has children (should it also be used for multiple notations? Something doesn't work, so maybe!)
             - index only used if node has multiple notations
         """
+        if self._derived is not None and "element_path" in self._derived:
+            return self._derived["element_path"]
         # logger.debug("Checking parent node '{}' for element path stem: {}".format(self.containing_node, self.containing_node.element_path))
         sep = app.config["i2b2_path_separator"]
         impc = app.config["i2b2_multipath_container"]
@@ -640,20 +922,22 @@ class NotationNode(object):
             notation_path = r"{pnp}{sep}{ni}{sep}".format(
                 pnp = pnp,
                 sep = sep,
-                ni = list(self.containing_node.notations.values()).index(self)
+                ni = self.index
                 )
         else:
             notation_path = r"{pnp}{impc}{sep}{ni}{sep}".format(
                 pnp = pnp,
                 sep = sep,
                 impc = impc,
-                ni = list(self.containing_node.notations.values()).index(self) - 1
+                ni = self.index
                 )
         ## Remove duplicate slashes - if they they were at start and end of concatenated strings, then they will be doubled (back-slashes will be escaped too)
         return notation_path.replace("\\\\", "\\").replace("//", "/")
     @property
     def c_hlevel(self) -> int:
         """Dynamically calculated. \MULTI\ is +1, actual notations are +2"""
+        if self._derived is not None and "c_hlevel" in self._derived:
+            return self._derived["c_hlevel"]
         ## TODO: or when containing_node notations length is 1?
         if self.notation == "" or self.containing_node.child_nodes is None or len(self.containing_node.child_nodes) == 0:
             ## Hidden container \MULTI\
@@ -685,7 +969,9 @@ class NotationNode(object):
         return self.element_path
     @property
     def concept_long_hash8(self) -> str:
-        """Concept path"""
+        """Concept path (hashed, cached by finalize)"""
+        if self._derived is not None and "concept_long_hash8" in self._derived:
+            return self._derived["concept_long_hash8"]
         import base64
         import hashlib
         hasher = hashlib.sha1(self.element_path.encode()).digest()
@@ -693,22 +979,30 @@ class NotationNode(object):
         hash8 = base64.urlsafe_b64encode(hasher[:8]).decode('ascii')[:8]
         return hash8
 
-    def __init__(self, containing_node, notation = None, tag = None) -> None:
-        """We want to know which instance is our parent, then we can extend it's attributes"""
+    def __init__(self, containing_node, notation = None, tag = None, index:int = None) -> None:
+        """We want to know which instance is our parent, then we can extend it's attributes
+        
+        :param index: Position among the containing node's notations (used in the path), None for the MULTI container
+        """
         self.containing_node = containing_node
         self._notation = notation
-        self.tag = tag
+        self.tag = _intern(tag)
+        self.index = index
+        self._derived = None
+
+    def finalize(self) -> None:
+        """Cache the derived fields, called by the containing node's finalize (after its own fields are cached)"""
+        self._derived = {}
+        for attribute in NotationNode.derived_attributes:
+            self._derived[attribute] = getattr(self, attribute)
 
     def __dict__(self):
         """Return all properties which are useful as well as any regular attributes"""
         # parent_attributes = ["pref_label", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description", "applied_path", "fetch_timestamp"]
         # notation_attributes = ["c_hlevel", "visual_attribute", "concept_long", "concept_long_hash8", "notation"]
         # all_attributes = [*parent_attributes, *notation_attributes]
-        all_attributes = [
-            "c_hlevel", "concept_long", "pref_label", "visual_attribute", "datatype_xml", "c_facttablecolumn", "c_tablename", "c_columnname", "description", "descriptions",
-            "applied_path", "fetch_timestamp", "concept_long_hash8", "notation", "notations", "display_label"]
-        d1 = {k: getattr(self.containing_node, k, None) for k in all_attributes if not hasattr(self, k)}
-        d2 = {k: getattr(self, k, None) for k in all_attributes if hasattr(self, k)}
+        d1 = {k: getattr(self.containing_node, k, None) for k in NotationNode.row_attributes if not hasattr(self, k)}
+        d2 = {k: getattr(self, k, None) for k in NotationNode.row_attributes if hasattr(self, k)}
         return {**d1, **d2}
 
 ##End
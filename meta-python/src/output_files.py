@@ -0,0 +1,136 @@
+""" output_files.py
+Writing the intermediate files (csv, arrow, parquet) atomically and optionally compressed - and reading them back
+
+Files are written under a hidden temporary name in the same directory and renamed when complete, so a load running during a fetch
+sees either the previous or the new file, never a partial one
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+## Extension added to the filename for each compression
+compression_extensions:dict = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+def output_compression() -> str:
+    """The configured "output_compression" - "zstd" falls back to "gzip" when zstandard is missing"""
+    compression = app.config.get("output_compression", "none") or "none"
+    if compression not in compression_extensions:
+        logger.warn("Unknown output_compression '{}', writing uncompressed files".format(compression))
+        return "none"
+    if compression == "zstd" and zstandard is None:
+        logger.warn("output_compression 'zstd' needs zstandard, which is not installed - using gzip")
+        return "gzip"
+    return compression
+
+def base_path(file_path:str) -> str:
+    """The file path without a compression extension"""
+    for extension in compression_extensions.values():
+        if extension and file_path.endswith(extension):
+            return file_path[ : -len(extension)]
+    return file_path
+
+class OutputFile:
+    """A file written under a temporary name and renamed to its path by commit (or removed by discard)
+
+    Write to .file - text (for csv) or binary (for pyarrow)
+    - path: Final path, including the compression extension
+    - bytes: Size of the file (after compression), set by commit
+    - seconds: Time spent opening and committing - callers add the time they spend writing
+    """
+    def __init__(self, path:str, binary:bool = False, compression:str = "none", buffer_size:int = None):
+        start = time.perf_counter()
+        if buffer_size is None:
+            buffer_size = app.config.get("output_buffer_bytes", 1048576)
+        self.path = path + compression_extensions[compression]
+        ## Hidden, so it doesn't match the source file names (and is on the same filesystem for the rename)
+        self.temp_path = os.path.join(os.path.dirname(self.path), ".{}.tmp".format(os.path.basename(self.path)))
+        self.bytes = 0
+        self._raw = open(self.temp_path, "wb", buffering = buffer_size)
+        if compression == "gzip":
+            self._stream = gzip.GzipFile(filename = "", mode = "wb", fileobj = self._raw, compresslevel = app.config.get("output_compression_level", 6))
+        elif compression == "zstd":
+            self._stream = zstandard.ZstdCompressor(level = app.config.get("output_compression_level", 3)).stream_writer(self._raw, closefd = False)
+        else:
+            self._stream = self._raw
+        self.file = self._stream if binary else io.TextIOWrapper(self._stream, encoding = "utf-8", newline = "")
+        self.seconds = time.perf_counter() - start
+
+    def commit(self) -> None:
+        """Finish the file (compression trailer, fsync) and rename it to its path
+
+        Files of the same table with another compression are removed, so the loader doesn't find stale ones
+        """
+        start = time.perf_counter()
+        if self.file is not self._stream and not self.file.closed:
+            self.file.flush()
+            self.file.detach()
+        if self._stream is not self._raw and not self._stream.closed:
+            self._stream.close()
+        ## Writers like pyarrow's can close the file themselves
+        if not self._raw.closed:
+            self._raw.flush()
+            os.fsync(self._raw.fileno())
+            self._raw.close()
+        os.replace(self.temp_path, self.path)
+        for extension in compression_extensions.values():
+            stale_path = base_path(self.path) + extension
+            if stale_path != self.path and os.path.exists(stale_path):
+                logger.debug("Removing '{}', replaced by '{}'".format(stale_path, self.path))
+                os.remove(stale_path)
+        self.bytes = os.path.getsize(self.path)
+        self.seconds += time.perf_counter() - start
+
+    def discard(self) -> None:
+        """Close and remove the temporary file, the file at path is left as it was"""
+        for stream in [self.file, self._stream, self._raw]:
+            try:
+                stream.close()
+            except Exception:
+                pass
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+def commit_all(outputs:list, file_stats:dict = None) -> None:
+    """Commit the files concurrently (the fsyncs are slow on network storage) - if any fails, the remaining are discarded
+
+    :param file_stats: Optional dict, filled with {<filename>: {"bytes", "seconds"}}
+    """
+    if len(outputs) == 0:
+        return
+    with ThreadPoolExecutor(max_workers = len(outputs)) as executor:
+        results = [executor.submit(output.commit) for output in outputs]
+        errors = [result.exception() for result in results if result.exception() is not None]
+    if len(errors) > 0:
+        discard_all(outputs)
+        raise errors[0]
+    if file_stats is not None:
+        for output in outputs:
+            file_stats[os.path.basename(output.path)] = {"bytes": output.bytes, "seconds": output.seconds}
+
+def discard_all(outputs:list) -> None:
+    """Discard the files which weren't committed"""
+    for output in outputs:
+        if os.path.exists(output.temp_path):
+            output.discard()
+
+def open_input(file_path:str):
+    """Open a (csv) file for reading as text, decompressing by its extension"""
+    if file_path.endswith(compression_extensions["gzip"]):
+        return gzip.open(file_path, "rt", encoding = "utf-8")
+    if file_path.endswith(compression_extensions["zstd"]):
+        if zstandard is None:
+            raise ImportError("zstandard is needed to read '{}'".format(file_path))
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(file_path, "rb")), encoding = "utf-8")
+    return open(file_path, "r")
@@ -0,0 +1,232 @@
+""" partitions.py
+Optional layout of the i2b2 tables with a list partition for each source (by sourcesystem_cd), managed by the meta service
+
+Flushing a source truncates its partition (instead of a DELETE scanning the whole table) and loading inserts into its partition directly.
+A replacing load (see meta.swap_shadow_tables) builds a new partition and exchanges it with the previous one.
+
+Unique keys without sourcesystem_cd (the primary keys on concept_path and modifier_path, unique indexes on c_fullname) can't be on the partitioned table,
+postgres only enforces them within each partition. So ON CONFLICT no longer drops a row whose key exists under another source - instead
+the rows of a load are checked against the other sources (see drop_cross_source_duplicates), with the table locked against other loads until the commit.
+table_access has no sourcesystem_cd, so it isn't partitioned. Migrate with the route /partition-tables, then enable with config "db_partition_by_source"
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+import hashlib
+import re
+import time
+
+## Tables which are partitioned by sourcesystem_cd
+partitioned_tables:list = ["i2b2metadata.i2b2", "i2b2demodata.concept_dimension", "i2b2demodata.modifier_dimension"]
+
+def enabled() -> bool:
+    """Whether the loader and flush use the partitions (config "db_partition_by_source")"""
+    return bool(app.config.get("db_partition_by_source", False))
+
+def use_partitions(cursor, table_key:str) -> bool:
+    """True when partitions are enabled and the table has been migrated"""
+    return enabled() and table_key in partitioned_tables and is_partitioned(cursor, table_key)
+
+def partition_name(table:str, source_id:str) -> str:
+    """Name of the partition of a source - the source_id is sanitised, so a hash of it is added to keep the names distinct"""
+    safe_id = re.sub("[^a-z0-9_]", "_", source_id.lower())[ : 25]
+    return "{}_src_{}_{}".format(table, safe_id, hashlib.md5(source_id.encode("utf-8")).hexdigest()[ : 6])
+
+def _relkind(cursor, schema:str, table:str) -> str:
+    """The pg_class relkind of a table ("r" table, "p" partitioned table), None if it doesn't exist"""
+    cursor.execute("SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE n.nspname = %s AND c.relname = %s;", [schema, table])
+    result = cursor.fetchone()
+    return result[0] if result else None
+
+def is_partitioned(cursor, table_key:str) -> bool:
+    """True if the table is partitioned"""
+    return _relkind(cursor, *table_key.split(".")) == "p"
+
+def _own_unique_keys(cursor, schema:str, table:str) -> list:
+    """Unique indexes of a table which don't belong to an index of the parent table
+
+    :return: [(index definition, constraint definition)] - the constraint definition is None for a plain unique index
+    """
+    cursor.execute("""
+        SELECT pg_get_indexdef(i.indexrelid), pg_get_constraintdef(c.oid) FROM pg_index i
+        LEFT JOIN pg_constraint c ON c.conindid = i.indexrelid AND c.conrelid = i.indrelid AND c.contype IN ('p', 'u')
+        WHERE i.indrelid = %s::regclass AND i.indisunique AND NOT EXISTS (SELECT 1 FROM pg_inherits h WHERE h.inhrelid = i.indexrelid);
+    """, ["{}.{}".format(schema, table)])
+    return cursor.fetchall()
+
+def _add_index(cursor, schema:str, table:str, index_definition:str, constraint_definition:str = None) -> None:
+    """Create an index on a table - a primary key or unique constraint as a constraint (with a generated name), otherwise as an index"""
+    if constraint_definition:
+        cursor.execute("ALTER TABLE {}.{} ADD {};".format(schema, table, constraint_definition))
+    else:
+        cursor.execute(_index_on(index_definition, schema, table))
+
+def cross_source_keys(cursor, table_key:str) -> list:
+    """Columns of the unique keys which postgres only enforces within a partition (those without sourcesystem_cd, on the default partition)
+
+    Expression and partial indexes are left out
+    :return: [[col_name]]
+    """
+    schema, table = table_key.split(".")
+    cursor.execute("""
+        SELECT array_agg(a.attname::text ORDER BY k.ord) FROM pg_index i
+        CROSS JOIN LATERAL unnest(i.indkey::int2[]) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+        WHERE i.indrelid = %s::regclass AND i.indisunique AND i.indpred IS NULL AND i.indexprs IS NULL
+        GROUP BY i.indexrelid;
+    """, ["{}.{}_default".format(schema, table)])
+    return [cols for (cols,) in cursor.fetchall() if "sourcesystem_cd" not in cols]
+
+def lock_for_load(cursor, table_key:str) -> None:
+    """Lock a partitioned table against the writes of other loads until the commit (i2b2 can still read it), so drop_cross_source_duplicates
+    sees the rows of every other source. Take it before inserting - upgrading the lock of an insert can deadlock with another load
+    """
+    if is_partitioned(cursor, table_key):
+        cursor.execute("LOCK TABLE {} IN SHARE ROW EXCLUSIVE MODE;".format(table_key))
+
+def drop_cross_source_duplicates(cursor, table_key:str, source_id:str, target_table:str) -> int:
+    """Delete the rows of a source loaded into target_table whose unique key (see cross_source_keys) another source already has
+
+    These are the rows ON CONFLICT DO NOTHING skips in an unpartitioned table. Does nothing if the table isn't partitioned
+    :param target_table: The table loaded into as "<schema>.<table>" - the partitioned table, the source's partition or its shadow partition
+    :return: Number of rows deleted
+    """
+    if not is_partitioned(cursor, table_key):
+        return 0
+    dropped = 0
+    for key_cols in cross_source_keys(cursor, table_key):
+        cursor.execute("""
+            DELETE FROM {target_table} t WHERE t.sourcesystem_cd = %s
+            AND EXISTS (SELECT 1 FROM {table_key} p WHERE p.sourcesystem_cd IS DISTINCT FROM %s AND {key_match});
+        """.format(target_table = target_table, table_key = table_key, key_match = " AND ".join(["p.{col} = t.{col}".format(col = col) for col in key_cols])), [source_id, source_id])
+        dropped += cursor.rowcount
+    if dropped > 0:
+        logger.warn("Dropped {} rows of '{}' loaded into '{}', their unique key exists under another source".format(dropped, source_id, target_table))
+    return dropped
+
+def _index_on(index_definition:str, schema:str, table:str) -> str:
+    """Change the table of an index definition (from pg_get_indexdef) - the index gets a generated name"""
+    return re.sub(r"^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+", lambda m: "CREATE {}INDEX ON {}.{}".format(m.group(1) or "", schema, table), index_definition)
+
+def _copy_grants(cursor, schema:str, from_table:str, to_table:str) -> None:
+    """Give the roles the same privileges on to_table as they have on from_table"""
+    cursor.execute("SELECT grantee, privilege_type FROM information_schema.role_table_grants WHERE table_schema = %s AND table_name = %s;", [schema, from_table])
+    for grantee, privilege in cursor.fetchall():
+        cursor.execute('GRANT {} ON TABLE {}.{} TO "{}";'.format(privilege, schema, to_table, grantee))
+
+def ensure_partition(cursor, table_key:str, source_id:str) -> str:
+    """Create the partition of a source (if it doesn't exist) and return its name
+
+    Rows of the source in the default partition are moved into it. The unique keys (which can't be on the partitioned table,
+    as they don't include sourcesystem_cd) are copied from the default partition, primary keys as constraints
+    """
+    schema, table = table_key.split(".")
+    partition = partition_name(table, source_id)
+    if _relkind(cursor, schema, partition) is not None:
+        return partition
+    default_partition = "{}_default".format(table)
+    cursor.execute("SELECT count(*) FROM {}.{} WHERE sourcesystem_cd = %s;".format(schema, default_partition), [source_id])
+    moved_rows = cursor.fetchone()[0]
+    if moved_rows > 0:
+        cursor.execute("CREATE TEMP TABLE partition_moved_rows ON COMMIT DROP AS SELECT * FROM {}.{} WHERE sourcesystem_cd = %s;".format(schema, default_partition), [source_id])
+        cursor.execute("DELETE FROM {}.{} WHERE sourcesystem_cd = %s;".format(schema, default_partition), [source_id])
+    cursor.execute("CREATE TABLE {schema}.{partition} PARTITION OF {schema}.{table} FOR VALUES IN (%s);".format(schema = schema, partition = partition, table = table), [source_id])
+    for index_definition, constraint_definition in _own_unique_keys(cursor, schema, default_partition):
+        _add_index(cursor, schema, partition, index_definition, constraint_definition)
+    _copy_grants(cursor, schema, table, partition)
+    if moved_rows > 0:
+        cursor.execute("INSERT INTO {}.{} SELECT * FROM partition_moved_rows; DROP TABLE partition_moved_rows;".format(schema, partition))
+    logger.info("Created partition '{}.{}' for source '{}' (moved {} rows from the default partition)".format(schema, partition, source_id, moved_rows))
+    return partition
+
+def flush_source(cursor, table_key:str, source_id:str) -> bool:
+    """Remove the rows of a source by truncating its partition
+
+    :return: False if that isn't possible (partitions not used, or the source has no partition) - then the rows must be deleted
+    """
+    if not use_partitions(cursor, table_key):
+        return False
+    schema, table = table_key.split(".")
+    partition = partition_name(table, source_id)
+    if _relkind(cursor, schema, partition) is None:
+        return False
+    cursor.execute("TRUNCATE {}.{};".format(schema, partition))
+    logger.debug("Truncated partition '{}.{}' of source '{}'".format(schema, partition, source_id))
+    return True
+
+def shadow_partition(cursor, table_key:str, source_id:str) -> str:
+    """Create an empty table to load a source into, which exchange_partition swaps in for its partition
+
+    It has the indexes of the partition and a check constraint for the source, so attaching it doesn't need to scan it
+    :return: The shadow table as "<schema>.<table>"
+    """
+    schema, table = table_key.split(".")
+    partition = ensure_partition(cursor, table_key, source_id)
+    shadow_table = "{}_new".format(partition)
+    cursor.execute("DROP TABLE IF EXISTS {schema}.{shadow_table}; CREATE TABLE {schema}.{shadow_table} (LIKE {schema}.{partition} INCLUDING ALL);".format(schema = schema, shadow_table = shadow_table, partition = partition))
+    cursor.execute("ALTER TABLE {schema}.{shadow_table} ADD CONSTRAINT {shadow_table}_source CHECK (sourcesystem_cd IS NOT NULL AND sourcesystem_cd = %s);".format(schema = schema, shadow_table = shadow_table), [source_id])
+    _copy_grants(cursor, schema, partition, shadow_table)
+    return "{}.{}".format(schema, shadow_table)
+
+def exchange_partition(cursor, table_key:str, source_id:str, shadow_table:str) -> None:
+    """Swap the shadow table (from shadow_partition) in as the partition of the source, the previous partition is dropped"""
+    schema, table = table_key.split(".")
+    partition = partition_name(table, source_id)
+    shadow_name = shadow_table.split(".")[1]
+    cursor.execute("ALTER TABLE {schema}.{table} DETACH PARTITION {schema}.{partition};".format(schema = schema, table = table, partition = partition))
+    cursor.execute("ALTER TABLE {schema}.{table} ATTACH PARTITION {shadow_table} FOR VALUES IN (%s);".format(schema = schema, table = table, shadow_table = shadow_table), [source_id])
+    cursor.execute("DROP TABLE {}.{};".format(schema, partition))
+    ## The partition bound replaces the check constraint (and the next shadow table would copy it)
+    cursor.execute("ALTER TABLE {shadow_table} DROP CONSTRAINT {shadow_name}_source; ALTER TABLE {shadow_table} RENAME TO {partition};".format(shadow_table = shadow_table, shadow_name = shadow_name, partition = partition))
+
+def migrate(db_conns, table_keys:list = None) -> dict:
+    """Convert the tables to tables list partitioned by sourcesystem_cd, with a partition for each source they contain and a default partition
+
+    The rows are copied into the new table and the old table is dropped - all in the transaction of the connection (the caller commits).
+    Indexes are recreated on the partitioned table, unique ones without sourcesystem_cd on each partition (primary keys and unique
+    constraints as constraints). Those keys are then no longer unique across sources, loads check that instead (see drop_cross_source_duplicates).
+    Privileges are copied. Tables which are already partitioned are skipped
+    :param table_keys: Tables to convert, defaults to partitioned_tables
+    :return: {"<schema>.<table>": {"partitions", "rows", "seconds"}}
+    """
+    if table_keys is None:
+        table_keys = partitioned_tables
+    results:dict = {}
+    for table_key in table_keys:
+        schema, table = table_key.split(".")
+        use_conn = schema if schema in db_conns else "dm"
+        cursor = db_conns[use_conn].cursor()
+        if is_partitioned(cursor, table_key):
+            logger.info("'{}' is already partitioned".format(table_key))
+            continue
+        start = time.perf_counter()
+        old_table = "{}_unpartitioned".format(table)
+        cursor.execute("""
+            SELECT pg_get_indexdef(i.indexrelid), i.indisunique, pg_get_constraintdef(c.oid) FROM pg_index i
+            LEFT JOIN pg_constraint c ON c.conindid = i.indexrelid AND c.conrelid = i.indrelid AND c.contype IN ('p', 'u')
+            WHERE i.indrelid = %s::regclass;
+        """, [table_key])
+        indexes = cursor.fetchall()
+        cursor.execute("ALTER TABLE {schema}.{table} RENAME TO {old_table};".format(schema = schema, table = table, old_table = old_table))
+        cursor.execute("CREATE TABLE {schema}.{table} (LIKE {schema}.{old_table} INCLUDING DEFAULTS INCLUDING STORAGE INCLUDING COMMENTS) PARTITION BY LIST (sourcesystem_cd);".format(schema = schema, table = table, old_table = old_table))
+        cursor.execute("CREATE TABLE {schema}.{table}_default PARTITION OF {schema}.{table} DEFAULT;".format(schema = schema, table = table))
+        for index_definition, is_unique, constraint_definition in indexes:
+            columns = index_definition.split("(", 1)[-1]
+            if is_unique and "sourcesystem_cd" not in columns:
+                _add_index(cursor, schema, "{}_default".format(table), index_definition, constraint_definition)
+            else:
+                _add_index(cursor, schema, table, index_definition, constraint_definition)
+        _copy_grants(cursor, schema, old_table, table)
+        _copy_grants(cursor, schema, old_table, "{}_default".format(table))
+        cursor.execute("SELECT DISTINCT sourcesystem_cd FROM {}.{} WHERE sourcesystem_cd IS NOT NULL;".format(schema, old_table))
+        source_ids = [row[0] for row in cursor.fetchall()]
+        for source_id in source_ids:
+            ensure_partition(cursor, table_key, source_id)
+        cursor.execute("INSERT INTO {schema}.{table} SELECT * FROM {schema}.{old_table};".format(schema = schema, table = table, old_table = old_table))
+        row_count = cursor.rowcount
+        cursor.execute("DROP TABLE {}.{};".format(schema, old_table))
+        results[table_key] = {"partitions": len(source_ids) + 1, "rows": row_count, "seconds": round(time.perf_counter() - start, 3)}
+        logger.info("Partitioned '{}' by sourcesystem_cd: {}".format(table_key, results[table_key]))
+    return results
@@ -0,0 +1,117 @@
+""" cache.py
+On-disk cache for sparql query responses, so repeated fetches of an unchanged ontology don't need to query fuseki
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+## For reusing the cache (and its size tracking) between requests
+response_cache:object = None
+
+def get_response_cache():
+    """Get the cache configured by "sparql_cache_directory" (user config), or None when caching is disabled (the default)"""
+    global response_cache
+    cache_dir = app.config.get("sparql_cache_directory")
+    if not cache_dir:
+        return None
+    if response_cache is None or response_cache.cache_dir != cache_dir:
+        response_cache = ResponseCache(
+            cache_dir,
+            ttl = app.config.get("sparql_cache_ttl", 300),
+            max_bytes = app.config.get("sparql_cache_max_bytes", 512 * 1024 * 1024)
+        )
+    return response_cache
+
+class ResponseCache(object):
+    """Responses stored as json files, keyed by endpoint and a hash of the rendered query
+
+    A file's mtime is when it was stored (for the TTL), its atime is when it was last used (for LRU eviction).
+    atime is set explicitly, so it doesn't depend on the mount options
+    """
+
+    def __init__(self, cache_dir:str, ttl:int, max_bytes:int) -> None:
+        """Create the cache directory if needed and measure its current size"""
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._size = sum(size for _path, size, _atime, _mtime in self._entries())
+        logger.info("Using sparql response cache in '{}' ({} bytes, ttl: {}s, max bytes: {})".format(self.cache_dir, self._size, self.ttl, self.max_bytes))
+
+    def get(self, endpoint:str, sparql_query:str) -> dict:
+        """The cached response, or None if there is no valid entry"""
+        path = self._path(endpoint, sparql_query)
+        try:
+            stored = os.stat(path).st_mtime
+            if time.time() - stored > self.ttl:
+                logger.debug("Cache entry expired: {}".format(path))
+                return None
+            with open(path, "r") as f:
+                data = json.load(f)
+            os.utime(path, (time.time(), stored))
+        except (OSError, ValueError):
+            return None
+        return data
+
+    def put(self, endpoint:str, sparql_query:str, data:dict) -> None:
+        """Store the response (atomically, so concurrent readers never see a partial file), then evict if over budget"""
+        path = self._path(endpoint, sparql_query)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir = self.cache_dir, prefix = ".", suffix = ".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            new_size = os.path.getsize(tmp_path)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warn("Could not write sparql cache entry '{}': {}".format(path, e))
+            return
+        with self._lock:
+            self._size += new_size - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Remove expired entries, then least recently used ones until the cache fits its byte budget"""
+        entries = self._entries()
+        now = time.time()
+        removed = 0
+        self._size = sum(size for _path, size, _atime, _mtime in entries)
+        for path, size, atime, mtime in sorted(entries, key = lambda entry: (now - entry[3] <= self.ttl, entry[2])):
+            if self._size <= self.max_bytes and now - mtime <= self.ttl:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+                removed += 1
+            except OSError:
+                pass
+        logger.info("Evicted {} sparql cache entries, size now: {} bytes".format(removed, self._size))
+
+    def _entries(self) -> list:
+        """(path, size, atime, mtime) for each cached response"""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(".json"):
+                path = os.path.join(self.cache_dir, filename)
+                try:
+                    file_stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, file_stat.st_size, file_stat.st_atime, file_stat.st_mtime))
+        return entries
+
+    def _path(self, endpoint:str, sparql_query:str) -> str:
+        """File for the endpoint/query combination"""
+        key = hashlib.sha256("{}\n{}".format(endpoint, sparql_query).encode()).hexdigest()
+        return os.path.join(self.cache_dir, "{}.json".format(key))
@@ -1,47 +1,62 @@
 """ connection.py
-Functions to manage the connection to fuseki
+Functions to manage the connection to fuseki and the (pooled) connections to the database
 """
 from flask import current_app as app
 
 import logging
 logger = logging.getLogger(__name__)
 
+import os
 import psycopg2
 import psycopg2.sql
 import requests
 import SPARQLWrapper
 import sys
+import threading
+import time
 
-def get_fuseki_connection(fuseki_endpoint:str, connection_type:str = "requests", source_id:str = "UNKNOWN"):
-    """Run the respective function to get the connection of the type requested"""
+def get_fuseki_connection(fuseki_endpoint:str, connection_type:str = "requests", source_id:str = "UNKNOWN", pool_size:int = None):
+    """Run the respective function to get the connection of the type requested
+    
+    :param pool_size: Number of HTTP connections to keep open to the endpoint (match the number of concurrent workers)
+    """
     connections = {"requests": "_get_requests_connection", "sqparql_wrapper": "_get_sparql_wrapper"}
     connection_function = connections.get(connection_type, "requests")
     connection = None
     try:
         logger.debug("Getting connection from '{}.{}'".format(sys.modules[__name__], connection_function))
-        connection = getattr(sys.modules[__name__], connection_function)(fuseki_endpoint)
+        connection = getattr(sys.modules[__name__], connection_function)(fuseki_endpoint, pool_size)
         connection["source_id"] = source_id
     except Exception as e:
         logger.error("Could not call the function to get the real connection!")
         logger.error("Requested type: {}\nSelected function: {}\nError:\n{}".format(connection_type, connection_function, e))
     return connection
 
-def _get_sparql_wrapper(fuseki_endpoint:str):
-    """Use the endpoint-url to setup the wrapper, which is needed to make quieries"""
+def _get_sparql_wrapper(fuseki_endpoint:str, pool_size:int = None):
+    """Use the endpoint-url to setup the wrapper, which is needed to make quieries (pool_size is not supported)"""
     sparql = SPARQLWrapper.SPARQLWrapper(fuseki_endpoint)
     sparql.setUseKeepAlive()
     logger.debug("Using KeepAlive with SPARQL Wrapper connections")
     ## See issue: https://github.com/RDFLib/sparqlwrapper/issues/2
     return sparql
 
-def _get_requests_connection(fuseki_endpoint:str) -> dict:
+def _get_requests_connection(fuseki_endpoint:str, pool_size:int = None) -> dict:
     """Get session and prepared request, also supply a default timeout"""
-    connection = {"session": _get_request_session(), "prepared_request": _get_prepped_request(fuseki_endpoint), "timeout": (3, 60)}
+    connection = {"session": _get_request_session(pool_size), "prepared_request": _get_prepped_request(fuseki_endpoint), "timeout": (3, 60)}
     return connection
 
-def _get_request_session():
-    """Create a session to utilise connection pooling - possibly more later"""
+def _get_request_session(pool_size:int = None):
+    """Create a session to utilise connection pooling - possibly more later
+    
+    :param pool_size: Maximum connections kept per host, when None the requests default (10) is used
+    """
     new_session = requests.Session()
+    if pool_size:
+        ## Without this, concurrent requests beyond the default pool size open (and discard) extra connections
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = pool_size)
+        new_session.mount("http://", adapter)
+        new_session.mount("https://", adapter)
+        logger.debug("Using HTTP connection pool of size: {}".format(pool_size))
     return new_session
 
 def _get_prepped_request(fuseki_endpoint:str):
@@ -54,6 +69,7 @@ def _get_prepped_request(fuseki_endpoint:str):
 def get_database_connection(database_host:str, database_name:str, database_user:str, database_password):
     """Get a connection to the database which we can reuse elsewhere"""
     logger.debug("Connection to db...")
+    conn = None
     try:
         conn = psycopg2.connect (
             host = database_host,
@@ -62,7 +78,187 @@ def get_database_connection(database_host:str, database_name:str, database_user:
             password = database_password
         )
         logger.info("Connection to postgres successful! {}".format(conn))
-    except:
-        logger.warn("Connection to postgres UN-successful! {}".format(conn))
+    except Exception as e:
+        logger.warn("Connection to postgres UN-successful! {}@{}/{}: {}".format(database_user, database_host, database_name, e))
         conn = None
     return conn
+
+## Environment variables of the database roles {role: (user, password, db_conns key)} - the key is the schema the role's connection is used for (see get_database_connections)
+database_roles:dict = {
+    "dm": ("DB_ADMIN_USER", "DB_ADMIN_PASS", None),
+    "crc": ("DS_CRC_USER", "DS_CRC_PASS", "DS_CRC_DB"),
+    "ont": ("DS_ONT_USER", "DS_ONT_PASS", "DS_ONT_DB"),
+}
+## Pool of each role {role: DatabasePool}, created on first use and kept for the lifetime of the process
+_database_pools:dict = {}
+_database_pools_lock = threading.Lock()
+
+class DatabasePool:
+    """Long-lived connections of one database role, shared by the requests (threads) of the listener
+
+    - max_size: Connections open at most (idle and checked out) - checkout waits when all are in use
+    - health_check_seconds: Connections idle for longer are checked with "SELECT 1" before reuse, broken ones are replaced
+    - stats: Counters since the pool was created, see database_pool_stats
+    """
+    def __init__(self, database_host:str, database_name:str, database_user:str, database_password, max_size:int = 4, health_check_seconds:float = 60):
+        self._connect_args = (database_host, database_name, database_user, database_password)
+        self.max_size = max(1, max_size)
+        self.health_check_seconds = health_check_seconds
+        ## (connection, time it was released)
+        self._idle:list = []
+        self._size = 0
+        self._condition = threading.Condition()
+        self.stats = {"created": 0, "reused": 0, "discarded": 0, "health_checks": 0, "timeouts": 0, "waits": 0, "wait_seconds": 0.0}
+
+    def checkout(self, timeout:float = 30):
+        """A connection of the pool, None if none became free within timeout seconds (or connecting failed)"""
+        start = time.perf_counter()
+        waited = False
+        with self._condition:
+            while True:
+                if len(self._idle) > 0:
+                    conn, released = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    conn = None
+                    self._size += 1
+                    break
+                remaining = timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self.stats["timeouts"] += 1
+                    logger.warn("No database connection for '{}' became free within {}s (pool size: {})".format(self._connect_args[2], timeout, self.max_size))
+                    return None
+                waited = True
+                self._condition.wait(remaining)
+            if waited:
+                self.stats["waits"] += 1
+                self.stats["wait_seconds"] += time.perf_counter() - start
+        if conn is not None:
+            if self._healthy(conn, released):
+                self._count("reused")
+                return conn
+            ## Replaced by a new connection, which keeps its place in the pool
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self._count("discarded")
+        ## Connect outside the lock, other threads can check out idle connections meanwhile
+        conn = get_database_connection(*self._connect_args)
+        if conn is None:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            return None
+        self._count("created")
+        return conn
+
+    def _count(self, stat:str) -> None:
+        with self._condition:
+            self.stats[stat] += 1
+
+    def _healthy(self, conn, released:float) -> bool:
+        """False if the connection is closed, or idle for longer than health_check_seconds and doesn't answer"""
+        if conn.closed:
+            return False
+        if time.monotonic() - released < self.health_check_seconds:
+            return True
+        self._count("health_checks")
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.warn("Pooled database connection for '{}' failed its health check, reconnecting: {}".format(self._connect_args[2], e))
+            return False
+
+    def release(self, conn) -> None:
+        """Return a connection - an open transaction is rolled back and temporary tables are dropped, broken connections are discarded"""
+        try:
+            if conn.closed:
+                raise psycopg2.InterfaceError("connection already closed")
+            conn.rollback()
+            cursor = conn.cursor()
+            cursor.execute("DISCARD TEMP;")
+            cursor.close()
+            conn.commit()
+        except Exception as e:
+            logger.warn("Discarding pooled database connection for '{}': {}".format(self._connect_args[2], e))
+            self._discard(conn)
+            return
+        with self._condition:
+            self._idle.append((conn, time.monotonic()))
+            self._condition.notify()
+
+    def _discard(self, conn) -> None:
+        """Close a connection and free its place in the pool"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._size -= 1
+            self.stats["discarded"] += 1
+            self._condition.notify()
+
+    def close(self) -> None:
+        """Close the idle connections (checked out ones are closed when they are released)"""
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for conn, _released in idle:
+            self._discard(conn)
+
+    def pool_stats(self) -> dict:
+        """Current size and the counters"""
+        with self._condition:
+            pool_stats = {"max_size": self.max_size, "size": self._size, "idle": len(self._idle), "in_use": self._size - len(self._idle)}
+        pool_stats.update(self.stats)
+        pool_stats["wait_seconds"] = round(pool_stats["wait_seconds"], 3)
+        return pool_stats
+
+def _database_pool(role:str) -> DatabasePool:
+    """The pool of a role from database_roles, created with the connection settings of the environment"""
+    with _database_pools_lock:
+        if role not in _database_pools:
+            user_var, password_var, _key_var = database_roles[role]
+            _database_pools[role] = DatabasePool(
+                os.getenv("I2B2DBHOST"),
+                os.getenv("I2B2DBNAME"),
+                os.getenv(user_var),
+                os.getenv(password_var),
+                max_size = app.config.get("db_pool_max_size", 4),
+                health_check_seconds = app.config.get("db_pool_health_check_seconds", 60)
+            )
+            logger.debug("Created database connection pool for role '{}'".format(role))
+        return _database_pools[role]
+
+def get_database_connections(timeout:float = None) -> dict:
+    """Check out a pooled connection for each role - the data manager ("dm") and 1 for each scheme
+
+    Return them with release_database_connections when the request is finished (after commit/rollback)
+    :param timeout: Seconds to wait for free connections (of all roles), defaults to config "db_pool_checkout_timeout_seconds"
+    :return: {"dm": conn, <DS_CRC_DB>: conn, <DS_ONT_DB>: conn} - a connection is None if it couldn't be checked out
+    """
+    if timeout is None:
+        timeout = app.config.get("db_pool_checkout_timeout_seconds", 30)
+    deadline = time.perf_counter() + timeout
+    db_conns = {}
+    for role, (_user_var, _password_var, key_var) in database_roles.items():
+        key = os.getenv(key_var) if key_var else role
+        db_conns[key] = _database_pool(role).checkout(max(0, deadline - time.perf_counter()))
+    return db_conns
+
+def release_database_connections(db_conns:dict) -> None:
+    """Return the connections of get_database_connections to their pools"""
+    for role, (_user_var, _password_var, key_var) in database_roles.items():
+        key = os.getenv(key_var) if key_var else role
+        if db_conns.get(key) is not None:
+            _database_pool(role).release(db_conns[key])
+
+def database_pool_stats() -> dict:
+    """Statistics of each role's pool {role: {"max_size", "size", "idle", "in_use", "created", "reused", ...}}"""
+    with _database_pools_lock:
+        pools = dict(_database_pools)
+    return {role: pool.pool_stats() for role, pool in pools.items()}
@@ -41,12 +41,8 @@ def top_elements(connection) -> dict:
     logger.debug("Fetching top-level elements")
     sparql_query = _get_skeleton("query_top_elements")
 
-    fuseki_endpoint = connection["prepared_request"].url
-    ## Simple request using session (for connection pooling/reuse)
-    response = connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, timeout=connection["timeout"])
-    logger.debug("Response (session): {}".format(response.text))
-
-    data = response.json()
+    data = _run_query(connection, sparql_query)
+    logger.debug("Response (session): {}".format(data))
     jsonString = json.dumps(data)
 
     elements:dict = {}
@@ -56,42 +52,158 @@ def top_elements(connection) -> dict:
     logger.debug(jsonString)
     return elements
 
-def getChildren(connection, node_name):
-    """Get all child elements of the given element"""
+def getChildren(connection, node_name, use_cache:bool = True):
+    """Get all child elements of the given element
+
+    :param use_cache: False to always query fuseki (see _run_query)
+    """
     logger.debug("fetching node children for {}".format(node_name))
     sparql_query = _get_skeleton("query_child_elements").replace("TOPELEMENT", "<"+node_name+">")
 
-    fuseki_endpoint = connection["prepared_request"].url
-    response = connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, timeout=connection["timeout"])
-
-    data = response.json()
+    data = _run_query(connection, sparql_query, use_cache = use_cache)
     jsonString = json.dumps(data)
 
-    children:dict = {}
-    for child in data["results"]["bindings"]:
-        children[child["element"]["value"]] = child["type"]["value"]
+    children:dict = _children_in_order([(child["element"]["value"], child["type"]["value"]) for child in data["results"]["bindings"]])
     logger.debug("Found children for '{}': {}".format(node_name, children))
     logger.debug(jsonString)
     return children
 
-def getAttributes(connection, node_uri):
-    """Use single query to get all the useful attributes of the node"""
+def getAllChildren(connection, use_cache:bool = True) -> dict:
+    """Get the child elements of every node in the ontology, using paged queries
+    
+    Uses the same relations as getChildren (skos:narrower, rdf:hasPart, skos:member)
+    :param use_cache: False to always query fuseki (see _run_query)
+    :return: {parent_uri: {child_uri: child_type}}
+    """
+    logger.debug("fetching all node children")
+    sparql_query = _get_skeleton("query_all_child_elements")
+
+    edges:dict = {}
+    edge_count = 0
+    for child in _paged_bindings(connection, sparql_query, use_cache = use_cache):
+        edges.setdefault(child["parent"]["value"], []).append((child["element"]["value"], child["type"]["value"]))
+        edge_count += 1
+    children:dict = {parent_uri: _children_in_order(parent_edges) for parent_uri, parent_edges in edges.items()}
+    logger.info("Found {} hierarchy edges under {} parent nodes".format(edge_count, len(children)))
+    return children
+
+def getAttributes(connection, node_uri, use_cache:bool = True):
+    """Use single query to get all the useful attributes of the node
+
+    :param use_cache: False to always query fuseki (see _run_query)
+    """
     logger.debug("fetching node attributes/properties for {}".format(node_uri))
     sparql_query = _get_skeleton("query_attributes").replace("<CONCEPT>", "<"+node_uri+">")
 
-    fuseki_endpoint = connection["prepared_request"].url
-    response = connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, timeout=connection["timeout"])
-
-    data = response.json()
+    data = _run_query(connection, sparql_query, use_cache = use_cache)
     jsonString = json.dumps(data)
 
+    element = _element_from_binding(node_uri, _first_binding(data["results"]["bindings"]))
+    logger.debug(jsonString)
+    return element
+
+def getAttributesBatch(connection, node_uris:list, batch_size:int = None, use_cache:bool = True) -> dict:
+    """Get the attributes of many nodes, using one query (with a VALUES block) per batch of nodes
+    
+    The bindings are split by concept and processed the same way as getAttributes
+    :param batch_size: Number of nodes per query, defaults to config "fuseki_attribute_batch_size"
+    :param use_cache: False to always query fuseki (see _run_query)
+    :return: {node_uri: element}
+    """
+    if batch_size is None:
+        batch_size = app.config.get("fuseki_attribute_batch_size", 100)
+    elements:dict = {}
+    for start in range(0, len(node_uris), batch_size):
+        batch = node_uris[start : start + batch_size]
+        logger.debug("fetching node attributes/properties for batch of {} nodes".format(len(batch)))
+        sparql_query = _get_skeleton("query_attributes_batch").replace("CONCEPTS", " ".join(["<"+node_uri+">" for node_uri in batch]))
+        data = _run_query(connection, sparql_query, use_cache = use_cache)
+        ## Only the first binding for each concept is used (see _first_binding)
+        first_bindings:dict = _first_bindings(data["results"]["bindings"])
+        for node_uri in batch:
+            if node_uri in first_bindings:
+                elements[node_uri] = _element_from_binding(node_uri, first_bindings[node_uri])
+            else:
+                logger.warn("No attributes in batch result for '{}', querying it alone".format(node_uri))
+                elements[node_uri] = getAttributes(connection, node_uri, use_cache = use_cache)
+    return elements
+
+def getFingerprints(connection, node_uris:list, batch_size:int = None) -> dict:
+    """Get a hash of all statements about each node, to detect which nodes changed since a previous fetch
+    
+    Never read from the response cache, as that would hide the changes. Nodes without any statements are not included
+    :param batch_size: Number of nodes per query, defaults to config "fuseki_attribute_batch_size"
+    :return: {node_uri: fingerprint}
+    """
+    if batch_size is None:
+        batch_size = app.config.get("fuseki_attribute_batch_size", 100)
+    fingerprints:dict = {}
+    for start in range(0, len(node_uris), batch_size):
+        batch = node_uris[start : start + batch_size]
+        logger.debug("fetching node fingerprints for batch of {} nodes".format(len(batch)))
+        sparql_query = _get_skeleton("query_fingerprints_batch").replace("CONCEPTS", " ".join(["<"+node_uri+">" for node_uri in batch]))
+        data = _run_query(connection, sparql_query, use_cache = False)
+        for binding in data["results"]["bindings"]:
+            if "concept" in binding and "fingerprint" in binding:
+                fingerprints[binding["concept"]["value"]] = binding["fingerprint"]["value"]
+    return fingerprints
+
+def getAllAttributes(connection) -> dict:
+    """Get the attributes of every concept and collection in the ontology, using paged queries
+    
+    Each node is processed the same way as getAttributes (see _first_binding)
+    :return: {node_uri: element}
+    """
+    logger.debug("fetching all node attributes/properties")
+    sparql_query = _get_skeleton("query_all_attributes")
+
+    first_bindings:dict = _first_bindings(_paged_bindings(connection, sparql_query))
+    elements:dict = {node_uri: _element_from_binding(node_uri, binding) for node_uri, binding in first_bindings.items()}
+    logger.info("Found attributes for {} nodes".format(len(elements)))
+    return elements
+
+def _children_in_order(child_edges:list) -> dict:
+    """The children of a node from its (child_uri, child_type) edges, sorted by URI and type - the query results are unordered (or sorted
+    differently), so every fetch mode builds the same tree. A child with several types gets the last one
+    """
+    return {child_uri: child_type for child_uri, child_type in sorted(child_edges)}
+
+## Variables of the attribute queries, in the order they decide which binding of a node is used
+_binding_vars:list = ["prefLabel", "displayLabel", "description", "datatype", "display", "notations", "units"]
+
+def _first_binding(bindings) -> dict:
+    """The binding of a node used for its attributes - the smallest by the values of _binding_vars, so it doesn't depend on the order
+    of the results (a node with several labels in a language has a binding for each)
+    """
+    first_binding:dict = None
+    for binding in bindings:
+        if first_binding is None or _binding_key(binding) < _binding_key(first_binding):
+            first_binding = binding
+    return first_binding if first_binding is not None else {}
+
+def _first_bindings(bindings) -> dict:
+    """The binding used for each concept of a multi-concept result (see _first_binding) {node_uri: binding}"""
+    first_bindings:dict = {}
+    for binding in bindings:
+        if "concept" in binding:
+            node_uri = binding["concept"]["value"]
+            if node_uri not in first_bindings or _binding_key(binding) < _binding_key(first_bindings[node_uri]):
+                first_bindings[node_uri] = binding
+    return first_bindings
+
+def _binding_key(binding:dict) -> tuple:
+    """Sort key of a binding of the attribute queries (unbound variables are empty)"""
+    return tuple(binding[var]["value"] if var in binding else "" for var in _binding_vars)
+
+def _element_from_binding(node_uri:str, binding:dict) -> dict:
+    """Convert a result binding of the attributes query to the element dict for the node"""
+    element:dict = {}
     try:
-        element:dict = {}
         element["name"] = getName(node_uri)
         singles_from_query = ["prefLabel", "displayLabel", "display", "datatype", "description"]
         for attrib in singles_from_query:
-            if attrib in data["results"]["bindings"][0] and data["results"]["bindings"][0][attrib]["value"] != "":
-                element[attrib] = _clean_label(data["results"]["bindings"][0][attrib]["value"])
+            if attrib in binding and binding[attrib]["value"] != "":
+                element[attrib] = _clean_label(binding[attrib]["value"])
             else:
                 logger.warn("No '{}' available for node: {}".format(attrib, node_uri))
                 element[attrib] = None
@@ -99,10 +211,12 @@ def getAttributes(connection, node_uri):
         lists_from_query = ["notations", "units"]
         ## NOTE: List delimiter in query is hard-coded as semi-colon ; TODO: Use a config and .replace()
         for attrib in lists_from_query:
-            if attrib in data["results"]["bindings"][0]:
+            if attrib in binding:
                 ## TODO: Adjust query to get the tag and add that as the value
-                element[attrib] = {_clean_label(k):None for k in data["results"]["bindings"][0][attrib]["value"].strip("[]").split(";")}
-                # element[attrib] = _clean_label(data["results"]["bindings"][0][attrib]["value"])
+                ## The order of group_concat is undefined (it can differ between the queries of the fetch modes), so the values are sorted
+                values = "; ".join(sorted(binding[attrib]["value"].strip("[]").split("; ")))
+                element[attrib] = {_clean_label(k):None for k in values.split(";")}
+                # element[attrib] = _clean_label(binding[attrib]["value"])
             else:
                 logger.warn("No '{}' available for node: {}".format(attrib, node_uri))
                 element[attrib] = None
@@ -110,10 +224,45 @@ def getAttributes(connection, node_uri):
     except Exception as e:
         logger.error("Error processing attributes from query for concept: {}!\n{}".format(node_uri, e))
     finally:
-        logger.debug(jsonString)
         logger.debug("Node data: {}".format(element))
     return element
 
+def _run_query(connection, sparql_query:str, use_cache:bool = True) -> dict:
+    """Send the query to the fuseki endpoint of the connection and return the decoded json response
+    
+    When the connection has a "cache", responses are read from and stored in it ("cache_mode" "refresh" skips reading)
+    :param use_cache: False to always query fuseki (the response is still stored)
+    """
+    fuseki_endpoint = connection["prepared_request"].url
+    response_cache = connection.get("cache")
+    if response_cache is not None and use_cache and connection.get("cache_mode") != "refresh":
+        data = response_cache.get(fuseki_endpoint, sparql_query)
+        if data is not None:
+            return data
+    ## Simple request using session (for connection pooling/reuse)
+    response = connection["session"].get(fuseki_endpoint, params={"query": sparql_query}, timeout=connection["timeout"])
+    data = response.json()
+    if response_cache is not None and response.ok:
+        response_cache.put(fuseki_endpoint, sparql_query, data)
+    return data
+
+def _paged_bindings(connection, sparql_query:str, page_size:int = None, use_cache:bool = True):
+    """Generator for all bindings of a (sorted) query, fetched page by page with LIMIT/OFFSET
+
+    :param use_cache: False to always query fuseki (see _run_query)
+    """
+    if page_size is None:
+        page_size = app.config.get("fuseki_page_size", 10000)
+    offset = 0
+    while True:
+        logger.debug("Fetching page of bindings (offset: {}, limit: {})".format(offset, page_size))
+        data = _run_query(connection, "{}\nLIMIT {}\nOFFSET {}".format(sparql_query, page_size, offset), use_cache = use_cache)
+        bindings = data["results"]["bindings"]
+        yield from bindings
+        if len(bindings) < page_size:
+            break
+        offset += page_size
+
 def _clean_label(label:str) -> str:
     """Clean charachters we don't want in the database"""
     if label is None:
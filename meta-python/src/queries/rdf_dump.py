@@ -0,0 +1,156 @@
+""" rdf_dump.py
+Read a local RDF export of CoMetaR (Turtle or N-Triples) instead of querying fuseki
+Produces the same structures as the bulk queries (top elements, children and attributes) so the trees can be built the same way
+"""
+from flask import current_app as app
+
+import logging
+logger = logging.getLogger(__name__)
+
+import rdflib
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+from typing import Tuple
+from queries import queries
+
+SKOS = "http://www.w3.org/2004/02/skos/core#"
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+DZL = "http://data.dzl.de/ont/dwh#"
+DC = "http://purl.org/dc/elements/1.1/"
+DWH = "http://sekmi.de/histream/dwh#"
+
+## Same mapping as the BIND in query_attributes (any other restriction is a "string")
+restriction_datatypes:dict = {
+    DWH + "integerRestriction": "integer",
+    DWH + "floatRestriction": "float",
+    DWH + "partialDateRestriction": "partialDate",
+    DWH + "largeStringRestriction": "largeString",
+    DWH + "dateRestriction": "date",
+}
+
+class DumpSink(object):
+    """Collect the statements needed for the trees while the dump is parsed - everything else is dropped"""
+
+    def __init__(self) -> None:
+        """Empty collections, keyed by subject uri"""
+        self.types:dict = {}
+        self.narrower:dict = {}
+        self.has_part:dict = {}
+        self.members:dict = {}
+        self.top_level_nodes:list = []
+        self.scheme_top_concepts:list = []
+        ## {uri: {property: [values]}} and {uri: {property: {lang: [values]}}}
+        self.values:dict = {}
+        self.lang_values:dict = {}
+        self.triple_count = 0
+
+    def triple(self, s, p, o) -> None:
+        """Called for each statement by the N-Triples parser"""
+        self.triple_count += 1
+        if isinstance(s, rdflib.BNode):
+            return
+        s = str(s)
+        p = str(p)
+        if p == RDF + "type":
+            self.types.setdefault(s, set()).add(str(o))
+        elif p == SKOS + "narrower":
+            self.narrower.setdefault(s, []).append(str(o))
+        elif p == RDF + "hasPart":
+            self.has_part.setdefault(s, []).append(str(o))
+        elif p == SKOS + "member":
+            self.members.setdefault(s, []).append(str(o))
+        elif p == DZL + "topLevelNode":
+            self.top_level_nodes.append(str(o))
+        elif p == SKOS + "topConceptOf" and str(o) == DZL + "Scheme":
+            self.scheme_top_concepts.append(s)
+        elif p in [SKOS + "prefLabel", DZL + "displayLabel", DC + "description"]:
+            if isinstance(o, rdflib.Literal) and o.language in ["en", "de"]:
+                self.lang_values.setdefault(s, {}).setdefault(p, {}).setdefault(o.language, []).append(str(o))
+        elif p in [DWH + "display", SKOS + "notation", DZL + "unit", DWH + "restriction"]:
+            self.values.setdefault(s, {}).setdefault(p, []).append(str(o))
+
+    def is_a(self, uri:str, rdf_type:str) -> bool:
+        """Check for an rdf:type statement"""
+        return SKOS + rdf_type in self.types.get(uri, ())
+
+def read_dump(dump_path:str) -> Tuple[dict, dict, dict]:
+    """Parse the dump in a single pass and derive the top elements, children and attributes
+
+    N-Triples (.nt) are streamed, other formats (eg Turtle) are parsed by rdflib into a graph first
+    :return: top_elements {node_uri: node_type}, all_children {parent_uri: {child_uri: child_type}} and all_attributes {node_uri: element}
+    """
+    logger.info("Reading RDF dump: {}".format(dump_path))
+    sink = DumpSink()
+    if dump_path.endswith(".nt"):
+        with open(dump_path, "rb") as f:
+            W3CNTriplesParser(sink).parse(f)
+    else:
+        graph = rdflib.Graph()
+        graph.parse(dump_path, format = rdflib.util.guess_format(dump_path))
+        for s, p, o in graph:
+            sink.triple(s, p, o)
+    logger.info("Read {} statements from RDF dump".format(sink.triple_count))
+
+    top_elements = _top_elements(sink)
+    all_children:dict = {}
+    all_attributes:dict = {}
+    pending = list(top_elements.keys())
+    while len(pending) > 0:
+        node_uri = pending.pop()
+        if node_uri in all_attributes:
+            continue
+        all_attributes[node_uri] = _attributes(sink, node_uri)
+        all_children[node_uri] = _children(sink, node_uri)
+        pending.extend(all_children[node_uri].keys())
+    logger.info("Derived {} top elements and {} nodes from RDF dump".format(len(top_elements), len(all_attributes)))
+    return top_elements, all_children, all_attributes
+
+def _top_elements(sink:DumpSink) -> dict:
+    """Same as query_top_elements"""
+    elements:dict = {}
+    for node_uri in sink.top_level_nodes:
+        if sink.is_a(node_uri, "Concept"):
+            elements[node_uri] = "concept"
+    for node_uri in sink.top_level_nodes:
+        if sink.is_a(node_uri, "Collection"):
+            elements[node_uri] = "collection"
+    for node_uri in sink.scheme_top_concepts:
+        if sink.is_a(node_uri, "Concept"):
+            elements[node_uri] = "concept"
+    return elements
+
+def _children(sink:DumpSink, node_uri:str) -> dict:
+    """Same as query_child_elements (in the order of queries.getChildren)"""
+    child_edges:list = []
+    if sink.is_a(node_uri, "Concept"):
+        for child_uri in sink.narrower.get(node_uri, []):
+            if sink.is_a(child_uri, "Concept"):
+                child_edges.append((child_uri, "concept"))
+        for child_uri in sink.has_part.get(node_uri, []):
+            if sink.is_a(child_uri, "Concept"):
+                child_edges.append((child_uri, "modifier"))
+    if sink.is_a(node_uri, "Collection"):
+        for child_uri in sink.members.get(node_uri, []):
+            if sink.is_a(child_uri, "Collection"):
+                child_edges.append((child_uri, "collection"))
+        for child_uri in sink.members.get(node_uri, []):
+            if sink.is_a(child_uri, "Concept"):
+                child_edges.append((child_uri, "concept"))
+    return queries._children_in_order(child_edges)
+
+def _attributes(sink:DumpSink, node_uri:str) -> dict:
+    """Build the same binding as query_attributes would return, then convert it like getAttributes"""
+    lang_values = sink.lang_values.get(node_uri, {})
+    values = sink.values.get(node_uri, {})
+    binding:dict = {}
+    for attrib, prop in [("prefLabel", SKOS + "prefLabel"), ("displayLabel", DZL + "displayLabel"), ("description", DC + "description")]:
+        by_lang = lang_values.get(prop, {})
+        ## coalesce(en, de, '') - of several labels, the one queries._first_binding uses
+        binding[attrib] = {"value": min(by_lang.get("en") or by_lang.get("de") or [""])}
+    for attrib, prop in [("notations", SKOS + "notation"), ("units", DZL + "unit")]:
+        ## concat('[', group_concat(distinct ...; separator='; '), ']')
+        binding[attrib] = {"value": "[{}]".format("; ".join(dict.fromkeys(values.get(prop, []))))}
+    if DWH + "display" in values:
+        binding["display"] = {"value": min(values[DWH + "display"])}
+    if DWH + "restriction" in values:
+        binding["datatype"] = {"value": min(restriction_datatypes.get(restriction, "string") for restriction in values[DWH + "restriction"])}
+    return queries._element_from_binding(node_uri, binding)
@@ -0,0 +1,48 @@
+""" bench_common.py
+Shared setup for the benchmark scripts in this directory
+
+The scripts are run from a checkout (not the container), they use the same config files as the listener:
+- APP_CONF_PATH and USER_CONF_PATH default to the files in support/config
+- meta-python/src is added to the import path (or BENCH_SRC_DIR, eg to compare with the src of an older checkout)
+"""
+import logging
+import os
+import sys
+import time
+
+import yaml
+
+support_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+src_dir = os.environ.get("BENCH_SRC_DIR", os.path.join(os.path.dirname(support_dir), "src"))
+if src_dir not in sys.path:
+    sys.path.insert(0, src_dir)
+os.environ.setdefault("APP_CONF_PATH", os.path.join(support_dir, "config", "config.yaml"))
+os.environ.setdefault("USER_CONF_PATH", os.path.join(support_dir, "config", "i2b2meta_user_config.yaml"))
+
+## The model logs (and warns about) every node - far too much for a benchmark
+logging.basicConfig(level = os.environ.get("BENCH_LOG_LEVEL", "ERROR"), format = "[%(asctime)s] %(name)s %(levelname)s - %(message)s")
+logger = logging.getLogger("benchmark")
+
+def make_app():
+    """A flask app with the yaml settings loaded in the same order as listener.load_settings (user, then internal)"""
+    from flask import Flask
+    app = Flask("benchmark")
+    for conf_path in [os.environ["USER_CONF_PATH"], os.environ["APP_CONF_PATH"]]:
+        with open(conf_path, "r") as yaml_file:
+            for k, v in yaml.safe_load(yaml_file).items():
+                app.config[k] = v
+    return app
+
+def timed(func, *args, **kwargs):
+    """Run func and return (result, seconds taken)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def report(title:str, rows:list, headers:list) -> None:
+    """Print a simple aligned table"""
+    print("\n{}".format(title))
+    widths = [max(len(str(value)) for value in [header] + [row[i] for row in rows]) for i, header in enumerate(headers)]
+    print("  ".join(str(header).rjust(widths[i]) for i, header in enumerate(headers)))
+    for row in rows:
+        print("  ".join(str(value).rjust(widths[i]) for i, value in enumerate(row)))
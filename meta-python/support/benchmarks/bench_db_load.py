@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+""" bench_db_load.py
+Load the i2b2 csv of a synthetic tree into postgres row by row (INSERT per row) and in bulk (COPY into a staging table + INSERT ... SELECT)
+
+Needs an i2b2 database, with the same environment variables as the listener (I2B2DBHOST, I2B2DBNAME, DB_ADMIN_USER, DB_ADMIN_PASS).
+The rows are loaded into a copy of i2b2metadata.i2b2 in the schema "bench_load", which is dropped afterwards
+
+Run with: python3 bench_db_load.py [nodes] [repeats]   (default: 20000 nodes, 3 repeats)
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+from bench_common import make_app, timed, report
+from bench_node_memory import build_tree
+
+bench_schema = "bench_load"
+
+def main(node_count:int, repeats:int) -> None:
+    from flask import current_app as app
+    import meta
+    from model import MetaNode
+    from queries import connection
+    db_conn = connection.get_database_connection(os.getenv("I2B2DBHOST"), os.getenv("I2B2DBNAME"), os.getenv("DB_ADMIN_USER"), os.getenv("DB_ADMIN_PASS"))
+    if db_conn is None:
+        print("No database connection - set I2B2DBHOST, I2B2DBNAME, DB_ADMIN_USER and DB_ADMIN_PASS")
+        return
+    ## Only the benchmark table, the configured limits are for the real tables
+    app.config["i2b2db_col_limits"] = {}
+    MetaNode.MetaNode.new_run()
+    tree, _created = build_tree(node_count, 50)
+    out_dir = tempfile.mkdtemp(prefix = "bench_db_load_")
+    meta.write_csv_stream([tree], "benchmark", out_dir, workers = 1)
+    csv_path = os.path.join(out_dir, "benchmark.{}.i2b2.csv".format(bench_schema))
+    shutil.copy(os.path.join(out_dir, "benchmark.i2b2metadata.i2b2.csv"), csv_path)
+    cursor = db_conn.cursor()
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS {schema}; DROP TABLE IF EXISTS {schema}.i2b2; CREATE TABLE {schema}.i2b2 (LIKE i2b2metadata.i2b2 INCLUDING ALL);".format(schema = bench_schema))
+    db_conn.commit()
+    rows = []
+    try:
+        for load_mode in ["rows", "copy"]:
+            app.config["db_load_mode"] = load_mode
+            times = []
+            for _i in range(repeats):
+                cursor.execute("TRUNCATE {}.i2b2;".format(bench_schema))
+                db_conn.commit()
+                result, seconds = timed(meta.push_csv_to_database, {"dm": db_conn}, "benchmark", [csv_path], ",")
+                db_conn.commit()
+                times.append(seconds)
+            cursor.execute("SELECT count(*) FROM {}.i2b2;".format(bench_schema))
+            row_count = cursor.fetchone()[0]
+            best = min(times)
+            rows.append([load_mode, result, row_count, "{:.2f}".format(best), round(row_count / best) if best > 0 else 0])
+    finally:
+        db_conn.rollback()
+        cursor.execute("DROP SCHEMA {} CASCADE;".format(bench_schema))
+        db_conn.commit()
+        db_conn.close()
+    report("Loading the csv of {} nodes into postgres (best of {})".format(node_count, repeats), rows, ["db_load_mode", "success", "rows in table", "seconds", "rows/s"])
+
+if __name__ == "__main__":
+    node_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with make_app().app_context():
+        main(node_count, repeats)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+""" bench_derived_fields.py
+Time CSV generation (whole_tree_csv) for deep trees, with and without the finalize pass which caches the derived fields
+
+Without finalize, element_path etc walk up the parent chain for every row, so the time per node grows with the depth.
+With it, the time per node should stay flat as the tree grows. Also checks both give identical CSV lines.
+
+Run with: python3 bench_derived_fields.py [depth ...]   (default depths: 5 10 20 40)
+"""
+import re
+import sys
+
+from bench_common import make_app, timed, report
+
+## Children per level (one of them continues deeper), every third node has 2 notations, the last child has a modifier
+breadth = 20
+
+def build_deep_tree(depth:int):
+    """A top level concept with a chain of depth levels, each with breadth leaf children"""
+    from model import MetaNode
+    def new_node(name:str, parent, node_type:str = "concept", notations:dict = None):
+        return MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#{}".format(name), name = name, node_type = node_type, parent_node = parent,
+            pref_labels = {name: "en"}, display_labels = {"": "en"}, notations = notations or {}, descriptions = {"": "en"}, datatype = "integer", sourcesystem_cd = "benchmark")
+    top = new_node("Deep", None)
+    parent = top
+    for level in range(depth):
+        for i in range(breadth):
+            name = "L{}C{}".format(level, i)
+            notations = {"{}:A".format(name): None, "{}:B".format(name): None} if i % 3 == 0 else {"{}:A".format(name): None}
+            leaf = new_node(name, parent, notations = notations)
+            if i == breadth - 1:
+                new_node("{}M".format(name), leaf, node_type = "modifier", notations = {"{}:M".format(name): None})
+        parent = new_node("L{}".format(level), parent)
+    return top
+
+def main(depths:list) -> None:
+    from model import MetaNode
+    finalize = MetaNode.MetaNode.finalize
+    timestamp = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.0")
+    rows = []
+    for depth in depths:
+        tree = build_deep_tree(depth)
+        node_count = depth * (breadth + 2) + 1
+        MetaNode.MetaNode.finalize = lambda self: None
+        uncached, uncached_seconds = timed(tree.whole_tree_csv)
+        MetaNode.MetaNode.finalize = finalize
+        cached, cached_seconds = timed(tree.whole_tree_csv)
+        identical = timestamp.sub("", str(uncached)) == timestamp.sub("", str(cached))
+        rows.append([depth, node_count, "{:.3f}".format(uncached_seconds), "{:.1f}".format(uncached_seconds / node_count * 1000000),
+            "{:.3f}".format(cached_seconds), "{:.1f}".format(cached_seconds / node_count * 1000000), identical])
+    report("whole_tree_csv without and with finalize (seconds, microseconds per node)", rows, ["depth", "nodes", "dynamic", "us/node", "finalized", "us/node", "identical"])
+
+if __name__ == "__main__":
+    depths = [int(arg) for arg in sys.argv[1:]] or [5, 10, 20, 40]
+    with make_app().app_context():
+        main(depths)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+""" bench_node_memory.py
+Build a synthetic tree (default 500k nodes) shaped like a fetched ontology and report the memory used per node
+
+Memory is measured with tracemalloc, so it includes everything allocated for the nodes (labels, notations etc).
+To compare with another version of the model, point BENCH_SRC_DIR at its src directory, eg from a git worktree:
+    git worktree add /tmp/meta-before <commit>
+    BENCH_SRC_DIR=/tmp/meta-before/meta-python/src python3 bench_node_memory.py
+
+Run with: python3 bench_node_memory.py [node_count] [breadth]   (default: 500000 nodes, 50 children per node)
+"""
+import gc
+import sys
+import tracemalloc
+
+from bench_common import make_app, timed, report, src_dir
+
+def build_tree(node_count:int, breadth:int):
+    """Nodes are added breadth first, each parent gets up to breadth children. Attributes are like those built by meta._element:
+    most nodes have one notation, every 10th has two, every 5th is numeric with a unit. Containers have an empty notation
+    """
+    from model import MetaNode
+    top = MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#Synthetic", name = "Synthetic", node_type = "concept", pref_labels = {"Synthetic tree": "en"},
+        display_labels = {None: "en"}, notations = {"": None}, descriptions = {None: "en"}, units = {"": None}, sourcesystem_cd = "benchmark")
+    parents = [top]
+    created = 1
+    parent_index = 0
+    while created < node_count:
+        parent = parents[parent_index]
+        parent_index += 1
+        for _i in range(min(breadth, node_count - created)):
+            name = "N{}".format(created)
+            if created % 10 == 0:
+                notations = {"S:{}.1".format(created): None, "S:{}.2".format(created): None}
+            else:
+                notations = {"S:{}".format(created): None}
+            if created % 5 == 0:
+                datatype, units = "float", {"kg": None}
+            else:
+                datatype, units = None, {"": None}
+            node = MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#{}".format(name), name = name, node_type = "concept", parent_node = parent,
+                pref_labels = {"Synthetic node {}".format(created): "en"}, display_labels = {None: "en"}, notations = notations, descriptions = {None: "en"},
+                datatype = datatype, units = units, dwh_display_status = None, sourcesystem_cd = "benchmark")
+            parents.append(node)
+            created += 1
+    return top, created
+
+def main(node_count:int, breadth:int) -> None:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    (tree, created), seconds = timed(build_tree, node_count, breadth)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    report("Memory for a synthetic tree (model from {})".format(src_dir), [[created, breadth, "{:.1f}".format(seconds), after - before, "{:.0f}".format((after - before) / created)]],
+        ["nodes", "breadth", "build seconds", "bytes", "bytes/node"])
+    return tree
+
+if __name__ == "__main__":
+    node_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    breadth = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    with make_app().app_context():
+        main(node_count, breadth)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+""" bench_notation_rows.py
+Regression benchmark for concepts with many notations (eg lab code lists): time the csv rows of a single concept with k notations
+
+Each notation gets its own rows (i2b2 and concept_dimension), so the time per notation should stay flat as k grows.
+The concept is measured without children (paths ...\\<index>\\) and with a child (paths ...\\MULTI\\<index>\\), the paths are checked too.
+Compare with an older version of the model with BENCH_SRC_DIR (see bench_common.py)
+
+Run with: python3 bench_notation_rows.py [k ...]   (default: 10 100 500 2000)
+"""
+import sys
+
+from bench_common import make_app, timed, report
+
+def build_concept(notation_count:int, with_child:bool):
+    """A top level concept with notation_count notations, and optionally a child concept"""
+    from model import MetaNode
+    top = MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#Top", name = "Top", node_type = "concept", pref_labels = {"Top": "en"},
+        display_labels = {None: "en"}, notations = {"": None}, descriptions = {None: "en"}, sourcesystem_cd = "benchmark")
+    concept = MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#Lab", name = "Lab", node_type = "concept", parent_node = top, pref_labels = {"Lab codes": "en"},
+        display_labels = {None: "en"}, notations = {"L:{}-{}".format(i, i % 10): None for i in range(notation_count)}, descriptions = {None: "en"}, datatype = "float",
+        units = {"mmol/l": None}, sourcesystem_cd = "benchmark")
+    if with_child:
+        MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#LabChild", name = "LabChild", node_type = "concept", parent_node = concept, pref_labels = {"Child": "en"},
+            display_labels = {None: "en"}, notations = {"L:child": None}, descriptions = {None: "en"}, sourcesystem_cd = "benchmark")
+    return top
+
+def check_paths(rows:list, notation_count:int, with_child:bool) -> bool:
+    """The concept_dimension path of notation i must end with \\<i>\\ (or \\MULTI\\<i>\\ when the concept has children)"""
+    from flask import current_app as app
+    sep = app.config["i2b2_path_separator"]
+    container = app.config["i2b2_multipath_container"] + sep if with_child else ""
+    paths = [row[0] for schema, table, row in rows if table == "concept_dimension" and "Lab" in row[0] and "LabChild" not in row[0]]
+    expected = ["{sep}i2b2{sep}Top{sep}Lab{sep}{container}{i}{sep}".format(sep = sep, container = container, i = i) for i in range(notation_count)]
+    return paths == expected
+
+def main(notation_counts:list) -> None:
+    table_rows = []
+    for with_child in [False, True]:
+        for notation_count in notation_counts:
+            tree = build_concept(notation_count, with_child)
+            rows, seconds = timed(lambda: list(tree.iter_csv_rows()))
+            table_rows.append([notation_count, with_child, len(rows), "{:.3f}".format(seconds), "{:.1f}".format(seconds / notation_count * 1000000), check_paths(rows, notation_count, with_child)])
+    report("Csv rows for a concept with k notations (seconds, microseconds per notation)", table_rows, ["k", "children", "rows", "seconds", "us/notation", "paths ok"])
+
+if __name__ == "__main__":
+    notation_counts = [int(arg) for arg in sys.argv[1:]] or [10, 100, 500, 2000]
+    with make_app().app_context():
+        main(notation_counts)
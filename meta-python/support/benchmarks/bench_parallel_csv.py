@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+""" bench_parallel_csv.py
+Write the csv for a forest of synthetic top level trees with 1 process and with a pool of worker processes, and check the files are identical.
+Also reports the peak memory allocated by the listener process while writing (with tracemalloc, in a separate run), which stays flat as the
+workers stream their rows through part files. A speedup needs as many free CPUs as workers - with fewer, the workers only add overhead
+
+Run with: python3 bench_parallel_csv.py [trees] [nodes_per_tree] [workers ...]   (default: 16 trees, 5000 nodes each, 2 4 8 workers)
+"""
+import filecmp
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from bench_common import make_app, timed, report
+from bench_node_memory import build_tree
+
+def _peak_memory(func, *args, **kwargs) -> float:
+    """Peak memory (MB) allocated by this process while running func"""
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024 / 1024
+
+def main(tree_count:int, nodes_per_tree:int, worker_counts:list) -> None:
+    import meta
+    from model import MetaNode
+    MetaNode.MetaNode.new_run()
+    trees = [build_tree(nodes_per_tree, 50)[0] for _i in range(tree_count)]
+    out_dir = tempfile.mkdtemp(prefix = "bench_parallel_csv_")
+    single_dir = os.path.join(out_dir, "workers-1")
+    _result, single_seconds = timed(meta.write_csv_stream, trees, "benchmark", single_dir, workers = 1)
+    single_files = sorted(os.listdir(single_dir))
+    single_peak = _peak_memory(meta.write_csv_stream, trees, "benchmark", single_dir, workers = 1)
+    rows = [[1, "{:.2f}".format(single_seconds), "1.0x", "{:.1f}".format(single_peak), True]]
+    for workers in worker_counts:
+        workers_dir = os.path.join(out_dir, "workers-{}".format(workers))
+        _result, seconds = timed(meta.write_csv_stream, trees, "benchmark", workers_dir, workers = workers)
+        _match, mismatch, errors = filecmp.cmpfiles(single_dir, workers_dir, single_files, shallow = False)
+        peak = _peak_memory(meta.write_csv_stream, trees, "benchmark", workers_dir, workers = workers)
+        rows.append([workers, "{:.2f}".format(seconds), "{:.1f}x".format(single_seconds / seconds), "{:.1f}".format(peak), len(mismatch) == 0 and len(errors) == 0])
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    report("Csv for {} trees of {} nodes with {} CPUs available, written to {} (seconds)".format(tree_count, nodes_per_tree, cpus, out_dir), rows, ["workers", "seconds", "speedup", "peak MB", "identical"])
+
+if __name__ == "__main__":
+    tree_count = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    nodes_per_tree = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    worker_counts = [int(arg) for arg in sys.argv[3:]] or [2, 4, 8]
+    with make_app().app_context():
+        main(tree_count, nodes_per_tree, worker_counts)
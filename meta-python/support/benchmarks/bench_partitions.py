@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+""" bench_partitions.py
+Compare the plain i2b2 tables with tables list partitioned by source (see partitions): migration, flushing a source, reloading it,
+that a path of one source loaded under another is still dropped (the unique keys without sourcesystem_cd are only enforced per partition) and the plans of typical queries of the i2b2 cells (ONT: children and term info of a path, CRC: concepts below a path)
+
+Needs an i2b2 database, with the same environment variables as the listener (I2B2DBHOST, I2B2DBNAME, DB_ADMIN_USER, DB_ADMIN_PASS).
+Copies of i2b2metadata.i2b2 and i2b2demodata.concept_dimension are created and filled in the schema "bench_partitions", which is dropped afterwards
+
+Run with: python3 bench_partitions.py [sources] [rows per source]   (default: 20 sources, 20000 rows)
+"""
+import json
+import os
+import sys
+
+from bench_common import make_app, timed, report
+
+bench_schema = "bench_partitions"
+## Synthetic rows: a path per row below \i2b2\<source>\ with 10 children per folder, for the NOT NULL columns
+fill_sql:dict = {
+    "i2b2": """
+        INSERT INTO {table} (c_hlevel, c_fullname, c_name, c_synonym_cd, c_visualattributes, c_facttablecolumn, c_tablename, c_columnname, c_columndatatype, c_operator, c_dimcode, m_applied_path, update_date, sourcesystem_cd)
+        SELECT 2 + (n % 3), '\\i2b2\\' || s || '\\' || (n / 10) || '\\' || n || '\\', 'Node ' || n, 'N', 'LA', 'concept_cd', 'concept_dimension', 'concept_path', 'T', 'LIKE',
+            '\\i2b2\\' || s || '\\' || (n / 10) || '\\' || n || '\\', '@', current_timestamp, s
+        FROM generate_series(1, %s) AS n, (SELECT 'source_' || i AS s FROM generate_series(1, %s) AS i) AS sources;
+    """,
+    "concept_dimension": """
+        INSERT INTO {table} (concept_path, concept_cd, name_char, update_date, sourcesystem_cd)
+        SELECT '\\i2b2\\' || s || '\\' || (n / 10) || '\\' || n || '\\', s || ':' || n, 'Node ' || n, current_timestamp, s
+        FROM generate_series(1, %s) AS n, (SELECT 'source_' || i AS s FROM generate_series(1, %s) AS i) AS sources;
+    """,
+}
+## Queries of the cells, with the path of one source
+cell_queries:dict = {
+    "i2b2": [
+        ("ONT children", "SELECT c_fullname, c_name, c_visualattributes FROM {table} WHERE c_fullname LIKE %s AND c_hlevel = 3;", "\\i2b2\\source_1\\1\\%"),
+        ("ONT term info", "SELECT c_fullname, c_name, c_visualattributes FROM {table} WHERE c_fullname = %s;", "\\i2b2\\source_1\\1\\15\\"),
+    ],
+    "concept_dimension": [
+        ("CRC concepts of a path", "SELECT concept_cd FROM {table} WHERE concept_path LIKE %s;", "\\i2b2\\source_1\\1\\%"),
+    ],
+}
+
+def _plan(cursor, sql:str, param:str) -> dict:
+    """Planning/execution time and the number of scanned relations of a query"""
+    cursor.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + sql, [param])
+    result = cursor.fetchone()[0]
+    explain = result[0] if isinstance(result, list) else json.loads(result)[0]
+    scans = []
+    def _scans(node:dict):
+        if "Relation Name" in node:
+            scans.append(node["Relation Name"])
+        for child in node.get("Plans", []):
+            _scans(child)
+    _scans(explain["Plan"])
+    return {"planning": explain["Planning Time"], "execution": explain["Execution Time"], "scans": len(scans)}
+
+def main(source_count:int, row_count:int) -> None:
+    import partitions
+    from queries import connection
+    db_conn = connection.get_database_connection(os.getenv("I2B2DBHOST"), os.getenv("I2B2DBNAME"), os.getenv("DB_ADMIN_USER"), os.getenv("DB_ADMIN_PASS"))
+    if db_conn is None:
+        print("No database connection - set I2B2DBHOST, I2B2DBNAME, DB_ADMIN_USER and DB_ADMIN_PASS")
+        return
+    cursor = db_conn.cursor()
+    migration_rows = []
+    duplicate_rows = []
+    flush_rows = []
+    query_rows = []
+    try:
+        cursor.execute("DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema};".format(schema = bench_schema))
+        for table, source_table in [("i2b2", "i2b2metadata.i2b2"), ("concept_dimension", "i2b2demodata.concept_dimension")]:
+            plain_table = "{}.{}".format(bench_schema, table)
+            part_table = "{}.{}_part".format(bench_schema, table)
+            for bench_table in [plain_table, part_table]:
+                cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING ALL);".format(bench_table, source_table))
+                cursor.execute(fill_sql[table].format(table = bench_table), [row_count, source_count])
+            db_conn.commit()
+            results, seconds = timed(partitions.migrate, {"dm": db_conn}, [part_table])
+            db_conn.commit()
+            migration_rows.append([table, results[part_table]["rows"], results[part_table]["partitions"], "{:.2f}".format(seconds)])
+
+            ## A row of source_1 loaded under source_2 - dropped by ON CONFLICT in the plain table, by drop_cross_source_duplicates in the partitioned one
+            cursor.execute("CREATE TEMP TABLE duplicate AS SELECT * FROM {} WHERE sourcesystem_cd = 'source_1' LIMIT 1;".format(plain_table))
+            cursor.execute("UPDATE duplicate SET sourcesystem_cd = 'source_2';")
+            cursor.execute("INSERT INTO {} SELECT * FROM duplicate ON CONFLICT DO NOTHING;".format(plain_table))
+            plain_inserted = cursor.rowcount
+            cursor.execute("INSERT INTO {} SELECT * FROM duplicate ON CONFLICT DO NOTHING;".format(part_table))
+            part_inserted = cursor.rowcount - partitions.drop_cross_source_duplicates(cursor, part_table, "source_2", part_table)
+            cursor.execute("DROP TABLE duplicate;")
+            cursor.execute("SELECT count(*) FROM pg_constraint c JOIN pg_inherits h ON h.inhrelid = c.conrelid WHERE h.inhparent = %s::regclass AND c.contype = 'p';", [part_table])
+            partition_pks = cursor.fetchone()[0]
+            db_conn.commit()
+            duplicate_rows.append([table, partitions.cross_source_keys(cursor, part_table), plain_inserted, part_inserted, partition_pks])
+            cursor.execute("ANALYZE {}; ANALYZE {};".format(plain_table, part_table))
+            db_conn.commit()
+
+            ## Flush a source and load it again (with generated rows)
+            source_id = "source_2"
+            partition = "{}.{}".format(bench_schema, partitions.partition_name("{}_part".format(table), source_id))
+            _result, delete_seconds = timed(cursor.execute, "DELETE FROM {} WHERE sourcesystem_cd = %s;".format(plain_table), [source_id])
+            _result, truncate_seconds = timed(cursor.execute, "TRUNCATE {};".format(partition))
+            db_conn.commit()
+            cursor.execute("CREATE TEMP TABLE reload AS SELECT * FROM {} LIMIT 0;".format(plain_table))
+            cursor.execute(fill_sql[table].format(table = "reload"), [row_count, 1])
+            cursor.execute("UPDATE reload SET sourcesystem_cd = %s;", [source_id])
+            _result, plain_load_seconds = timed(cursor.execute, "INSERT INTO {} SELECT * FROM reload ON CONFLICT DO NOTHING;".format(plain_table))
+            _result, partition_load_seconds = timed(cursor.execute, "INSERT INTO {} SELECT * FROM reload ON CONFLICT DO NOTHING;".format(partition))
+            cursor.execute("DROP TABLE reload;")
+            db_conn.commit()
+            ## The DELETE leaves dead rows in the plain table until it is vacuumed
+            cursor.execute("SELECT pg_total_relation_size(%s), (SELECT sum(pg_total_relation_size(relid)) FROM pg_partition_tree(%s));", [plain_table, part_table])
+            plain_bytes, partitioned_bytes = cursor.fetchone()
+            flush_rows.append([table, "{:.3f}".format(delete_seconds), "{:.3f}".format(truncate_seconds), "{:.3f}".format(plain_load_seconds), "{:.3f}".format(partition_load_seconds), plain_bytes, partitioned_bytes])
+
+            for name, sql, param in cell_queries[table]:
+                for layout, bench_table in [("plain", plain_table), ("partitioned", part_table)]:
+                    ## The first run warms the cache
+                    _plan(cursor, sql.format(table = bench_table), param)
+                    plan = _plan(cursor, sql.format(table = bench_table), param)
+                    query_rows.append([name, layout, plan["scans"], "{:.3f}".format(plan["planning"]), "{:.3f}".format(plan["execution"])])
+            db_conn.rollback()
+    finally:
+        db_conn.rollback()
+        cursor.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(bench_schema))
+        db_conn.commit()
+        db_conn.close()
+    report("Migration of {} sources with {} rows each".format(source_count, row_count), migration_rows, ["table", "rows", "partitions", "seconds"])
+    report("A path of source_1 loaded under source_2 (rows inserted, should be 0 for both)", duplicate_rows, ["table", "unique keys per partition", "plain", "partitioned", "partitions with a primary key"])
+    report("Flushing and reloading one source", flush_rows, ["table", "DELETE s", "TRUNCATE s", "load plain s", "load partition s", "plain bytes", "partitioned bytes"])
+    report("Queries of the i2b2 cells (EXPLAIN ANALYZE, ms)", query_rows, ["query", "layout", "relations scanned", "planning", "execution"])
+
+if __name__ == "__main__":
+    source_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    row_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    with make_app().app_context():
+        main(source_count, row_count)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+""" bench_wide_nodes.py
+Build very wide nodes (eg code lists with thousands of members) and time adding the children
+
+Compares MetaNode.add_child with the previous implementation (append, then list(set()) on every add - quadratic, hash ordered)
+and checks that the children keep their insertion order, so the CSV is the same on every run.
+
+Run with: python3 bench_wide_nodes.py [width ...]   (default widths: 1000 5000 20000)
+"""
+import re
+import sys
+
+from bench_common import make_app, timed, report
+
+def legacy_add_child(self, child_node) -> None:
+    """add_child as it was before insertion ordering"""
+    self.child_nodes.append(child_node)
+    self.child_nodes = list(set(self.child_nodes))
+
+def build_wide_node(width:int):
+    """A top level concept with width children, each with its own notation"""
+    from model import MetaNode
+    parent = MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#Wide", name = "Wide", node_type = "concept", pref_labels = {"Wide node": "en"},
+        display_labels = {"": "en"}, notations = {}, descriptions = {"": "en"}, sourcesystem_cd = "benchmark")
+    for i in range(width):
+        MetaNode.MetaNode(node_uri = "http://data.dzl.de/ont/dwh#Code{}".format(i), name = "Code{}".format(i), node_type = "concept", parent_node = parent,
+            pref_labels = {"Code {}".format(i): "en"}, display_labels = {"": "en"}, notations = {"C:{:06d}".format(i): None}, descriptions = {"": "en"}, sourcesystem_cd = "benchmark")
+    return parent
+
+def main(widths:list) -> None:
+    from model import MetaNode
+    current_add_child = MetaNode.MetaNode.add_child
+    rows = []
+    for width in widths:
+        MetaNode.MetaNode.add_child = legacy_add_child
+        legacy_node, legacy_seconds = timed(build_wide_node, width)
+        legacy_in_order = [child.name for child in legacy_node.child_nodes] == ["Code{}".format(i) for i in range(width)]
+        MetaNode.MetaNode.add_child = current_add_child
+        node, seconds = timed(build_wide_node, width)
+        in_order = [child.name for child in node.child_nodes] == ["Code{}".format(i) for i in range(width)]
+        ## Adding an existing child again must not duplicate it
+        node.add_child(node.child_nodes[0])
+        assert len(node.child_nodes) == width
+        rows.append([width, "{:.3f}".format(legacy_seconds), legacy_in_order, "{:.3f}".format(seconds), in_order, "{:.1f}x".format(legacy_seconds / seconds)])
+    report("Building a node with <width> children (seconds)", rows, ["width", "list(set())", "ordered", "add_child", "ordered", "speedup"])
+
+    ## Two builds of the same tree must give identical csv lines (apart from the fetch timestamp)
+    timestamp = re.compile(r"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.0")
+    first = build_wide_node(widths[0]).whole_tree_csv()
+    second = build_wide_node(widths[0]).whole_tree_csv()
+    reproducible = [timestamp.sub("", str(first[schema][table])) == timestamp.sub("", str(second[schema][table])) for schema in first for table in first[schema]]
+    print("\nCSV lines identical between builds: {}".format(all(reproducible)))
+
+if __name__ == "__main__":
+    widths = [int(arg) for arg in sys.argv[1:]] or [1000, 5000, 20000]
+    with make_app().app_context():
+        main(widths)
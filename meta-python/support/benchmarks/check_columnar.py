@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+""" check_columnar.py
+Check that the typed intermediate files (see columnar) hold the same values as the csv, for the timestamp formats the csv can contain
+
+The timestamps are always parsed, the round trip through write_tables/read_table needs pyarrow and is skipped without it.
+Exits with 1 when a value differs
+
+Run with: python3 check_columnar.py
+"""
+import datetime
+import os
+import sys
+import tempfile
+
+from bench_common import make_app
+
+## Timestamp values of the csv and the value expected in the file (None for the time of loading)
+timestamps:list = [
+    ("2023-01-02 03:04:05.0", datetime.datetime(2023, 1, 2, 3, 4, 5)),
+    ("2023-01-02 03:04:05", datetime.datetime(2023, 1, 2, 3, 4, 5)),
+    ("2023-01-02T03:04:05", datetime.datetime(2023, 1, 2, 3, 4, 5)),
+    ("2023-01-02 03:04:05.123", datetime.datetime(2023, 1, 2, 3, 4, 5, 123000)),
+    ("2023-01-02 03:04:05.1234567", datetime.datetime(2023, 1, 2, 3, 4, 5, 123456)),
+    ("2023-01-02 03:04:05.5+02:00", datetime.datetime(2023, 1, 2, 3, 4, 5, 500000)),
+    ("2023-01-02", datetime.datetime(2023, 1, 2)),
+    ("current_timestamp", None),
+    ("", None),
+]
+
+def check_parse() -> list:
+    """Values of _convert which differ from the expected ones"""
+    import columnar
+    failures = []
+    for value, expected in timestamps:
+        converted = columnar._convert(value, "download_date", "timestamp without time zone", "check")
+        if converted != expected:
+            failures.append("parse '{}': {} (expected {})".format(value, converted, expected))
+    try:
+        columnar.parse_timestamp("02.01.2023")
+        failures.append("parse '02.01.2023': no error")
+    except ValueError:
+        pass
+    return failures
+
+def check_round_trip(file_format:str) -> list:
+    """Values read back from a file of write_tables which differ from the expected ones"""
+    import columnar
+    cols = ["c_hlevel", "c_fullname", "update_date", "download_date", "sourcesystem_cd"]
+    rows = [["1", "\\check\\{}\\".format(i), "current_timestamp", value, ""] for i, (value, _expected) in enumerate(timestamps)]
+    load_time = datetime.datetime(2024, 5, 6, 7, 8, 9)
+    failures = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        if not columnar.write_tables([{"i2b2metadata": {"i2b2": rows}}], "check", out_dir, file_format, {"i2b2metadata.i2b2": cols}):
+            return ["{}: write_tables failed".format(file_format)]
+        table = columnar.read_table(os.path.join(out_dir, "check.i2b2metadata.i2b2{}".format(columnar.file_extensions[file_format])))
+        for row, (value, expected) in zip(columnar.table_rows(table, load_time), timestamps):
+            if row["download_date"] != expected:
+                failures.append("{} '{}': {} (expected {})".format(file_format, value, row["download_date"], expected))
+            if row["update_date"] != load_time or row["sourcesystem_cd"] != "check":
+                failures.append("{} '{}': {}".format(file_format, value, row))
+    return failures
+
+def main() -> int:
+    import columnar
+    failures = check_parse()
+    if columnar.available():
+        for file_format in columnar.file_extensions:
+            failures += check_round_trip(file_format)
+    else:
+        print("pyarrow is not installed - skipping the round trip through the files")
+    for failure in failures:
+        print(failure)
+    print("{} failures".format(len(failures)))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    with make_app().app_context():
+        sys.exit(main())
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+""" check_fetch_modes.py
+Check that every fuseki_fetch_mode builds the same trees: the csv files of the recursive, bulk, concurrent and incremental fetch
+(and of an rdf_dump of the same data) must be identical, row order included
+
+The queries are read from /src/resources, as in the container. Pass a fuseki endpoint, or a local RDF file (Turtle or N-Triples),
+whose queries are then answered by rdflib instead of fuseki. The response cache isn't used. Exits with 1 when the files differ
+
+Run with: python3 check_fetch_modes.py <fuseki endpoint | RDF file>
+"""
+import json
+import os
+import re
+import sys
+import tempfile
+
+from bench_common import make_app
+
+fetch_modes:list = ["recursive", "bulk", "concurrent", "incremental"]
+## The time of the run (download date, creation date of the value metadata) differs between fetches
+_timestamp_pattern = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.0")
+
+class _GraphResponse:
+    """The parts of a requests response which queries._run_query uses"""
+    def __init__(self, data:dict):
+        self.ok = True
+        self._data = data
+
+    def json(self) -> dict:
+        return self._data
+
+class _GraphSession:
+    """Answers the queries of a fuseki connection from an rdflib graph (for a local RDF file)"""
+    def __init__(self, graph):
+        import threading
+        from rdflib.plugins.sparql import aggregates
+        from rdflib.plugins.sparql.sparql import NotBoundError
+        self.graph = graph
+        self.lock = threading.Lock()
+        ## rdflib raises for a DISTINCT aggregate (the group_concat of the notations) over an unbound variable, fuseki skips it
+        use_row = aggregates.Accumulator.use_row
+        def _use_bound_row(accumulator, row) -> bool:
+            try:
+                return use_row(accumulator, row)
+            except NotBoundError:
+                return False
+        if not getattr(use_row, "skips_unbound", False):
+            _use_bound_row.skips_unbound = True
+            aggregates.Accumulator.use_row = _use_bound_row
+
+    def get(self, url:str, params:dict = None, timeout = None) -> _GraphResponse:
+        with self.lock:
+            return _GraphResponse(json.loads(self.graph.query(params["query"]).serialize(format = "json")))
+
+def _write_csv(trees:list, out_dir:str) -> None:
+    """Write the csv files of the trees"""
+    import meta
+    meta.write_csv_stream(trees, "check", out_dir, workers = 1)
+
+def _differences(expected_path:str, actual_path:str) -> int:
+    """Number of lines which differ between two csv files, ignoring the time of the run"""
+    if not os.path.isfile(actual_path):
+        return 1
+    with open(expected_path, "r", encoding = "utf-8") as expected_file, open(actual_path, "r", encoding = "utf-8") as actual_file:
+        expected_lines = [_timestamp_pattern.sub("<time>", line) for line in expected_file]
+        actual_lines = [_timestamp_pattern.sub("<time>", line) for line in actual_file]
+    return sum(1 for expected, actual in zip(expected_lines, actual_lines) if expected != actual) + abs(len(expected_lines) - len(actual_lines))
+
+def main(source:str) -> int:
+    from flask import current_app as app
+    import meta
+    from queries import connection
+    app.config["sparql_cache_directory"] = ""
+    work_dir = tempfile.mkdtemp(prefix = "check_fetch_modes_")
+    app.config["dynamic_metadata_directory"] = work_dir
+    endpoint = source
+    if os.path.isfile(source):
+        import rdflib
+        graph = rdflib.Graph()
+        graph.parse(source)
+        connection._get_request_session = lambda pool_size = None: _GraphSession(graph)
+        endpoint = "http://localhost/check/query"
+    out_dirs:dict = {}
+    for fetch_mode in fetch_modes:
+        fetch_stats = {}
+        trees = meta.pull_fuseki_datatree(endpoint, "check", fetch_mode = fetch_mode, cache_mode = "bypass", fetch_stats = fetch_stats)["check"]
+        out_dirs[fetch_mode] = os.path.join(work_dir, fetch_mode)
+        print("{}: {} trees, {}".format(fetch_mode, len(trees), fetch_stats))
+        _write_csv(trees, out_dirs[fetch_mode])
+    ## The second incremental fetch keeps the unchanged nodes of the first
+    trees = meta.pull_fuseki_datatree(endpoint, "check", fetch_mode = "incremental", cache_mode = "bypass")["check"]
+    out_dirs["incremental (again)"] = os.path.join(work_dir, "incremental_again")
+    _write_csv(trees, out_dirs["incremental (again)"])
+    if os.path.isfile(source):
+        trees = meta.pull_rdf_dump_datatree(source, "check")["check"]
+        out_dirs["rdf_dump"] = os.path.join(work_dir, "rdf_dump")
+        _write_csv(trees, out_dirs["rdf_dump"])
+    differences = 0
+    file_names = sorted(os.listdir(out_dirs["recursive"]))
+    for mode, out_dir in out_dirs.items():
+        if mode == "recursive":
+            continue
+        for file_name in file_names:
+            line_differences = _differences(os.path.join(out_dirs["recursive"], file_name), os.path.join(out_dir, file_name))
+            if line_differences > 0:
+                print("{} differs from recursive: {} ({} lines)".format(mode, file_name, line_differences))
+                differences += 1
+    print("{} files of {} fetch modes compared with recursive, {} differ (output in {})".format(len(file_names), len(out_dirs) - 1, differences, work_dir))
+    return 1 if differences > 0 else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(2)
+    with make_app().app_context():
+        sys.exit(main(sys.argv[1]))
@@ -8,6 +8,11 @@ Please use CSV files with a headers line
 
 Run in windows with something like (from the dir with csv exports):
 ```/c/Program\ Files/Python39/python ~/projects/worktrees/i2b2-meta-python/meta-python/support/compareCsv.py```
+
+With --diff the exports are compared directly (streaming, in bounded memory) instead of writing sorted "slim" files:
+```python compareCsv.py --diff [--old dzl] [--new local] [--key i2b2metadata.i2b2=c_fullname,m_applied_path] [--partitions 64] [--workers 4]```
+The rows of each table are hash partitioned by their key columns into temporary files, then one partition at a time is compared.
+Added, removed and changed rows (with the changed columns) are written to <table>.diff.csv and counted in the log
 """
 
 import logging
@@ -19,7 +24,11 @@ with open("{}/config/scriptlog.yaml".format(os.path.dirname(os.path.realpath(__f
 logging.config.dictConfig(log_config)
 logger = logging.getLogger(__name__)
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import csv
+import tempfile
+import zlib
 
 ## TODO:
 # Currently hard coded ; as csv delimiter
@@ -42,6 +51,16 @@ table_cols_to_keep:dict = {
     "i2b2demodata.modifier_dimension": ["modifier_path", "modifier_cd", "name_char", "modifier_blob", "upload_id"]
 }
 
+## Columns identifying a row of each table, for --diff (rows with the same key are compared column by column)
+table_key_cols:dict = {
+    "i2b2metadata.i2b2": ["c_fullname", "m_applied_path"],
+    "i2b2metadata.table_access": ["c_fullname"],
+    "i2b2demodata.concept_dimension": ["concept_path"],
+    "i2b2demodata.modifier_dimension": ["modifier_path"]
+}
+## Number of partition files per table and side for --diff - memory use is about the size of 1 partition of both sides
+diff_partitions:int = 64
+
 def trim_data(source_label:str, source_cd:str, table_cols_to_keep:dict[str:list[str]], suffix:str, dir:str = None):
     """Read and re-write CSV files with fewer columns and fewer rows (by selecting only the same source)"""
     logger.debug("Current dir: {}".format(os.getcwd()))
@@ -92,14 +111,143 @@ def trim_data(source_label:str, source_cd:str, table_cols_to_keep:dict[str:list[
         logger.debug("Writing for '{}' complete...".format(out_file))
         os.system("rm *.temp.*")
 
+def _source_rows(source_label:str, source_cd:str, table_name:str, cols:list[str]):
+    """Generator for the (stripped) comparable columns of the rows of a table export - selected by source as in trim_data"""
+    in_file = "{}.{}.csv".format(source_label, table_name)
+    with open(in_file, 'r', encoding='utf-8') as base:
+        reader = csv.DictReader(base, skipinitialspace=True, delimiter = global_csv_delimiter)
+        output_fields = [x for x in cols if x in reader.fieldnames]
+        for line in reader:
+            if (
+                    "sourcesystem_cd" in line and source_cd in line["sourcesystem_cd"]
+                ) or (
+                    "c_table_cd" in line and source_cd in line["c_table_cd"]
+                ) or (
+                    table_name == "i2b2metadata.table_access"
+                ):
+                yield {k:(line[k] or "").strip() for k in output_fields}
+
+def _partition_rows(source_label:str, source_cd:str, table_name:str, cols:list[str], key_cols:list[str], partitions:int, partition_dir:str) -> int:
+    """Write the rows of a table export into partition files, by a (stable) hash of their key
+
+    :return: Number of rows
+    """
+    files = [open(os.path.join(partition_dir, "{}.{}.part{}.csv".format(source_label, table_name, i)), 'w', encoding='utf-8', newline='') for i in range(partitions)]
+    writers = [csv.writer(f) for f in files]
+    row_count = 0
+    try:
+        for row in _source_rows(source_label, source_cd, table_name, cols):
+            key = "\x1f".join(row.get(k, "") for k in key_cols)
+            writers[zlib.crc32(key.encode('utf-8')) % partitions].writerow([row.get(col, "") for col in cols])
+            row_count += 1
+    finally:
+        for f in files:
+            f.close()
+    return row_count
+
+def _read_partition(path:str, cols:list[str], key_cols:list[str]) -> dict:
+    """Read a partition file as {key: [rows]} - a key can have several rows"""
+    rows:dict = {}
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for values in csv.reader(f):
+            row = dict(zip(cols, values))
+            rows.setdefault(tuple(row[k] for k in key_cols), []).append(row)
+    return rows
+
+def diff_table(table_name:str, old_label:str, old_cd:str, new_label:str, new_cd:str, cols:list[str], key_cols:list[str], partitions:int = None, out_dir:str = ".") -> dict:
+    """Compare a table between 2 exports, in bounded memory
+
+    Both exports are hash partitioned by the key columns, then each pair of partitions is compared in memory.
+    Rows whose key is only in the new export are "added", only in the old "removed", otherwise the columns are compared ("changed").
+    Where a key has several rows, identical rows are matched first and the rest are compared in order
+    :return: Counts {"old_rows", "new_rows", "added", "removed", "changed", "unchanged"}
+    """
+    if partitions is None:
+        partitions = diff_partitions
+    ## Only columns in both exports can be compared
+    with open("{}.{}.csv".format(old_label, table_name), 'r', encoding='utf-8') as f_old, open("{}.{}.csv".format(new_label, table_name), 'r', encoding='utf-8') as f_new:
+        old_fields = csv.DictReader(f_old, skipinitialspace=True, delimiter = global_csv_delimiter).fieldnames or []
+        new_fields = csv.DictReader(f_new, skipinitialspace=True, delimiter = global_csv_delimiter).fieldnames or []
+    cols = [x for x in cols if x in old_fields and x in new_fields]
+    key_cols = [x for x in key_cols if x in cols]
+    if len(key_cols) == 0:
+        logger.warning("No key columns for '{}' in both exports, comparing whole rows".format(table_name))
+        key_cols = cols
+    counts = {"old_rows": 0, "new_rows": 0, "added": 0, "removed": 0, "changed": 0, "unchanged": 0}
+    diff_file = os.path.join(out_dir, "{}.diff.csv".format(table_name))
+    with tempfile.TemporaryDirectory(prefix = "compareCsv.") as partition_dir, open(diff_file, 'w', encoding='utf-8', newline='') as f_diff:
+        counts["old_rows"] = _partition_rows(old_label, old_cd, table_name, cols, key_cols, partitions, partition_dir)
+        counts["new_rows"] = _partition_rows(new_label, new_cd, table_name, cols, key_cols, partitions, partition_dir)
+        diff_writer = csv.writer(f_diff, delimiter = global_csv_delimiter)
+        diff_writer.writerow(["change", "key", "column", "old", "new"])
+        for i in range(partitions):
+            old_rows = _read_partition(os.path.join(partition_dir, "{}.{}.part{}.csv".format(old_label, table_name, i)), cols, key_cols)
+            new_rows = _read_partition(os.path.join(partition_dir, "{}.{}.part{}.csv".format(new_label, table_name, i)), cols, key_cols)
+            for key in sorted(set(old_rows.keys()) | set(new_rows.keys())):
+                key_label = "|".join(key)
+                old_list = old_rows.get(key, [])
+                new_list = new_rows.get(key, [])
+                ## Identical rows match, whatever their order
+                for row in list(old_list):
+                    if row in new_list:
+                        old_list.remove(row)
+                        new_list.remove(row)
+                        counts["unchanged"] += 1
+                for old_row, new_row in zip(old_list, new_list):
+                    counts["changed"] += 1
+                    for col in cols:
+                        if old_row[col] != new_row[col]:
+                            diff_writer.writerow(["changed", key_label, col, old_row[col], new_row[col]])
+                for old_row in old_list[len(new_list) : ]:
+                    counts["removed"] += 1
+                    diff_writer.writerow(["removed", key_label, "", global_csv_delimiter.join(old_row.values()), ""])
+                for new_row in new_list[len(old_list) : ]:
+                    counts["added"] += 1
+                    diff_writer.writerow(["added", key_label, "", "", global_csv_delimiter.join(new_row.values())])
+    logger.info("Compared '{}' ({} -> {}): {} - details in '{}'".format(table_name, old_label, new_label, counts, diff_file))
+    return counts
+
+def diff_tables(old_label:str, new_label:str, table_cols:dict[str:list[str]], key_cols:dict[str:list[str]], partitions:int = None, workers:int = None) -> dict:
+    """Compare all tables of 2 exports (see diff_table) - the tables are compared in parallel processes
+
+    :return: {table_name: counts}
+    """
+    tables = [table_name for table_name in table_cols.keys() if os.path.isfile("{}.{}.csv".format(old_label, table_name)) and os.path.isfile("{}.{}.csv".format(new_label, table_name))]
+    for table_name in table_cols.keys():
+        if table_name not in tables:
+            logger.error("Export of '{}' missing for '{}' or '{}', not compared".format(table_name, old_label, new_label))
+    results:dict = {}
+    with ProcessPoolExecutor(max_workers = workers or min(len(tables), os.cpu_count() or 1) or 1) as executor:
+        futures = {table_name: executor.submit(diff_table, table_name, old_label, sources[old_label], new_label, sources[new_label], table_cols[table_name], key_cols.get(table_name, []), partitions) for table_name in tables}
+        for table_name, future in futures.items():
+            results[table_name] = future.result()
+    return results
+
 def pre_checks():
     """Check variables are within limits"""
     pass
 
 if __name__ == "__main__":
     """Run as script"""
+    parser = argparse.ArgumentParser(description = "Compare i2b2 table exports")
+    parser.add_argument("--diff", action = "store_true", help = "Compare the exports directly (streaming) instead of writing slim files")
+    parser.add_argument("--old", default = list(sources.keys())[0], help = "Source label of the old export (a key of sources)")
+    parser.add_argument("--new", default = list(sources.keys())[-1], help = "Source label of the new export (a key of sources)")
+    parser.add_argument("--key", action = "append", default = [], help = "Key columns of a table, eg i2b2metadata.i2b2=c_fullname,m_applied_path")
+    parser.add_argument("--partitions", type = int, default = diff_partitions, help = "Partition files per table (more use less memory)")
+    parser.add_argument("--workers", type = int, default = None, help = "Tables compared in parallel")
+    args = parser.parse_args()
     logger.info("Running CSV comparison script")
     pre_checks()
-    for source_label, source_cd in sources.items():
-        trim_data(source_label, source_cd, table_cols_to_keep, suffix)
+    if args.diff:
+        key_cols = dict(table_key_cols)
+        for key_arg in args.key:
+            table_name, cols = key_arg.split("=", 1)
+            key_cols[table_name] = cols.split(",")
+        results = diff_tables(args.old, args.new, table_cols_to_keep, key_cols, args.partitions, args.workers)
+        for table_name, counts in results.items():
+            logger.info("{}: {}".format(table_name, counts))
+    else:
+        for source_label, source_cd in sources.items():
+            trim_data(source_label, source_cd, table_cols_to_keep, suffix)
     logger.info("Finished CSV comparison script")